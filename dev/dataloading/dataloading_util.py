@@ -1,3 +1,4 @@
+import functools
 import json
 
 import pandas as pd
@@ -8,6 +9,7 @@ from dev.dataloading.transformer import Transformer
 # from dev.dataloading.dataset import Dataset
 # from dev.dataloading.domain import Domain
 from utils import Dataset, Domain
+from utils.dataset_jax import get_column_dtypes
 
 
 def ohe_to_categorical(D, feats_idx):
@@ -131,25 +133,81 @@ def get_upsample_fn(oversample):
     return get_upsample_row
 
 
-def get_upsampled_dataset_from_relaxed(D, domain: Domain, oversample=1, seed=0):
-    feats_idx = domain.get_feats_idx()
-    n, d = D.shape
-    key = jax.random.key(seed)
-    key_cols = jax.random.split(key, len(feats_idx))
+@functools.lru_cache(maxsize=None)
+def get_upsample_kernel(oversample):
+    """jit of get_upsample_row batched over values, shared by the calls with the same oversample."""
+    return jit(vmap(get_upsample_fn(oversample)))
 
-    all_columns = []
-    for i, (feat, key_col) in enumerate(zip(feats_idx, key_cols)):
-        get_upsample_row = get_upsample_fn(oversample)
-        get_upsample_row_vmap = jit(vmap(get_upsample_row))
-        sub_keys = jax.random.split(key_col, n)
-        col = get_upsample_row_vmap(sub_keys, D[:, feat]).reshape(-1, 1)
-        all_columns.append(col)
 
-    new_D = np.hstack(all_columns)
-    df = pd.DataFrame(data=new_D, columns=list(domain.attrs))
-    dataset = Dataset(df, domain=domain)
-    return dataset
+def get_upsampled_dataset_from_relaxed(D, domain: Domain, oversample=1, seed=0, block_size=65536):
+    """
+    Samples oversample rows of the original domain from each row of the relaxed dataset D. The categorical columns
+    of one cardinality are upsampled together, by one kernel compiled for the group, on blocks of rows of D with about
+    block_size values of the group. Each block is written into the preallocated columns of the output.
+    """
+    n = D.shape[0]
+    key = jax.random.key(seed)
+    key_cols = jax.random.split(key, len(domain.attrs))
+    # The keys of each column and row.
+    row_keys = vmap(lambda key_col: jax.random.split(key_col, n))(key_cols)
+
+    dtypes = get_column_dtypes(domain)
+    columns = {attr: np.empty(n * oversample, dtype=dtypes[attr]) for attr in domain.attrs}
+    for i in domain.numeric_index:
+        columns[domain.attrs[i]][:] = np.repeat(np.asarray(D[:, domain.onehot_offsets[i]], dtype=np.float32), oversample)
+
+    upsample_fn = get_upsample_kernel(oversample)
+    cat_sizes = domain.cardinalities[domain.categorical_index]
+    for size in np.unique(cat_sizes):
+        cols = domain.categorical_index[cat_sizes == size]
+        g = len(cols)
+        positions = domain.onehot_offsets[cols][:, None] + np.arange(size)
+        keys = row_keys[cols].T
+        block_rows = max(1, min(n, block_size // g))
+        for start in range(0, n, block_rows):
+            stop = min(start + block_rows, n)
+            # The values of the block, row by row, flattened so that the kernel has one batch axis.
+            block_keys = keys[start:stop].reshape(-1)
+            block_probs = jnp.asarray(D[start:stop][:, positions]).reshape(-1, size)
+            pad = (block_rows - (stop - start)) * g
+            if pad > 0:
+                # Pad the last block to the compiled shape.
+                block_keys = jnp.concatenate([block_keys, jnp.repeat(block_keys[-1:], pad, axis=0)])
+                block_probs = jnp.concatenate([block_probs, jnp.repeat(block_probs[-1:], pad, axis=0)])
+            labels = np.asarray(upsample_fn(block_keys, block_probs))[: (stop - start) * g]
+            labels = labels.reshape(stop - start, g, oversample)
+            for j, i in enumerate(cols):
+                columns[domain.attrs[i]][start * oversample: stop * oversample] = labels[:, j].reshape(-1)
+
+    return Dataset.from_columns(domain, columns)
+
+
+
+def test_upsampled_dataset_blocks():
+    """The upsampled dataset does not depend on the block size, and matches the kernel applied to whole columns."""
+    domain = Domain([f"c{i}" for i in range(8)], [3, 1, 5, 3, 2, 1, 5, 3])
+    n, oversample, seed = 200, 10, 3
+    rng = np.random.default_rng(0)
+    D = np.concatenate(
+        [rng.dirichlet(np.ones(s), n) if s > 1 else rng.uniform(size=(n, 1)) for s in domain.shape], axis=1
+    ).astype(np.float32)
+
+    # Each column upsampled with the keys of its rows, without blocks.
+    key_cols = jax.random.split(jax.random.key(seed), len(domain.attrs))
+    upsample_fn = get_upsample_kernel(oversample)
+    expected = {}
+    for i, attr in enumerate(domain.attrs):
+        offset = domain.onehot_offsets[i]
+        values = upsample_fn(jax.random.split(key_cols[i], n), D[:, offset: offset + domain.shape[i]])
+        expected[attr] = np.asarray(values).reshape(-1)
+
+    for block_size in [1, 7, 64, 65536]:
+        data = get_upsampled_dataset_from_relaxed(D, domain, oversample=oversample, seed=seed, block_size=block_size)
+        assert len(data) == n * oversample
+        for attr in domain.attrs:
+            assert (data.df[attr].values == expected[attr].astype(data.df[attr].dtype)).all(), (block_size, attr)
 
 
 if __name__ == "__main__":
     test_get_dataset()
+    test_upsampled_dataset_blocks()
@@ -1,3 +1,4 @@
+import json
 import numpy as np
 import pandas as pd
 # from dev.dataloading.dataset import Dataset
@@ -10,6 +11,19 @@ CONTINUOUS = "continuous"
 ORDINAL = "ordinal"
 
 
+def _to_chunks(data):
+    """A DataFrame is a single chunk. Any other iterable, such as pd.read_csv(..., chunksize=n), yields the chunks."""
+    if isinstance(data, pd.DataFrame):
+        return [data]
+    return data
+
+
+def _to_json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
 class Transformer:
     """Continuous and ordinal columns are normalized to [0, 1].
     Discrete columns are converted to a one-hot vector.
@@ -34,14 +48,34 @@ class Transformer:
         ordinal_columns=tuple(),
         normalize=False,
     ):
-        meta = []
-
-        df = pd.DataFrame(data)
-        for index in df:
-            column = df[index]
+        """
+        :param data: a DataFrame, or an iterable of DataFrames with the same columns (chunks). With several chunks,
+        categories with the same count can be ordered differently than with a single DataFrame.
+        """
+        columns = None
+        value_counts = {}
+        ranges = {}
+        for chunk in _to_chunks(data):
+            df = pd.DataFrame(chunk)
+            columns = list(df.columns) if columns is None else columns
+            for index in df:
+                column = df[index]
+                if index in categorical_columns or index in ordinal_columns:
+                    counts = column.value_counts()
+                    if index in value_counts:
+                        counts = value_counts[index].add(counts, fill_value=0)
+                    value_counts[index] = counts
+                elif index in continuous_columns and normalize:
+                    col_min, col_max = column.min(), column.max()
+                    if index in ranges:
+                        col_min = min(col_min, ranges[index][0])
+                        col_max = max(col_max, ranges[index][1])
+                    ranges[index] = (col_min, col_max)
 
+        meta = []
+        for index in columns:
             if index in categorical_columns:
-                mapper = column.value_counts().index.tolist()
+                mapper = value_counts[index].sort_values(ascending=False, kind="stable").index.tolist()
                 meta.append(
                     {
                         "name": index,
@@ -51,9 +85,7 @@ class Transformer:
                     }
                 )
             elif index in ordinal_columns:
-                value_count = list(dict(column.value_counts()).items())
-                value_count = sorted(value_count, key=lambda x: -x[1])
-                mapper = list(map(lambda x: x[0], value_count))
+                mapper = value_counts[index].sort_values(ascending=False, kind="stable").index.tolist()
                 meta.append(
                     {"name": index, "type": ORDINAL, "size": len(mapper), "i2s": mapper}
                 )
@@ -62,20 +94,26 @@ class Transformer:
                     {
                         "name": index,
                         "type": CONTINUOUS,
-                        "min": column.min() if normalize else 0,
-                        "max": column.max() if normalize else 1,
+                        "min": ranges[index][0] if normalize else 0,
+                        "max": ranges[index][1] if normalize else 1,
                     }
                 )
 
         return meta
 
     def fit(self, data):
+        """
+        :param data: a DataFrame, or an iterable of DataFrames with the same columns (chunks)
+        """
         self.meta = self.get_metadata(
             data,
             self.categorical_columns,
             self.continuous_columns,
             normalize=self.normalize,
         )
+        self.set_output_dim()
+
+    def set_output_dim(self):
         self.output_dim = 0
         for info in self.meta:
             # if info['name'] != self.target_feat_idx:
@@ -84,10 +122,68 @@ class Transformer:
             else:
                 self.output_dim += info["size"]
 
+    def save(self, path):
+        """Saves the columns, the options and the fitted meta in a JSON file, so that load skips fit."""
+        config = {
+            "categorical_columns": list(self.categorical_columns),
+            "continuous_columns": list(self.continuous_columns),
+            "bin_size": self.bin_size,
+            "normalize": self.normalize,
+            "meta": [
+                {
+                    key: [_to_json_value(v) for v in value] if key == "i2s" else _to_json_value(value)
+                    for key, value in info.items()
+                }
+                for info in self.meta
+            ],
+        }
+        with open(path, "w") as f:
+            json.dump(config, f)
+
+    @staticmethod
+    def load(path):
+        """Loads a fitted Transformer saved with save."""
+        with open(path) as f:
+            config = json.load(f)
+        transformer = Transformer(
+            config["categorical_columns"],
+            config["continuous_columns"],
+            bin_size=config["bin_size"],
+            normalize=config["normalize"],
+        )
+        transformer.meta = config["meta"]
+        transformer.set_output_dim()
+        return transformer
+
+    def get_bin_edges(self, info):
+        """The bin edges that pd.cut computes for the fitted range of a continuous column."""
+        if not self.normalize:
+            raise ValueError(
+                "Binning chunks needs the range of the continuous columns, which fit computes with normalize=True."
+            )
+        edges = np.linspace(info["min"], info["max"], self.bin_size + 1)
+        edges[0] -= 0.001 * (info["max"] - info["min"])
+        return edges
+
     # def transform(self, data: pd.DataFrame, target: list) -> Dataset:
-    def transform(self, data: pd.DataFrame) -> Dataset:
+    def transform(self, data) -> Dataset:
+        """
+        :param data: a DataFrame, or an iterable of DataFrames (chunks). Continuous columns of chunks are binned on
+        the range of fit, which is the range of the data if it is the data of fit.
+        """
+        if isinstance(data, pd.DataFrame):
+            return self.transform_columns(data, bin_edges=None)
+        bin_edges = {
+            info["name"]: self.get_bin_edges(info)
+            for info in self.meta
+            if info["type"] == CONTINUOUS and self.bin_size is not None
+        }
+        chunks = [self.transform_columns(chunk, bin_edges=bin_edges) for chunk in data]
+        df = pd.concat([chunk.df for chunk in chunks], ignore_index=True)
+        return Dataset(df, chunks[0].domain)
 
-        data_t = []
+    def transform_columns(self, data: pd.DataFrame, bin_edges: dict = None) -> Dataset:
+        columns = {}
         attrs = []
         shape = []
         original_shape = []
@@ -97,86 +193,156 @@ class Transformer:
             attrs.append(col_name)
             if info["type"] == CONTINUOUS:
                 if self.bin_size is not None:
-                    col_binned = np.array(
-                        pd.cut(
-                            col,
-                            bins=self.bin_size,
-                            labels=np.arange(self.bin_size),
-                            retbins=False,
-                        )
+                    bins = self.bin_size if bin_edges is None else bin_edges[col_name]
+                    col_binned = pd.cut(
+                        col,
+                        bins=bins,
+                        labels=np.arange(self.bin_size),
+                        retbins=False,
                     )
-                    col_binned = col_binned.reshape([-1, 1])
-                    data_t.append(col_binned)
+                    columns[col_name] = np.asarray(col_binned)
                     shape.append(self.bin_size)
                 else:
                     # print(f"continuous column {id_}: {info['max']}, {info['min']}. col.max={col.max()}, col.min={col.min()}")
-                    col_normed = (col - info["min"]) / (
+                    columns[col_name] = (col - info["min"]) / (
                         info["max"] - info["min"] + 1e-9
                     )
-                    data_t.append(col_normed.reshape([-1, 1]))
                     shape.append(1)
                 original_shape.append(1)
             else:
-                mapper = dict([(item, id) for id, item in enumerate(info["i2s"])])
-                mapped = data[col_name].apply(lambda x: mapper[x]).values.astype(int)
-                data_t.append(mapped.reshape([-1, 1]).astype(int))
+                codes = pd.Categorical(col, categories=info["i2s"]).codes
+                if np.any(codes < 0):
+                    unknown = pd.unique(col[codes < 0])
+                    raise ValueError(f"Column {col_name} has values that were not seen by fit: {unknown[:10]}")
+                columns[col_name] = codes
                 shape.append(info["size"])
                 original_shape.append(info["size"])
 
         # domain = Domain(attrs, shape, target)
         domain = Domain(attrs, shape)
-        df = pd.DataFrame(np.concatenate(data_t, axis=1), columns=domain.attrs)
-        for id_, info in enumerate(self.meta):
-            col_name = info["name"]
-            if info["type"] == CATEGORICAL:
-                df[col_name] = df[col_name].astype(int)
-
         # self.original_domain = Domain(attrs, original_shape, target)
         self.original_domain = Domain(attrs, original_shape)
-        return Dataset(df, domain)
+        return Dataset.from_columns(domain, columns)
+
+    def inverse_transform(self, data: Dataset, chunk_size: int = None) -> pd.DataFrame:
+        """Takes as input a Dataset and return a DataFrame
 
-    def inverse_transform(self, data: Dataset) -> pd.DataFrame:
-        """Takes as input a Dataset and return a DataFrame"""
-        # data_t = np.zeros([len(data), len(self.meta)])
-        data_t = pd.DataFrame()
+        :param chunk_size: If given, the rows are converted in chunks of chunk_size rows, which bounds the memory of
+        the intermediate arrays.
+        """
+        if chunk_size is not None and len(data) > chunk_size:
+            return pd.concat(
+                [
+                    self.inverse_transform_columns(data.df.iloc[start:start + chunk_size])
+                    for start in range(0, len(data), chunk_size)
+                ],
+                ignore_index=True,
+            )
+        return self.inverse_transform_columns(data.df)
 
-        data = data.df.copy()
-        res = []
-        column_names = []
+    def inverse_transform_columns(self, df: pd.DataFrame) -> pd.DataFrame:
+        columns = {}
         for id_, info in enumerate(self.meta):
             col_name = info["name"]
-            column_names.append(col_name)
+            current = df.iloc[:, id_].to_numpy()
             if info["type"] == CONTINUOUS:
-                current = data.iloc[:, 0]
-                data = data.iloc[:, 1:]
                 min_val = info["min"]
                 max_val = info["max"]
                 if self.bin_size is not None:
                     # current = 0.5 * (2*current+1) / self.bin_size
-                    lower = current.values / self.bin_size
-                    upper = (current.values + 1) / self.bin_size
+                    lower = current / self.bin_size
+                    upper = (current + 1) / self.bin_size
                     current = np.random.uniform(lower, upper)
-                    current = current * (max_val - min_val) + min_val
-                    res.append(current)
-                else:
-                    current = (current * (max_val - min_val) + min_val).values
-                    res.append(current)
-                # data_t[col_name] = current
-                # print(data_t[col_name].isna().sum())
+                current = current * (max_val - min_val) + min_val
             else:
-                current = data.iloc[:, 0].astype(int)
-                data = data.iloc[:, 1:]
-                col_data = np.array(list(map(info["i2s"].__getitem__, current)))
-                res.append(col_data)
-                # data_t[col_name] = list(map(info['i2s'].__getitem__, current))
+                current = np.take(np.asarray(info["i2s"]), current.astype(int))
+                if info["type"] == CATEGORICAL and np.issubdtype(current.dtype, np.number):
+                    current = current.astype(int)
+            columns[col_name] = current
 
-        data_t = pd.DataFrame(np.column_stack(res), columns=column_names)
-        for id_, info in enumerate(self.meta):
-            col_name = info["name"]
-            if info["type"] == CATEGORICAL:
-                data_t[col_name] = data_t[col_name].astype(int)
+        return pd.DataFrame(columns)
+
+
+######################################################################
+## TEST
+######################################################################
+
+def get_test_dataframe(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "a": rng.integers(0, 20, n),
+            "x": rng.normal(size=n),
+            "b": rng.choice(["u", "v", "w"], n),
+            "y": rng.uniform(5, 9, n),
+        }
+    )
+
+
+def test_round_trip():
+    """inverse_transform recovers the categorical columns, and the continuous columns up to their bin."""
+    df = get_test_dataframe()
+    for bin_size in [None, 8]:
+        transformer = Transformer(["a", "b"], ["x", "y"], bin_size=bin_size, normalize=True)
+        transformer.fit(df)
+        data = transformer.transform(df)
+        assert transformer.output_dim == 20 + 3 + 2
+        post_df = transformer.inverse_transform(data)
+        assert list(post_df.columns) == list(df.columns)
+        assert (post_df["a"].values == df["a"].values).all()
+        assert (post_df["b"].values == df["b"].values).all()
+        for col in ["x", "y"]:
+            width = df[col].max() - df[col].min()
+            tolerance = 1e-6 if bin_size is None else 1.01 * width / bin_size
+            assert np.abs(post_df[col].values - df[col].values).max() <= tolerance * max(width, 1)
+
+        np.random.seed(0)
+        post_df = transformer.inverse_transform(data)
+        np.random.seed(0)
+        chunked_df = transformer.inverse_transform(data, chunk_size=300)
+        if bin_size is None:
+            assert np.allclose(chunked_df[["x", "y"]].values, post_df[["x", "y"]].values)
+        assert (chunked_df[["a", "b"]].values == post_df[["a", "b"]].values).all()
+
+
+def test_chunks_and_save():
+    """fit and transform on chunks match a single DataFrame, and a loaded transformer matches the saved one."""
+    import os
+    import tempfile
+
+    df = get_test_dataframe()
+    chunks = [df.iloc[start:start + 300] for start in range(0, len(df), 300)]
+    for bin_size in [None, 8]:
+        transformer = Transformer(["a", "b"], ["x", "y"], bin_size=bin_size, normalize=True)
+        transformer.fit(df)
+        data = transformer.transform(df)
+
+        chunked = Transformer(["a", "b"], ["x", "y"], bin_size=bin_size, normalize=True)
+        chunked.fit(chunks)
+        for info, chunked_info in zip(transformer.meta, chunked.meta):
+            if "i2s" in info:
+                # Categories with the same count can be ordered differently.
+                assert sorted(info["i2s"]) == sorted(chunked_info["i2s"])
+            else:
+                assert info == chunked_info
+        chunked.meta = transformer.meta
+        assert (chunked.transform(chunks).df.values == data.df.values).all()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "transformer.json")
+            transformer.save(path)
+            loaded = Transformer.load(path)
+        assert loaded.output_dim == transformer.output_dim
+        assert (loaded.transform(df).df.values == data.df.values).all()
+        assert (loaded.inverse_transform(data)[["a", "b"]].values == df[["a", "b"]].values).all()
 
-        return data_t
+    transformer = Transformer(["b"], ["x"])
+    transformer.fit(df)
+    try:
+        transformer.transform(pd.DataFrame({"b": ["z"], "x": [0.0]}))
+        assert False, "The value z was not seen by fit."
+    except ValueError:
+        pass
 
 
 if __name__ == "__main__":
@@ -201,3 +367,5 @@ if __name__ == "__main__":
     trans.fit(
         data,
     )
+    test_round_trip()
+    test_chunks_and_save()
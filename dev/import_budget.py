@@ -0,0 +1,52 @@
+"""
+Measures the cold import time of the core packages in a fresh interpreter, and checks it against a budget. The
+plotting, machine learning and dataset-loader dependencies must not be imported by the core packages.
+
+    python dev/import_budget.py --budget 2.5
+"""
+import argparse
+import subprocess
+import sys
+
+CORE_PACKAGES = ('utils', 'stats', 'models')
+FORBIDDEN_MODULES = ('matplotlib', 'seaborn', 'sklearn', 'dp_data')
+
+
+def get_import_times(packages=CORE_PACKAGES) -> dict:
+    """Returns the cumulative import time in seconds of every module imported by packages, from python -X importtime."""
+    statement = f'import {", ".join(packages)}'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'{statement} failed:\n{result.stderr}')
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        import_times[module.strip()] = int(cumulative) / 1e6
+    return import_times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=2.5, help='maximum import time of the core packages in seconds')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest top-level modules to print')
+    args = parser.parse_args()
+
+    import_times = get_import_times()
+    total = sum(import_times[package] for package in CORE_PACKAGES if package in import_times)
+    top_level = {module: t for module, t in import_times.items() if '.' not in module}
+    for module, t in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'{module:<30}{t:8.3f}s')
+    print(f'{"total":<30}{total:8.3f}s (budget {args.budget:.3f}s)')
+
+    failures = [f'{module} is imported' for module in FORBIDDEN_MODULES if module in import_times]
+    if total > args.budget:
+        failures.append(f'import time {total:.3f}s exceeds the budget of {args.budget:.3f}s')
+    if len(failures) > 0:
+        print('\n'.join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,3 @@
 from models.generator_base import Generator
 from models.gsd import GSD
+from models.planning import plan_gsd, GSDPlan, ModulePlan
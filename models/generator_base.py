@@ -1,66 +1,123 @@
+import contextlib
+import functools
 import jax
+import chex
+from flax import struct
 from stats import ChainedStatistics
 import time
 from utils import Dataset, timer
-from utils.cdp2adp import cdp_rho, cdp_eps
+from utils.profiling import TraceWindow, profile_scope
+from utils.sanitizer import Sanitizer
+from utils.accountant import cdp_rho, cdp_eps, ZCDPAccountant
 import jax.numpy as jnp
 from typing import Callable
 
+@struct.dataclass
+class StopConfig:
+    """
+    Stopping rules of a generation loop. The loop stops when the best fitness falls below target_fitness, when
+    max_generations have run, or when the best fitness improved by less than plateau_tolerance (relative) over the
+    last plateau_window generations. plateau_window = 0 disables the plateau rule.
+    """
+    max_generations: chex.Array
+    target_fitness: chex.Array
+    plateau_window: chex.Array
+    plateau_tolerance: chex.Array
+
+    @staticmethod
+    def create(max_generations: int, target_fitness: float = 0.0, plateau_window: int = 0,
+               plateau_tolerance: float = 0.0001):
+        return StopConfig(max_generations=jnp.int32(max_generations), target_fitness=jnp.float32(target_fitness),
+                          plateau_window=jnp.int32(plateau_window), plateau_tolerance=jnp.float32(plateau_tolerance))
+
+
+@struct.dataclass
+class StopState:
+    """State of the stopping rules, kept on the device and updated every generation."""
+    generation: chex.Array
+    lag_fitness: chex.Array
+    stopped: chex.Array
+
+    @staticmethod
+    def create(best_fitness):
+        return StopState(generation=jnp.int32(0), lag_fitness=jnp.asarray(best_fitness, dtype=jnp.float32),
+                         stopped=jnp.bool_(False))
+
+
+def update_stop_state(stop_state: StopState, best_fitness: chex.Array, config: StopConfig) -> StopState:
+    """Applies the stopping rules after a generation. Traceable, so it can run inside the generation loop."""
+    t = stop_state.generation
+    window = config.plateau_window
+    check_plateau = (window > 0) & (t % jnp.maximum(window, 1) == 0) & (t > window)
+    loss_change = jnp.abs(stop_state.lag_fitness - best_fitness) / stop_state.lag_fitness
+    plateau = check_plateau & (loss_change < config.plateau_tolerance)
+    stopped = (best_fitness < config.target_fitness) | plateau | (t + 1 >= config.max_generations)
+    return StopState(generation=t + 1,
+                     lag_fitness=jnp.where(check_plateau, best_fitness, stop_state.lag_fitness),
+                     stopped=stopped)
+
+
+def get_round_time_budget(time_budget: float, elapsed_time: float, remaining_rounds: int):
+    if time_budget is None:
+        return None
+    return max(time_budget - elapsed_time, 0) / remaining_rounds
+
+
+def sanitized(name: str):
+    """Decorator of the methods of Generator that counts the jit cache misses and transfers of the call, see sanitize."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.sanitize(name):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class Generator:
     data_size: int
-    early_stop_elapsed_time = 1
-    last_time: float = None
-    last_error: float = None
-    loss_change_threshold: float = 0.001
-
-    def early_stop_init(self):
-        self.last_time: float = time.time()
-        self.last_error = 10000000
-        self.start_time = time.time()
-        self.last_update_iteration = 0
-
-    def early_stop(self, t, error):
+    statistics_min_sizes: dict = None
+    sanitizer: Sanitizer = None
+    # Budget spent by the steps of the last private fit.
+    privacy_accountant: ZCDPAccountant = None
+
+    def sanitize(self, name: str):
         """
-        :param t: current iteration
-        :param error: the error on this iteration
-        :return:
+        Activates the sanitizer of the generator, if any, in the region name. The sanitizer reports when the outermost
+        sanitized call returns, so a call of fit inside fit_zcdp_adaptive is reported with the whole run.
         """
-        if self.last_update_iteration == 0:  # If it's the first time don't halt
-            self.last_error = error
-            self.last_update_iteration = t
-            return False
-
-        stop_early = False
-        loss_change = (self.last_error - error) / self.last_error
-        iterations_increase = (t - self.last_update_iteration) / self.last_update_iteration
-        if loss_change > self.loss_change_threshold:
-            # If the loss improves same the iteration and the error
-            self.last_error = error
-            self.last_update_iteration = t
-
-        if iterations_increase > 0.1:
-            # If the iterations have increased by more than 10% since the last improvement then halt
-            stop_early = True
-            self.last_error = error
-            self.last_update_iteration = t
-        return stop_early
+        if self.sanitizer is None:
+            return contextlib.nullcontext()
+        return self.sanitizer.activate(name)
 
     def fit(self, key: jax.Array, stat: ChainedStatistics, init_data: Dataset = None,
-            tolerance: float = 0, adaptive_epoch: int = 1) -> Dataset:
+            tolerance: float = 0, adaptive_epoch: int = 1, time_budget: float = None) -> Dataset:
         pass
 
+    def compile_ahead(self, stat: ChainedStatistics, num_sample: int = 1) -> dict:
+        """
+        Starts compiling the kernels of the next round in the background. Returns the layout of the statistics they
+        are compiled for, or None if the generator does not compile ahead.
+        """
+        return None
+
     def fit_dp(self, key: jax.Array, stat_module: ChainedStatistics, epsilon: float, delta: float,
                init_data: Dataset = None, tolerance: float = 0) -> Dataset:
         rho = cdp_rho(epsilon, delta)
         eps2 = cdp_eps(rho, delta)
         assert eps2 <= epsilon, f'Error: ({eps2})-zCDP -> ({eps2})-DP'
-        return self.fit_zcdp(key, stat_module, rho, init_data, tolerance)
+        return self.fit_zcdp(key, stat_module, rho, init_data, tolerance, delta=delta)
 
     def fit_zcdp(self, key: jax.Array, stat_module: ChainedStatistics, rho: float,
-                 init_data: Dataset = None, tolerance: float = 0) -> Dataset:
+                 init_data: Dataset = None, tolerance: float = 0, delta: float = None) -> Dataset:
+        """
+        :param delta: If given, the privacy accountant also reports the budget as epsilon of (epsilon, delta)-DP.
+        """
         key_stats, key_fit = jax.random.split(key)
+        self.privacy_accountant = ZCDPAccountant(rho, delta)
         stat_module.reselect_stats()
         stat_module.private_measure_all_statistics(key_stats, rho)
+        self.privacy_accountant.spend(rho, 'oneshot')
 
         return self.fit(key_fit, stat_module, init_data, tolerance, adaptive_epoch=1)
 
@@ -79,50 +136,73 @@ class Generator:
                         tolerance: float = 0,
                         start_sync=True,
                         print_progress=True,
-                        debug_fn: Callable = None, num_sample=1):
+                        debug_fn: Callable = None, num_sample=1, time_budget: float = None):
         rho = cdp_rho(epsilon, delta)
         eps2 = cdp_eps(rho, delta)
         assert rho < epsilon, f'Error: ({rho})-zCDP -> ({eps2})-DP'
         return self.fit_zcdp_adaptive(key, stat_module, rounds, rho, tolerance, start_sync, print_progress, debug_fn,
-                                      num_sample)
+                                      num_sample, time_budget, delta=delta)
 
+    @sanitized('Generator.fit_zcdp_adaptive')
     def fit_zcdp_adaptive(self, key: jax.Array,
                           stat_module: ChainedStatistics,
                           rounds: int,
                           rho: float, tolerance: float = 0,
                           start_sync=False,
                           print_progress=False,
-                          debug_fn: Callable = None, num_sample=1):
+                          debug_fn: Callable = None, num_sample=1,
+                          time_budget: float = None,
+                          trace_rounds: TraceWindow = None,
+                          delta: float = None):
+        """
+        :param time_budget: total time in seconds. Each round gets an equal share of the time that is left, so
+         rounds that converge early leave more time to the later ones.
+        :param trace_rounds: If given, the profiler trace of its window of rounds (starting at 1) is written to its
+         directory.
+        :param delta: If given, the privacy accountant also reports the budget as epsilon of (epsilon, delta)-DP.
+        """
 
         # Reset selected statistics
         stat_module.reselect_stats()
 
         rho_per_round = rho / rounds
+        self.privacy_accountant = ZCDPAccountant(rho, delta)
 
         key, key_init = jax.random.split(key, 2)
         init_seed = int(jax.random.randint(key_init, minval=0, maxval=2 ** 20, shape=(1,))[0])
         sync_dataset = Dataset.synthetic(stat_module.get_domain(), N=self.data_size, seed=init_seed)
 
+        start_time = timer()
         for i in range(1, rounds + 1):
-            if i < rounds:
-                self.loss_change_threshold = 0.01
-            else:
-                self.loss_change_threshold = 0.001
+            if trace_rounds is not None:
+                trace_rounds.step(i)
+            # Kernels of this round, compiled in the background during the previous round or during the selection.
+            self.statistics_min_sizes = self.compile_ahead(stat_module, num_sample)
 
             # Select a query with max error using the exponential mechanism and evaluate
             select_time = timer()
             # X_sync = sync_dataset.to_numpy()
             key, subkey_select = jax.random.split(key, 2)
-            stat_module.private_select_measure_statistic(subkey_select, rho_per_round, sync_dataset, num_sample)
+            with profile_scope('Generator.round/select'):
+                stat_module.private_select_measure_statistic(subkey_select, rho_per_round, sync_dataset, num_sample)
+            self.privacy_accountant.spend(rho_per_round, f'round {i}')
             select_time = timer() - select_time
 
+            # Kernels of the next round, compiled in the background while this round runs.
+            if i < rounds:
+                self.compile_ahead(stat_module, num_sample)
+
             fit_time = timer()
             key, key_fit = jax.random.split(key, 2)
+            round_time_budget = get_round_time_budget(time_budget, timer() - start_time, rounds - i + 1)
             dataset: Dataset
-            if start_sync:
-                new_sync_dataset = self.fit(key_fit, stat_module, sync_dataset, tolerance=tolerance, adaptive_epoch=i)
-            else:
-                new_sync_dataset = self.fit(key_fit, stat_module, tolerance=tolerance, adaptive_epoch=i)
+            with profile_scope('Generator.round/fit'):
+                if start_sync:
+                    new_sync_dataset = self.fit(key_fit, stat_module, sync_dataset, tolerance=tolerance,
+                                                adaptive_epoch=i, time_budget=round_time_budget)
+                else:
+                    new_sync_dataset = self.fit(key_fit, stat_module, tolerance=tolerance, adaptive_epoch=i,
+                                                time_budget=round_time_budget)
             fit_time = timer() - fit_time
 
             if print_progress:
@@ -152,7 +232,12 @@ class Generator:
 
             if debug_fn is not None:
                 debug_fn(i, sync_dataset)
+            if trace_rounds is not None:
+                trace_rounds.step_end(i)
 
+        if trace_rounds is not None:
+            trace_rounds.stop()
+        self.statistics_min_sizes = None
         return sync_dataset
 
     def fit_dp_hybrid(self, key: jax.Array,
@@ -163,14 +248,16 @@ class Generator:
                         start_sync=True,
                         print_progress=True,
                         debug_fn: Callable = None, num_sample=1,
-                      oneshot_share_opt=None):
+                      oneshot_share_opt=None, time_budget: float = None):
         rho = cdp_rho(epsilon, delta)
         eps2 = cdp_eps(rho, delta)
 
         assert rho < epsilon, f'Error: ({rho})-zCDP -> ({eps2})-DP'
         return self.fit_zcdp_hybrid(key, stat_module, rounds, rho, tolerance,
-                                    start_sync, print_progress, debug_fn, num_sample, oneshot_share_opt)
+                                    start_sync, print_progress, debug_fn, num_sample, oneshot_share_opt,
+                                    time_budget, delta=delta)
 
+    @sanitized('Generator.fit_zcdp_hybrid')
     def fit_zcdp_hybrid(self, key: jax.Array,
                             stat_module: ChainedStatistics,
                             rounds: int,
@@ -179,7 +266,17 @@ class Generator:
                             print_progress=False,
                             debug_fn: Callable = None,
                         num_sample=1,
-                        oneshot_share_opt=None):
+                        oneshot_share_opt=None,
+                        time_budget: float = None,
+                        trace_rounds: TraceWindow = None,
+                        delta: float = None):
+        """
+        :param time_budget: total time in seconds of the adaptive rounds. Each round gets an equal share of the time
+         that is left, so rounds that converge early leave more time to the later ones.
+        :param trace_rounds: If given, the profiler trace of its window of adaptive rounds (starting at 1) is written
+         to its directory.
+        :param delta: If given, the privacy accountant also reports the budget as epsilon of (epsilon, delta)-DP.
+        """
         oneshot_stats_ids = [0]
         num_adaptive_queries = rounds * num_sample
         oneshot_workloads = stat_module.stat_modules[0].get_num_workloads()
@@ -193,10 +290,12 @@ class Generator:
 
         rho_oneshot = oneshot_share * rho
         rho_adaptive = rho - rho_oneshot
+        self.privacy_accountant = ZCDPAccountant(rho, delta)
 
         # Oneshot
         key, key_oneshot = jax.random.split(key, 2)
         stat_module.private_measure_all_statistics(key_oneshot, rho_oneshot, stat_ids=oneshot_stats_ids)
+        self.privacy_accountant.spend(rho_oneshot, 'oneshot')
 
 
         ## Adaptive
@@ -206,6 +305,8 @@ class Generator:
         init_seed = int(jax.random.randint(key_init, minval=0, maxval=2 ** 20, shape=(1,))[0])
         sync_dataset = Dataset.synthetic(stat_module.get_domain(), N=self.data_size, seed=init_seed)
 
+        # Kernels of the first adaptive round, compiled in the background during the one-shot fit.
+        self.compile_ahead(stat_module, num_sample)
         key, key_oneshot_fit = jax.random.split(key, 2)
         sync_dataset = self.fit(key_oneshot_fit, stat_module, sync_dataset, tolerance=tolerance)
 
@@ -218,26 +319,42 @@ class Generator:
               f'\tTrue error(max/l2) is {oneshot_error.max():.5f}/{oneshot_error.mean():.7f}.'
               f'\tGaussian error(max/l2) is {gau_error.max():.5f}/{gau_error.mean():.7f}.')
 
+        start_time = timer()
         for i in range(1, rounds + 1):
+            if trace_rounds is not None:
+                trace_rounds.step(i)
             # if i < rounds:
             #     self.loss_change_threshold = 0.01
             # else:
             #     self.loss_change_threshold = 0.001
 
+            # Kernels of this round, compiled in the background during the previous round or during the selection.
+            self.statistics_min_sizes = self.compile_ahead(stat_module, num_sample)
+
             # Select a query with max error using the exponential mechanism and evaluate
             select_time = timer()
             # X_sync = sync_dataset.to_numpy()
             key, subkey_select = jax.random.split(key, 2)
-            stat_module.private_select_measure_statistic(subkey_select, rho_per_round, sync_dataset, num_sample)
+            with profile_scope('Generator.round/select'):
+                stat_module.private_select_measure_statistic(subkey_select, rho_per_round, sync_dataset, num_sample)
+            self.privacy_accountant.spend(rho_per_round, f'round {i}')
             select_time = timer() - select_time
 
+            # Kernels of the next round, compiled in the background while this round runs.
+            if i < rounds:
+                self.compile_ahead(stat_module, num_sample)
+
             fit_time = timer()
             key, key_fit = jax.random.split(key, 2)
+            round_time_budget = get_round_time_budget(time_budget, timer() - start_time, rounds - i + 1)
             dataset: Dataset
-            if start_sync:
-                new_sync_dataset = self.fit(key_fit, stat_module, sync_dataset, tolerance=tolerance, adaptive_epoch=i)
-            else:
-                new_sync_dataset = self.fit(key_fit, stat_module, tolerance=tolerance, adaptive_epoch=i)
+            with profile_scope('Generator.round/fit'):
+                if start_sync:
+                    new_sync_dataset = self.fit(key_fit, stat_module, sync_dataset, tolerance=tolerance,
+                                                adaptive_epoch=i, time_budget=round_time_budget)
+                else:
+                    new_sync_dataset = self.fit(key_fit, stat_module, tolerance=tolerance, adaptive_epoch=i,
+                                                time_budget=round_time_budget)
             fit_time = timer() - fit_time
 
             if print_progress:
@@ -266,5 +383,10 @@ class Generator:
 
             if debug_fn is not None:
                 debug_fn(i, sync_dataset)
+            if trace_rounds is not None:
+                trace_rounds.step_end(i)
 
+        if trace_rounds is not None:
+            trace_rounds.stop()
+        self.statistics_min_sizes = None
         return sync_dataset
\ No newline at end of file
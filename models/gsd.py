@@ -1,12 +1,24 @@
+import os
+import warnings
 import jax.numpy as jnp
+import numpy as np
 import pandas as pd
 from models import Generator
+from models.generator_base import StopConfig, StopState, update_stop_state, sanitized
 import time
 from stats import ChainedStatistics
+from stats.chained_statistics import pad_statistics
 import jax
 import chex
 from flax import struct
+from jax.experimental.shard_map import shard_map
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
 from utils import Dataset, Domain, timer
+from utils.compilation import KernelCache, enable_persistent_compilation_cache
+from utils.telemetry import Telemetry
+from utils.profiling import profile_scope
+from utils.sanitizer import device_get
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
 from typing import Tuple
 
@@ -26,6 +38,96 @@ class PopulationState:
     add_row: chex.Array
 
 
+@struct.dataclass
+class RandomPool:
+    """Random numbers of several generations of ask_pooled, drawn at once. The first axis is the generation."""
+    muta_rows: chex.Array
+    muta_cols: chex.Array
+    muta_values: chex.Array
+    mate_rows: chex.Array
+    mate_elite_ids: chex.Array
+    mate_elite_rows: chex.Array
+    mate_cols: chex.Array
+    mate_noise: chex.Array
+
+
+@struct.dataclass
+class GenerationTelemetry:
+    """Telemetry of a chunk of generations, one entry per generation. Generations that did not run are NaN or 0."""
+    best_fitness: chex.Array
+    population_best_fitness: chex.Array
+    replaced_best: chex.Array
+    elite_accepted: chex.Array
+
+    @staticmethod
+    def create(num_steps: int):
+        return GenerationTelemetry(best_fitness=jnp.full(num_steps, jnp.nan, dtype=jnp.float32),
+                                   population_best_fitness=jnp.full(num_steps, jnp.nan, dtype=jnp.float32),
+                                   replaced_best=jnp.zeros(num_steps, dtype=jnp.bool_),
+                                   elite_accepted=jnp.zeros(num_steps, dtype=jnp.int32))
+
+
+@struct.dataclass
+class WarmStartState:
+    """State carried by GSD from one call of fit to the next one."""
+    state: EvoState
+    elite_stat: chex.Array
+    workload_keys: list = struct.field(pytree_node=False)
+    selection_version: int = struct.field(pytree_node=False)
+    statistics: ChainedStatistics = struct.field(pytree_node=False)
+    # The dataset returned by the fit that saved the state.
+    sync_dataset: Dataset = struct.field(pytree_node=False, default=None)
+
+
+def get_extended_statistics_order(workload_keys: list, old_workload_keys: list, workload_sizes: dict):
+    """
+    Returns the indices that reorder the concatenation [old statistics, new statistics] into the order of
+    workload_keys. The new statistics must be concatenated in the order they appear in workload_keys.
+    """
+    positions = {}
+    pos = 0
+    for key in old_workload_keys:
+        positions[key] = pos
+        pos += workload_sizes[key]
+    for key in workload_keys:
+        if key not in positions:
+            positions[key] = pos
+            pos += workload_sizes[key]
+    return np.concatenate([np.arange(positions[key], positions[key] + workload_sizes[key]) for key in workload_keys])
+
+
+# Bytes of the temporaries of the fitness of one member on one statistic: the statistics of the added and removed rows,
+# the updated statistics and the error.
+FITNESS_BYTES_PER_STATISTIC = 16
+
+
+def get_largest_divisor(n: int, max_divisor: int) -> int:
+    return max(k for k in range(1, max(min(n, max_divisor), 1) + 1) if n % k == 0)
+
+
+def get_fitness_chunk_sizes(population_size: int, table_sizes: list, memory_budget: int) -> tuple:
+    """
+    Returns the number of members and, for each query table, the number of queries whose fitness terms are evaluated
+    at once, so that the temporaries of the fitness fit in memory_budget bytes. The population is split first, and
+    the query tables only if a single member does not fit.
+    """
+    max_statistics = max(memory_budget // FITNESS_BYTES_PER_STATISTIC, 1)
+    num_statistics = sum(table_sizes)
+    population_chunk = get_largest_divisor(population_size, max_statistics // max(num_statistics, 1))
+    if population_chunk * num_statistics <= max_statistics:
+        return population_chunk, list(table_sizes)
+    # The padded table sizes are k * 2^j with k < 16, see get_query_bucket_size, so they have power of two divisors.
+    max_chunk = max(max_statistics, 1)
+    return 1, [get_largest_divisor(size, max_chunk) if size > max_chunk else size for size in table_sizes]
+
+
+def get_device_mesh(size: int, axis_name: str) -> Mesh:
+    """Returns a one dimensional mesh over the largest number of devices that divides size."""
+    devices = jax.devices()
+    num_shards = max(n for n in range(1, len(devices) + 1) if size % n == 0)
+    return Mesh(np.array(devices[:num_shards]), (axis_name,))
+
+
 """
 Implement crossover that is specific to synthetic data
 """
@@ -48,6 +150,54 @@ def get_best_fitness_member(
     )
     return best_member, best_fitness, replace_best, best_in_gen
 
+class Genome:
+    def __init__(self, domain: Domain, compact: bool = False):
+        """
+        Storage type of the synthetic datasets of GSD: the elite archive, the best member and the population.
+
+        The default genome is float32. The compact genome stores the categorical columns as their integer values and
+        the numeric columns, which lie in [0, 1], in fixed point with 16 bits. It is uint8 if every column is
+        categorical with at most 256 values, uint16 otherwise. The statistics are computed on the decoded rows.
+
+        :param compact: If True, use the compact genome. A domain with a categorical column of more than 65536 values
+         does not fit in uint16, and keeps the float32 genome with a warning.
+        """
+        sizes = np.array(domain.shape)
+        self.numeric_mask = jnp.array(sizes == 1)
+        self.dtype = jnp.float32
+        self.scale = 1
+        if compact and sizes.max() > 2 ** 16:
+            warnings.warn(f'The compact genome holds categorical columns of at most {2 ** 16} values, but the domain '
+                          f'has a column of {sizes.max()} values. The genome is float32.')
+        if compact and sizes.max() <= 2 ** 16:
+            if (sizes > 1).all() and sizes.max() <= 2 ** 8:
+                self.dtype = jnp.uint8
+            else:
+                self.dtype = jnp.uint16
+                self.scale = 2 ** 16 - 1
+
+    def is_compact(self) -> bool:
+        return self.dtype != jnp.float32
+
+    def encode(self, X: chex.Array) -> chex.Array:
+        """Encodes rows of values, whose last axis is the columns of the domain."""
+        if not self.is_compact():
+            return X.astype(jnp.float32)
+        return jnp.where(self.numeric_mask, jnp.round(X * self.scale), X).astype(self.dtype)
+
+    def encode_values(self, values: chex.Array, cols: chex.Array) -> chex.Array:
+        """Encodes values of the columns cols."""
+        if not self.is_compact():
+            return values.astype(jnp.float32)
+        return jnp.where(self.numeric_mask[cols], jnp.round(values * self.scale), values).astype(self.dtype)
+
+    def decode(self, X: chex.Array) -> chex.Array:
+        if not self.is_compact():
+            return X.astype(jnp.float32)
+        X = X.astype(jnp.float32)
+        return jnp.where(self.numeric_mask, X / self.scale, X)
+
+
 class SimpleGAforSyncData:
     def __init__(self, domain: Domain,
                  data_size: int,
@@ -57,10 +207,19 @@ class SimpleGAforSyncData:
                  elite_size: int = 5,
                  muta_rate: int = 1,
                  mate_rate: int = 1,
+                 random_pool_size: int = 64,
+                 row_mesh: Mesh = None,
+                 genome: Genome = None,
                  debugging=False):
         """Simple Genetic Algorithm For Synthetic Data Search Adapted from (Such et al., 2017)
         Reference: https://arxiv.org/abs/1712.06567
-        Inspired by: https://github.com/hardmaru/estool/blob/master/es.py"""
+        Inspired by: https://github.com/hardmaru/estool/blob/master/es.py
+
+        :param random_pool_size: number of generations whose random numbers are drawn at once by draw_random_pool
+        :param row_mesh: If given, the rows of the synthetic datasets of the state and of the population are split
+         over the devices of this mesh, see get_state_sharding
+        :param genome: storage type of the synthetic datasets, float32 by default
+        """
 
         if population_size is not None:
             self.population_size_muta = population_size // 2
@@ -83,30 +242,55 @@ class SimpleGAforSyncData:
         assert muta_rate == mate_rate, "Mutations and crossover must be the same."
         self.muta_rate = muta_rate
         self.mate_rate = mate_rate
+        self.random_pool_size = random_pool_size
+        self.row_mesh = row_mesh
+        self.genome = genome if genome is not None else Genome(domain)
         self.debugging = debugging
 
+        d = len(domain.attrs)
+        self.column_sizes = jnp.array(domain.shape)
+        numeric_idx = jnp.asarray(domain.numeric_index)
+        self.numeric_mask = jnp.zeros(d).at[numeric_idx].set(1)
+
     def initialize(
             self, rng: chex.PRNGKey
     ) -> EvoState:
         """`initialize` the evolution strategy."""
-        init_x = self.initialize_elite_population(rng)
+        if self.row_mesh is None:
+            init_x = self.initialize_elite_population(rng)
+        else:
+            init_x = jax.jit(self.initialize_sharded_elite_population,
+                             out_shardings=self.get_state_sharding().archive)(rng)
+        init_x = self.genome.encode(init_x)
         state = EvoState(
-            archive=init_x.astype(jnp.float32),
+            archive=init_x,
             fitness=jnp.zeros(self.elite_size) + jnp.finfo(jnp.float32).max,
-            best_member=init_x[0].astype(jnp.float32),
+            best_member=init_x[0],
             best_fitness=jnp.finfo(jnp.float32).max
         )
+        state = self.shard_state(state)
 
         rng1, rng2 = jax.random.split(rng, 2)
-        random_numbers = jax.random.permutation(rng1, self.data_size, independent=True)
-        muta_fn = get_mutate_fn(muta_rate=self.muta_rate, random_numbers=random_numbers)
-        mate_fn = get_mating_fn(self.domain, mate_rate=self.mate_rate, random_numbers=random_numbers)
-
-        self.muta_vmap = jax.jit(jax.vmap(muta_fn, in_axes=(None, 0, 0)))
-        self.mate_vmap = jax.jit(jax.vmap(mate_fn, in_axes=(None, 0, 0)))
+        self.random_numbers = jax.random.permutation(rng1, self.data_size, independent=True)
 
         return state
 
+    def get_state_shape(self) -> EvoState:
+        d = len(self.domain.attrs)
+        return EvoState(
+            archive=jax.ShapeDtypeStruct((self.elite_size, self.data_size, d), self.genome.dtype),
+            fitness=jax.ShapeDtypeStruct((self.elite_size,), jnp.float32),
+            best_member=jax.ShapeDtypeStruct((self.data_size, d), self.genome.dtype),
+            best_fitness=jax.ShapeDtypeStruct((), jnp.float32)
+        )
+
+    def get_population_state_shape(self) -> PopulationState:
+        d = len(self.domain.attrs)
+        return PopulationState(
+            X=jax.ShapeDtypeStruct((self.population_size, self.data_size, d), self.genome.dtype),
+            remove_row=jax.ShapeDtypeStruct((self.population_size, self.muta_rate, d), self.genome.dtype),
+            add_row=jax.ShapeDtypeStruct((self.population_size, self.muta_rate, d), self.genome.dtype))
+
     @partial(jax.jit, static_argnums=(0,))
     def initialize_elite_population(self, rng: chex.PRNGKey):
         d = len(self.domain.attrs)
@@ -114,36 +298,107 @@ class SimpleGAforSyncData:
         initialization = pop.reshape((self.elite_size, self.data_size, d))
         return initialization
 
+    def initialize_sharded_elite_population(self, rng: chex.PRNGKey):
+        """
+        Same distribution as initialize_elite_population, but the members are drawn one at a time so that only one
+        synthetic dataset is generated at once.
+        """
+        return jax.lax.map(lambda rng_member: Dataset.synthetic_jax_rng(self.domain, self.data_size, rng_member),
+                           jax.random.split(rng, self.elite_size))
+
+    def get_state_sharding(self) -> EvoState:
+        """
+        Returns the sharding of each field of the state: the rows of the archive and of the best member are split
+        over row_mesh and the fitness is replicated. Returns None without row_mesh.
+        """
+        if self.row_mesh is None:
+            return None
+        return EvoState(archive=NamedSharding(self.row_mesh, P(None, 'rows', None)),
+                        fitness=NamedSharding(self.row_mesh, P()),
+                        best_member=NamedSharding(self.row_mesh, P('rows', None)),
+                        best_fitness=NamedSharding(self.row_mesh, P()))
+
+    def shard_state(self, state: EvoState) -> EvoState:
+        if self.row_mesh is None:
+            return state
+        return jax.device_put(state, self.get_state_sharding())
+
     @partial(jax.jit, static_argnums=(0,))
     def initialize_random_population(self, rng: chex.PRNGKey):
         pop = Dataset.synthetic_jax_rng(self.domain, self.population_size, rng)
         return pop
 
-    def ask(self, rng: chex.PRNGKey, state: EvoState):
-        rng_pop, rng_ask = jax.random.split(rng, 2)
-        random_data = self.initialize_random_population(rng_pop)
-        return self.ask_strategy(rng_ask, random_data, state)
+    @partial(jax.jit, static_argnums=(0,))
+    def draw_random_pool(self, rng: chex.PRNGKey, random_numbers: chex.Array) -> RandomPool:
+        """
+        Draws the random numbers of random_pool_size generations of ask_pooled with one call. Each member of the
+        population changes a window of rows of the permutation random_numbers.
+        """
+        K = self.random_pool_size
+        d = len(self.domain.attrs)
+        muta_shape = (K, self.population_size_muta, self.muta_rate)
+        mate_shape = (K, self.population_size_cross, self.mate_rate)
+        rng_muta_rows, rng_muta_cols, rng_muta_values, rng_mate_rows, rng_mate_ids, rng_mate_elite_rows, \
+            rng_mate_cols, rng_mate_noise = jax.random.split(rng, 8)
+
+        def get_rows(rng_rows, shape):
+            start = jax.random.randint(rng_rows, minval=0, maxval=random_numbers.shape[0] - shape[-1],
+                                       shape=shape[:-1] + (1,))
+            return random_numbers[start + jnp.arange(shape[-1])]
+
+        # A new value is uniform over the domain of its column, as in Dataset.synthetic_jax_rng.
+        muta_cols = jax.random.randint(rng_muta_cols, minval=0, maxval=d, shape=muta_shape)
+        sizes = self.column_sizes[muta_cols]
+        u = jax.random.uniform(rng_muta_values, shape=muta_shape)
+        muta_values = self.genome.encode_values(jnp.where(sizes > 1, jnp.floor(u * sizes), u), muta_cols)
+
+        return RandomPool(
+            muta_rows=get_rows(rng_muta_rows, muta_shape),
+            muta_cols=muta_cols,
+            muta_values=muta_values,
+            mate_rows=get_rows(rng_mate_rows, mate_shape),
+            mate_elite_ids=jax.random.randint(rng_mate_ids, minval=0, maxval=self.elite_size, shape=mate_shape[:-1]),
+            mate_elite_rows=jax.random.randint(rng_mate_elite_rows, minval=0, maxval=self.data_size, shape=mate_shape),
+            mate_cols=jax.random.randint(rng_mate_cols, minval=0, maxval=d, shape=mate_shape),
+            mate_noise=jax.random.normal(rng_mate_noise, shape=mate_shape + (d,)),
+        )
 
     @partial(jax.jit, static_argnums=(0,))
-    def ask_strategy(self, rng: chex.PRNGKey, random_data, state: EvoState):
-        rng, rng_i, rng_j, rng_k, rng_muta, rng_mate, rng_mutate = jax.random.split(rng, 7)
-
-        random_data = random_data[:self.population_size_muta, :]
-        rng_muta_split = jax.random.split(rng_muta, self.population_size_muta)
-        pop_muta = self.muta_vmap(state.best_member, rng_muta_split, random_data)
-
-        rng_mate_split = jax.random.split(rng_mate, self.population_size_cross)
-        j = jax.random.randint(rng_j, minval=0, maxval=self.elite_size, shape=(self.population_size_cross,))
-        x_j = state.archive[j]
-        pop_mate = self.mate_vmap(state.best_member, rng_mate_split, x_j)
-
-        remove_row = jnp.concatenate((pop_muta.remove_row, pop_mate.remove_row), axis=0)
-        add_row = jnp.concatenate((pop_muta.add_row, pop_mate.add_row), axis=0)
-        population = PopulationState(
-            X=jnp.concatenate((pop_muta.X, pop_mate.X)),
-            remove_row=remove_row,
-            add_row=add_row)
-        return population
+    def ask_pooled(self, pool: RandomPool, i, state: EvoState) -> PopulationState:
+        """
+        Returns the population of a generation, with the random numbers of the i-th generation of pool. Half of the
+        members mutate one value of a row of the best member, and the other half copy one value of a row of an elite
+        member onto it (with Gaussian noise on the numeric columns). The mutations and crossovers only gather their
+        random numbers, so no random number is generated here.
+        """
+        X0 = state.best_member
+        d = X0.shape[1]
+        numeric_mask = self.numeric_mask.reshape((1, d))
+
+        def muta(rows, cols, values):
+            removed_rows = X0[rows]
+            added_rows = removed_rows.at[jnp.arange(rows.shape[0]), cols].set(values)
+            return PopulationState(X=X0.at[rows].set(added_rows), remove_row=removed_rows, add_row=added_rows)
+
+        def mate(rows, elite_id, elite_rows, cols, noise):
+            removed_rows = X0[rows]
+            new_rows = self.genome.decode(state.archive[elite_id][elite_rows]) + numeric_mask * noise
+            new_rows = self.genome.encode(jnp.where(numeric_mask > 0, jnp.clip(new_rows, 0, 1), new_rows))
+            # Only crossover one column of the rows
+            cross_mask = jax.nn.one_hot(cols, d, dtype=jnp.float32)
+            added_rows = jnp.where(cross_mask > 0, new_rows, removed_rows)
+            return PopulationState(X=X0.at[rows].set(added_rows), remove_row=removed_rows, add_row=added_rows)
+
+        pop_muta = jax.vmap(muta)(pool.muta_rows[i], pool.muta_cols[i], pool.muta_values[i])
+        pop_mate = jax.vmap(mate)(pool.mate_rows[i], pool.mate_elite_ids[i], pool.mate_elite_rows[i],
+                                  pool.mate_cols[i], pool.mate_noise[i])
+        X = jnp.concatenate((pop_muta.X, pop_mate.X))
+        if self.row_mesh is not None:
+            X = jax.lax.with_sharding_constraint(X, NamedSharding(self.row_mesh, P(None, 'rows', None)))
+        return PopulationState(
+            X=X,
+            remove_row=jnp.concatenate((pop_muta.remove_row, pop_mate.remove_row), axis=0),
+            add_row=jnp.concatenate((pop_muta.add_row, pop_mate.add_row), axis=0))
 
     @partial(jax.jit, static_argnums=(0,))
     def tell(
@@ -180,82 +435,6 @@ class SimpleGAforSyncData:
         return new_state
 
 
-def get_mutate_fn(muta_rate: int, random_numbers):
-    def muta(
-            X0,
-            rng: chex.PRNGKey,  initialization
-    ) -> PopulationState:
-        X0 = X0.astype(jnp.float32)
-
-        n, d = X0.shape
-        rng, rng1, rng2, rng3, rng4, rng5, rng6, rng_temp, rng_normal = jax.random.split(rng, 9)
-
-        temp = jax.random.randint(rng1, minval=0, maxval=random_numbers.shape[0] - muta_rate, shape=(1,))
-        temp_id = jnp.arange(muta_rate) + temp
-        temp_id = jax.random.permutation(rng2, random_numbers[temp_id], independent=True)
-        mut_rows = temp_id
-
-        ###################
-        ## Mutate
-        mut_col = jax.random.randint(rng5, minval=0, maxval=d, shape=(muta_rate,))
-        values = initialization[mut_col]
-
-        removed_rows_muta = X0[mut_rows, :].reshape((muta_rate, d))
-        X_mut = X0.at[mut_rows, mut_col].set(values)
-        added_rows_muta = X_mut[mut_rows, :].reshape((muta_rate, d))
-
-        pop_state = PopulationState(X=X_mut, remove_row=removed_rows_muta, add_row=added_rows_muta)
-        return pop_state
-
-    return muta
-
-def get_mating_fn(domain: Domain, mate_rate: int, random_numbers):
-    d = len(domain.attrs)
-    numeric_idx = domain.get_attribute_indices(domain.get_numeric_cols()).astype(int)
-    mask = jnp.zeros(d)
-    mask = mask.at[numeric_idx].set(1)
-    mask = mask.reshape((1, d))
-
-    def mate(
-            X0, rng: chex.PRNGKey, elite_rows: chex.Array
-    ) -> PopulationState:
-        X0 = X0.astype(jnp.float32)
-        elite_rows = elite_rows.astype(jnp.float32)
-
-        n, d = X0.shape
-        rng, rng1, rng2, rng3, rng4, rng5, rng6, rng_temp, rng_normal = jax.random.split(rng, 9)
-
-        # Choose row indices to cross
-        temp = jax.random.randint(rng1, minval=0, maxval=random_numbers.shape[0] - mate_rate, shape=(1,))
-        temp_id = jnp.arange(mate_rate) + temp
-        temp_id = jax.random.permutation(rng2, random_numbers[temp_id], independent=True)
-        remove_rows_idx = temp_id[:mate_rate]
-
-        removed_rows_mate = X0[remove_rows_idx, :].reshape((mate_rate, d))
-        add_rows_idx = jax.random.randint(rng3, minval=0, maxval=elite_rows.shape[0], shape=(mate_rate,))
-
-        # Copy this row onto the dataset
-        new_rows = elite_rows[add_rows_idx]
-        noise = mask * jax.random.normal(rng_normal, shape=(new_rows.shape[0], d))
-        new_rows = new_rows + noise
-        new_rows = new_rows.at[:, numeric_idx].set(jnp.clip(new_rows[:, numeric_idx], 0, 1))
-
-        # Only crossover a subset of the values in the rows
-        rng_mate1, rng_mate2 = jax.random.split(rng_temp, 2)
-        temp = jnp.repeat(jnp.array([1, 0]), jnp.array([1, d - 1]), total_repeat_length=d)
-        temp = jnp.repeat(temp.reshape(1, -1), new_rows.shape[0])
-        temp = jax.random.permutation(rng_mate2, temp).reshape((mate_rate, -1))
-
-        added_rows_mate = temp * new_rows + (1 - temp) * removed_rows_mate
-
-        # Copy new rows
-        X = X0.at[remove_rows_idx].set(added_rows_mate)
-
-        pop_state = PopulationState(X=X, remove_row=removed_rows_mate, add_row=added_rows_mate)
-        return pop_state
-
-    return mate
-
 ######################################################################
 ######################################################################
 ######################################################################
@@ -278,8 +457,65 @@ class GSD(Generator):
                  stop_early=True,
                  stop_early_gen=None,
                  stop_eary_threshold=0,
-                 sparse_statistics=False
+                 sparse_statistics=False,
+                 random_pool_size=64,
+                 count_statistics=False,
+                 resync_interval=None,
+                 telemetry=None,
+                 trace_generations=None,
+                 sanitizer=None,
+                 warm_start=False,
+                 compilation_cache_dir=None,
+                 shard_population=False,
+                 shard_rows=False,
+                 pipeline_chunks=False,
+                 fitness_memory_budget=None,
+                 compact_genome=False
                  ):
+        """
+        :param random_pool_size: the generations run on the device in chunks of this size, with the random numbers
+         of a chunk drawn at once. The host checks the time budget between chunks.
+        :param count_statistics: If True and all the statistics are counts (see AdaptiveStatisticState), the
+         statistics of the best synthetic dataset are kept as exact int32 counts instead of float32. The fitness is
+         then free of float32 rounding drift, so the generations can differ from the default float32 statistics.
+        :param resync_interval: If given, the statistics of the best synthetic dataset are recomputed from scratch
+         every resync_interval generations (rounded up to a chunk). The largest difference to the incrementally
+         updated statistics is stored in resync_errors.
+        :param telemetry: a TelemetrySink or a list of them. Once per chunk of generations, fit writes one record per
+         generation with the best fitness, the best fitness of the population and how many members were accepted,
+         and one record with the timings of the chunk.
+        :param trace_generations: a TraceWindow of generations. The profiler trace of the chunks of generations that
+         overlap the window is written to its directory.
+        :param sanitizer: a Sanitizer that counts the jit cache misses and device-to-host transfers of each region of
+         fit, and reports them when fit (or the adaptive loop calling it) returns.
+        :param warm_start: If True, consecutive calls of fit on the same ChainedStatistics keep the evolution state
+         and the statistics of the best synthetic dataset. Only the newly selected workloads are evaluated. The warm
+         start state takes precedence over the sync_dataset argument of fit, which is ignored with a warning unless
+         it is the dataset returned by the previous fit (as in fit_zcdp_adaptive with start_sync=True).
+        :param compilation_cache_dir: If given, compiled kernels are stored in this directory and reused by
+         later processes that run the same configuration and the same source code (see KernelCache). The kernels
+         are unpickled, so the directory must only be writable by trusted users.
+        :param shard_population: If True, the fitness of the population is evaluated in parallel on the available
+         devices, e.g. the CPU devices given by XLA_FLAGS=--xla_force_host_platform_device_count. The population is
+         split over the largest number of devices that divides its size.
+        :param shard_rows: If True, the rows of the synthetic datasets (the elite archive, the best member and the
+         population) are split over the available devices, for data sizes that do not fit on one device. The
+         mutations are routed to the device that owns the row and only the statistics, which are sums over the rows,
+         are reduced across devices. The data size is split over the largest number of devices that divides it.
+        :param pipeline_chunks: If True, the chunks of generations run on a worker thread, and each chunk starts
+         from the outputs of the previous one while the host reads its telemetry, writes it and prints the
+         progress. The generations are the same as without pipelining. A chunk started after a stopping rule
+         applied runs no generation and is discarded.
+        :param fitness_memory_budget: If given, the fitness of the population is evaluated in chunks of members, and
+         of queries if needed, whose temporaries take at most this many bytes, instead of population_size times the
+         number of statistics at once. The chunk sizes are chosen when the kernels are compiled.
+        :param compact_genome: If True, the synthetic datasets are stored in uint8 or uint16 instead of float32, with
+         the numeric columns in 16 bits fixed point, see Genome.
+        """
+        if shard_population and shard_rows:
+            raise ValueError('shard_population and shard_rows cannot be combined.')
+        if random_pool_size is None or random_pool_size < 1:
+            raise ValueError(f'random_pool_size must be a positive integer, got {random_pool_size}.')
         self.domain = domain
         self.data_size = data_size
         self.num_generations = num_generations
@@ -292,168 +528,612 @@ class GSD(Generator):
                                             population_size_muta=population_size_muta,
                                             population_size_cross=population_size_cross,
                                             population_size=population_size,
-                                            muta_rate=muta_rate, mate_rate=mate_rate)
+                                            muta_rate=muta_rate, mate_rate=mate_rate,
+                                            random_pool_size=random_pool_size,
+                                            row_mesh=get_device_mesh(data_size, 'rows') if shard_rows else None,
+                                            genome=Genome(domain, compact=compact_genome))
         self.stop_generation = None
+        self.count_statistics = count_statistics
+        self.resync_interval = resync_interval
+        self.resync_errors = []
+        self.telemetry = Telemetry(telemetry)
+        self.trace_generations = trace_generations
+        self.sanitizer = sanitizer
+        self.warm_start = warm_start
+        self.statistics_min_sizes = None
+        self.warm_start_state = None
+        self.compilation_cache_dir = compilation_cache_dir
+        self.pipeline_chunks = pipeline_chunks
+        self.fitness_memory_budget = fitness_memory_budget
+        self.population_mesh = get_device_mesh(self.strategy.population_size, 'population') \
+            if shard_population else None
+        self.kernel_cache = KernelCache()
+        if compilation_cache_dir is not None:
+            enable_persistent_compilation_cache(os.path.join(compilation_cache_dir, 'xla'))
+            self.kernel_cache = KernelCache(os.path.join(compilation_cache_dir, 'kernels'))
 
     def __str__(self):
         return f'GSD'
 
-    def fit(self, key, adaptive_statistic: ChainedStatistics,
-            sync_dataset: Dataset = None, tolerance: float = 0.0, adaptive_epoch=1):
+    def use_count_statistics(self, adaptive_statistic: ChainedStatistics) -> bool:
+        return self.count_statistics and adaptive_statistic.is_count_statistic()
+
+    def get_elite_stat(self, statistics: chex.Array, count_mode: bool) -> chex.Array:
+        """Converts the statistics of a synthetic dataset to the unnormalized statistics kept by fit."""
+        elite_stat = self.data_size * statistics
+        return jnp.round(elite_stat).astype(jnp.int32) if count_mode else elite_stat
+
+    def get_new_workload_keys(self, adaptive_statistic: ChainedStatistics):
         """
-        Minimize error between real_stats and sync_stats
+        Returns the workloads selected since the last call of fit, or None if the warm start state cannot be used.
         """
+        if not self.warm_start or self.warm_start_state is None:
+            return None
+        warm = self.warm_start_state
+        if warm.statistics is not adaptive_statistic or warm.selection_version != adaptive_statistic.selection_version:
+            return None
+        workload_keys = adaptive_statistic.get_selected_workload_keys()
+        old_workload_keys = set(warm.workload_keys)
+        if not old_workload_keys.issubset(workload_keys):
+            return None
+        return [key for key in workload_keys if key not in old_workload_keys]
+
+    def extend_warm_start_state(self, adaptive_statistic: ChainedStatistics, new_workload_keys: list):
+        """
+        Extends the fitness of the elite archive and the statistics of the best member with the new workloads.
+        The fitness is a sum of squared errors over the statistics, so the new workloads are simply added to it.
+        """
+        warm = self.warm_start_state
+        state = warm.state
+        if len(new_workload_keys) == 0:
+            return state, warm.elite_stat
+
+        new_noised_statistics, _, new_statistics_fn = adaptive_statistic.get_selected_workloads_statistics(
+            new_workload_keys)
+        decode = self.strategy.genome.decode
+        archive_new_stats = jax.vmap(lambda X: new_statistics_fn(decode(X)), in_axes=(0,))(state.archive)
+        archive_fitness = state.fitness + jnp.linalg.norm(new_noised_statistics - archive_new_stats, axis=1,
+                                                          ord=2) ** 2
+        best_new_stat = self.get_elite_stat(new_statistics_fn(decode(state.best_member)),
+                                            self.use_count_statistics(adaptive_statistic))
+        best_fitness = state.best_fitness + jnp.linalg.norm(new_noised_statistics - best_new_stat / self.data_size,
+                                                            ord=2) ** 2
+        state = state.replace(fitness=archive_fitness, best_fitness=best_fitness)
+
+        workload_keys = adaptive_statistic.get_selected_workload_keys()
+        workload_sizes = {key: adaptive_statistic.get_selected_workload_size(key) for key in workload_keys}
+        order = get_extended_statistics_order(workload_keys, warm.workload_keys, workload_sizes)
+        elite_stat = jnp.concatenate([warm.elite_stat, best_new_stat])[order]
+        return state, elite_stat
+
+    def write_telemetry(self, telemetry: GenerationTelemetry, adaptive_epoch: int, chunk_start: int, chunk_end: int,
+                        elapsed_time: float, **chunk_times):
+        num_steps = chunk_end - chunk_start
+        records = [dict(event='generation', round=adaptive_epoch, generation=chunk_start + i,
+                        best_fitness=telemetry.best_fitness[i],
+                        population_best_fitness=telemetry.population_best_fitness[i],
+                        replaced_best=telemetry.replaced_best[i], elite_accepted=telemetry.elite_accepted[i],
+                        time=elapsed_time)
+                   for i in range(num_steps)]
+        records.append(dict(event='chunk', round=adaptive_epoch, generation=chunk_end - 1, generations=num_steps,
+                            replaced_best=int(telemetry.replaced_best[:num_steps].sum()),
+                            elite_accepted=int(telemetry.elite_accepted[:num_steps].sum()),
+                            time=elapsed_time, **chunk_times))
+        self.telemetry.write(records)
+
+    def compile_kernel(self, name: str, fn, statistics_key, *args):
+        """
+        Returns fn compiled ahead of time for the shapes of args. The executable is keyed by the domain, the data
+        size, the population size and the statistics modules it evaluates, and it is reused by later calls of fit
+        whose query tables fall in the same size buckets.
+        """
+        return self.kernel_cache.compile(name, fn, self.get_kernel_key(statistics_key), *args)
 
-        self.stop_generation = None
-        init_time = timer()
-
-        if self.sparse_statistics:
-            selected_statistics, selected_noised_statistics, statistics_fn = adaptive_statistic.get_selected_trimmed_statistics_fn()
-            if self.print_progress:
-                print(f'Number of sparse statistics is {selected_statistics.shape[0]}. Time = {timer() - init_time:.2f}')
-        else:
-            selected_noised_statistics = adaptive_statistic.get_selected_noised_statistics()
-            selected_statistics = adaptive_statistic.get_selected_statistics_without_noise()
-            statistics_fn = adaptive_statistic.get_selected_statistics_fn()
+    def get_kernel_key(self, statistics_key):
+        meshes = [dict(mesh.shape) for mesh in [self.population_mesh, self.strategy.row_mesh] if mesh is not None]
+        return (str(self.domain), self.data_size, self.strategy.population_size_muta,
+                self.strategy.population_size_cross, self.strategy.elite_size, meshes, self.fitness_memory_budget,
+                statistics_key)
 
-        # For debugging
-        @jax.jit
-        def true_loss(X_arg):
-            error = jnp.abs(selected_statistics - statistics_fn(X_arg))
-            return jnp.abs(error).max(), jnp.abs(error).mean(), jnp.linalg.norm(error, ord=2)
+    def get_fit_kernels(self, statistics_kernel, count_mode: bool = False) -> dict:
+        """
+        Returns the kernels of fit for the given statistics kernel. The noised statistics and the query tables are
+        arguments of the kernels. If count_mode is True, the statistics of the best synthetic dataset are int32 counts.
+        """
+        def genome_statistics_kernel(X, query_tables):
+            # The synthetic datasets are stored in the genome of the strategy.
+            return statistics_kernel(self.strategy.genome.decode(X), query_tables)
 
-        @jax.jit
-        def private_loss(X_arg):
-            error = jnp.abs(selected_noised_statistics - statistics_fn(X_arg))
-            return jnp.abs(error).max(), jnp.abs(error).mean(), jnp.linalg.norm(error, ord=2)
+        def get_row_stats(rows, query_tables):
+            row_stats = rows.shape[0] * genome_statistics_kernel(rows, query_tables)
+            return jnp.round(row_stats).astype(jnp.int32) if count_mode else row_stats
 
-        def fitness_fn(stats: chex.Array, pop_state: PopulationState):
+        def fitness_fn(stats: chex.Array, remove_row: chex.Array, add_row: chex.Array, noised_statistics: chex.Array,
+                       query_tables):
             # Process one member of the population
             # 1) Update the statistics of this synthetic dataset
-            rem_row = pop_state.remove_row
-            add_row = pop_state.add_row
-            num_rows = rem_row.shape[0]
-            add_stats = (num_rows * statistics_fn(add_row))
-            rem_stats = (num_rows * statistics_fn(rem_row))
+            add_stats = get_row_stats(add_row, query_tables)
+            rem_stats = get_row_stats(remove_row, query_tables)
             upt_sync_stat = stats.reshape(-1) + add_stats - rem_stats
             # 2) Compute its fitness based on the statistics
-            fitness = jnp.linalg.norm(selected_noised_statistics - upt_sync_stat / self.data_size, ord=2) ** 2
+            fitness = jnp.linalg.norm(noised_statistics - upt_sync_stat.astype(jnp.float32) / self.data_size,
+                                      ord=2) ** 2
             return fitness
 
-        fitness_fn_vmap = jax.vmap(fitness_fn, in_axes=(None, 0))
-        fitness_fn_jit = jax.jit(fitness_fn_vmap)
-
-
-        # INITIALIZE STATE
-        key, subkey = jax.random.split(key, 2)
-
-        state = self.strategy.initialize(subkey)
-
-        if sync_dataset is not None:
-            init_sync = sync_dataset.to_numpy()
-            temp = init_sync.reshape((1, init_sync.shape[0], init_sync.shape[1]))
-            new_archive = jnp.concatenate([temp, state.archive[1:, :, :]])
-            state = state.replace(archive=new_archive)
-
-        elite_population_fn = jax.vmap(statistics_fn, in_axes=(0,))
-        elite_fitness = jnp.linalg.norm(selected_noised_statistics - elite_population_fn(state.archive), axis=1,
-                                        ord=2) ** 2
-        best_member_id = elite_fitness.argmin()
-        state = state.replace(
-            fitness=elite_fitness,
-            best_member=state.archive[best_member_id],
-            best_fitness=elite_fitness[best_member_id]
-        )
-
-        self.early_stop_init()  # Initiate time-based early stop system
-
-        best_fitness_total = 100000
-        ask_time = 0
-        elite_stat_time = 0
-        fit_time = 0
-        tell_time = 0
-        last_fitness = None
-        self.fitness_record = []
-
-        if self.print_progress:
-            timer(init_time, '\tSetup time = ')
-
-        elite_stat = self.data_size * statistics_fn(state.best_member)  # Statistics of best SD
+        fitness_fn_vmap = jax.vmap(fitness_fn, in_axes=(None, 0, 0, None, None))
+        if self.fitness_memory_budget is not None:
+            fitness_fn_vmap = self.get_chunked_fitness_fn(get_row_stats)
+        if self.population_mesh is not None:
+            # Each device evaluates its share of the population. Only the changed rows are split, the statistics
+            # and the query tables are replicated, and the fitness values are gathered.
+            fitness_fn_vmap = shard_map(fitness_fn_vmap, mesh=self.population_mesh,
+                                        in_specs=(P(), P('population'), P('population'), P(), P()),
+                                        out_specs=P('population'), check_rep=False)
 
         def update_elite_stat(elite_stat_arg,
                               population_state: PopulationState,
                               replace_best,
-                              best_id_arg
+                              best_id_arg,
+                              query_tables
                               ):
-            num_rows = population_state.remove_row[0].shape[0]
-
             new_elite_stat = jax.lax.select(
                     replace_best,
                     elite_stat_arg
-                        - (num_rows * statistics_fn(population_state.remove_row[best_id_arg]))
-                        + (num_rows * statistics_fn(population_state.add_row[best_id_arg])),
+                        - get_row_stats(population_state.remove_row[best_id_arg], query_tables)
+                        + get_row_stats(population_state.add_row[best_id_arg], query_tables),
                     elite_stat_arg
                 )
             return new_elite_stat
 
-        update_elite_stat_jit = jax.jit(update_elite_stat)
-        LAST_LAG_FITNESS = state.best_fitness
+        def generations(state: EvoState, elite_stat: chex.Array, stop_state: StopState, random_pool: RandomPool,
+                        noised_statistics: chex.Array, query_tables, stop_config: StopConfig):
+            """
+            Runs one generation per entry of random_pool, or until a stopping rule applies. Returns the new state
+            and the GenerationTelemetry of the chunk.
+            """
+            num_steps = random_pool.muta_rows.shape[0]
+
+            def cond_fn(carry):
+                i, _, _, stop_state_arg, _ = carry
+                return (i < num_steps) & ~stop_state_arg.stopped
+
+            def body_fn(carry):
+                i, state_arg, elite_stat_arg, stop_state_arg, telemetry = carry
+                with jax.named_scope('ask'):
+                    population_state = self.strategy.ask_pooled(random_pool, i, state_arg)
+                with jax.named_scope('fitness'):
+                    fitness = fitness_fn_vmap(elite_stat_arg, population_state.remove_row, population_state.add_row,
+                                              noised_statistics, query_tables)
+                with jax.named_scope('tell'):
+                    elite_accepted = jnp.minimum((fitness < state_arg.fitness.max()).sum(), self.strategy.elite_size)
+                    state_arg, replace_best, best_id = self.strategy.tell(population_state.X, fitness, state_arg)
+                with jax.named_scope('update_elite_stat'):
+                    elite_stat_arg = update_elite_stat(elite_stat_arg, population_state, replace_best, best_id,
+                                                       query_tables)
+                stop_state_arg = update_stop_state(stop_state_arg, state_arg.best_fitness, stop_config)
+                telemetry = telemetry.replace(
+                    best_fitness=telemetry.best_fitness.at[i].set(state_arg.best_fitness),
+                    population_best_fitness=telemetry.population_best_fitness.at[i].set(fitness.min()),
+                    replaced_best=telemetry.replaced_best.at[i].set(replace_best),
+                    elite_accepted=telemetry.elite_accepted.at[i].set(elite_accepted))
+                return i + 1, state_arg, elite_stat_arg, stop_state_arg, telemetry
+
+            _, state, elite_stat, stop_state, telemetry = jax.lax.while_loop(
+                cond_fn, body_fn, (0, state, elite_stat, stop_state, GenerationTelemetry.create(num_steps)))
+            if self.strategy.row_mesh is not None:
+                state = jax.lax.with_sharding_constraint(state, self.strategy.get_state_sharding())
+            return state, elite_stat, stop_state, telemetry
+
+        def initialize_elite(state, noised_statistics, query_tables):
+            # The fitness of the elite archive, its best member and the statistics of the best member, in one kernel.
+            archive_stats = jax.vmap(genome_statistics_kernel, in_axes=(0, None))(state.archive, query_tables)
+            elite_fitness = jnp.linalg.norm(noised_statistics - archive_stats, axis=1, ord=2) ** 2
+            best_member_id = elite_fitness.argmin()
+            state = state.replace(fitness=elite_fitness, best_member=state.archive[best_member_id],
+                                  best_fitness=elite_fitness[best_member_id])
+            return state, self.get_elite_stat(archive_stats[best_member_id], count_mode)
+
+        return {
+            'statistics': genome_statistics_kernel,
+            'initialize_elite': initialize_elite,
+            'generations': generations,
+        }
+
+    def get_chunked_fitness_fn(self, get_row_stats):
+        """
+        Same as the vmapped fitness of get_fit_kernels, evaluated in chunks of members and of queries (see
+        get_fitness_chunk_sizes) so that its temporaries fit in fitness_memory_budget. The squared errors of the
+        chunks of queries are accumulated.
+        """
+        def member_fitness(stats, remove_row, add_row, noised_statistics, query_tables, chunk_sizes):
+            fitness = jnp.float32(0)
+            offset = 0
+            for module_id, ((table, num_queries), chunk_size) in enumerate(zip(query_tables, chunk_sizes)):
+                size = jax.tree_util.tree_leaves(table)[0].shape[0]
+                chunked_table = jax.tree_util.tree_map(
+                    lambda x: x.reshape((size // chunk_size, chunk_size) + x.shape[1:]), table)
+
+                def chunk_error(fitness_arg, xs, module_id=module_id, num_queries=num_queries, offset=offset,
+                                chunk_size=chunk_size):
+                    chunk_table, start = xs
+                    chunk_tables = tuple((chunk_table, jnp.clip(num_queries - start, 0, chunk_size))
+                                         if i == module_id else None for i in range(len(query_tables)))
+                    add_stats = get_row_stats(add_row, chunk_tables)
+                    rem_stats = get_row_stats(remove_row, chunk_tables)
+                    upt_sync_stat = jax.lax.dynamic_slice(stats, (offset + start,), (chunk_size,)) \
+                        + add_stats - rem_stats
+                    error = jax.lax.dynamic_slice(noised_statistics, (offset + start,), (chunk_size,)) \
+                        - upt_sync_stat.astype(jnp.float32) / self.data_size
+                    return fitness_arg + jnp.sum(error ** 2), None
+
+                fitness = jax.lax.scan(chunk_error, fitness, (chunked_table, jnp.arange(0, size, chunk_size)))[0]
+                offset += size
+            return fitness
+
+        def chunked_fitness_fn(stats, remove_row, add_row, noised_statistics, query_tables):
+            population_size = remove_row.shape[0]
+            table_sizes = [jax.tree_util.tree_leaves(table)[0].shape[0] for table, _ in query_tables]
+            population_chunk, chunk_sizes = get_fitness_chunk_sizes(population_size, table_sizes,
+                                                                    self.fitness_memory_budget)
+            fitness_vmap = jax.vmap(partial(member_fitness, chunk_sizes=chunk_sizes),
+                                    in_axes=(None, 0, 0, None, None))
+            rows = jax.tree_util.tree_map(
+                lambda x: x.reshape((population_size // population_chunk, population_chunk) + x.shape[1:]),
+                (remove_row, add_row))
+            fitness = jax.lax.map(lambda chunk_rows: fitness_vmap(stats, *chunk_rows, noised_statistics,
+                                                                  query_tables), rows)
+            return fitness.reshape(population_size)
+
+        return chunked_fitness_fn
+
+    def get_fit_kernel_args(self, query_tables, count_mode: bool = False) -> dict:
+        """Returns the shapes of the arguments of the kernels of get_fit_kernels."""
+        num_statistics = sum(jax.tree_util.tree_leaves(table)[0].shape[0] for table, _ in query_tables)
+        statistics_shape = jax.ShapeDtypeStruct((num_statistics,), jnp.float32)
+        elite_stat_shape = jax.ShapeDtypeStruct((num_statistics,), jnp.int32 if count_mode else jnp.float32)
+        state_shape = self.strategy.get_state_shape()
+        random_pool_shape = jax.eval_shape(self.strategy.draw_random_pool, jax.random.PRNGKey(0),
+                                           jax.ShapeDtypeStruct((self.data_size,), jnp.int32))
+        stop_state_shape = jax.eval_shape(StopState.create, state_shape.best_fitness)
+        stop_config_shape = jax.eval_shape(StopConfig.create, 1)
+        if self.strategy.row_mesh is not None:
+            # The synthetic datasets are split by rows and everything else is replicated, see replicate.
+            state_shape = jax.tree_util.tree_map(lambda x, sharding: jax.ShapeDtypeStruct(x.shape, x.dtype,
+                                                                                          sharding=sharding),
+                                                 state_shape, self.strategy.get_state_sharding())
+            replicated = NamedSharding(self.strategy.row_mesh, P())
+            elite_stat_shape, stop_state_shape, random_pool_shape, statistics_shape, query_tables, \
+                stop_config_shape = jax.tree_util.tree_map(
+                    lambda x: jax.ShapeDtypeStruct(jnp.shape(x), jnp.result_type(x), sharding=replicated),
+                    (elite_stat_shape, stop_state_shape, random_pool_shape, statistics_shape, query_tables,
+                     stop_config_shape))
+        return {
+            'statistics': (state_shape.best_member, query_tables),
+            'initialize_elite': (state_shape, statistics_shape, query_tables),
+            'generations': (state_shape, elite_stat_shape, stop_state_shape, random_pool_shape, statistics_shape,
+                            query_tables, stop_config_shape),
+        }
+
+    def replicate(self, tree):
+        """With shard_rows, places every array of tree on all the devices, as the kernels of fit expect."""
+        if self.strategy.row_mesh is None:
+            return tree
+        return jax.device_put(tree, NamedSharding(self.strategy.row_mesh, P()))
+
+    def compile_ahead(self, adaptive_statistic: ChainedStatistics, num_sample: int = 1):
+        """
+        Starts compiling, on a background thread, the kernels for the selected statistics plus any num_sample
+        workloads selected next. Returns the layout of the query tables they are compiled for; setting it as
+        statistics_min_sizes before the next call of fit makes that call use the compiled kernels.
+        """
+        if self.sparse_statistics:
+            # The number of trimmed statistics is only known after measuring them.
+            return None
+        min_sizes = adaptive_statistic.get_next_round_min_sizes(num_sample)
+        statistics_kernel, query_tables, _, statistics_key = adaptive_statistic.get_selected_statistics_kernel(
+            min_sizes=min_sizes)
+        count_mode = self.use_count_statistics(adaptive_statistic)
+        kernels = self.get_fit_kernels(statistics_kernel, count_mode)
+        kernel_args = self.get_fit_kernel_args(query_tables, count_mode)
+        for name in ['initialize_elite', 'generations']:
+            self.kernel_cache.compile_ahead(name, kernels[name], self.get_kernel_key((statistics_key, count_mode)),
+                                            *kernel_args[name])
+        return min_sizes
+
+    @sanitized('GSD.fit')
+    def fit(self, key, adaptive_statistic: ChainedStatistics,
+            sync_dataset: Dataset = None, tolerance: float = 0.0, adaptive_epoch=1, time_budget: float = None):
+        """
+        Minimize error between real_stats and sync_stats
+
+        :param time_budget: If given, stop after the first chunk of generations that ends past time_budget seconds.
+        """
+
+        self.stop_generation = None
+        init_time = timer()
+        setup_times = {}
+
+        with profile_scope('GSD.fit/statistics'):
+            if self.sparse_statistics:
+                selected_statistics, selected_noised_statistics, statistics_kernel, query_tables, valid_positions, \
+                    statistics_key = adaptive_statistic.get_selected_trimmed_statistics_kernel()
+                if self.print_progress:
+                    print(f'Number of sparse statistics is {selected_statistics.shape[0]}. '
+                          f'Time = {timer() - init_time:.2f}')
+            else:
+                selected_noised_statistics = adaptive_statistic.get_selected_noised_statistics()
+                selected_statistics = adaptive_statistic.get_selected_statistics_without_noise()
+                statistics_kernel, query_tables, valid_positions, statistics_key = \
+                    adaptive_statistic.get_selected_statistics_kernel(min_sizes=self.statistics_min_sizes)
+            # The statistics kernel outputs the statistics in a padded layout where the padded queries are zero, so
+            # the padded noised statistics give the same fitness.
+            noised_statistics = pad_statistics(selected_noised_statistics, query_tables, valid_positions)
+            query_tables, noised_statistics = self.replicate((query_tables, noised_statistics))
+
+        # For debugging
+        @jax.jit
+        def true_loss(X_arg, query_tables_arg):
+            error = jnp.abs(selected_statistics - kernels['statistics'](X_arg, query_tables_arg)[valid_positions])
+            return jnp.abs(error).max(), jnp.abs(error).mean(), jnp.linalg.norm(error, ord=2)
+
+        setup_times['statistics_time'] = timer() - init_time
+        count_mode = self.use_count_statistics(adaptive_statistic)
+        statistics_key = (statistics_key, count_mode)
+        kernels = self.get_fit_kernels(statistics_kernel, count_mode)
+        kernel_args = self.get_fit_kernel_args(query_tables, count_mode)
+
+        # INITIALIZE STATE
+        with profile_scope('GSD.fit/initialize'):
+            key, subkey = jax.random.split(key, 2)
+
+            new_workload_keys = None if self.sparse_statistics else self.get_new_workload_keys(adaptive_statistic)
+            if new_workload_keys is not None:
+                if sync_dataset is not None and sync_dataset is not self.warm_start_state.sync_dataset:
+                    warnings.warn('GSD.fit continues from the warm start state, so sync_dataset is ignored. Set '
+                                  'warm_start_state to None to start from sync_dataset.')
+                state, elite_stat = self.extend_warm_start_state(adaptive_statistic, new_workload_keys)
+                elite_stat = pad_statistics(elite_stat, query_tables, valid_positions)
+            else:
+                state = self.strategy.initialize(subkey)
+
+                if sync_dataset is not None:
+                    init_sync = sync_dataset.to_numpy()
+                    temp = self.strategy.genome.encode(init_sync.reshape((1, init_sync.shape[0], init_sync.shape[1])))
+                    new_archive = jnp.concatenate([temp, state.archive[1:, :, :]])
+                    state = state.replace(archive=new_archive)
+
+                initialize_elite_jit = self.compile_kernel('initialize_elite', kernels['initialize_elite'],
+                                                           statistics_key, *kernel_args['initialize_elite'])
+                state, elite_stat = initialize_elite_jit(self.strategy.shard_state(state), noised_statistics,
+                                                         query_tables)
+            state, elite_stat = self.strategy.shard_state(state), self.replicate(elite_stat)
+
+        setup_times['init_time'] = timer() - init_time - setup_times['statistics_time']
+        t0 = timer()
+        with profile_scope('GSD.fit/compile'):
+            generations_jit = self.compile_kernel('generations', kernels['generations'], statistics_key,
+                                                  *kernel_args['generations'])
+        setup_times['compile_time'] = timer() - t0
+        if self.telemetry.enabled:
+            self.telemetry.write([dict(event='setup', round=adaptive_epoch, num_statistics=len(valid_positions),
+                                       count_mode=count_mode, **setup_times)])
+
+        best_fitness_total = 100000
+        last_fitness = None
+        self.fitness_record = []
+
+        if self.print_progress:
+            timer(init_time, '\tSetup time = ')
+
+        # The stopping rules are checked on the device after every generation, and the host only waits for the
+        # device once per chunk of random_pool_size generations.
+        stop_config = StopConfig.create(max_generations=self.num_generations,
+                                        target_fitness=self.stop_eary_threshold,
+                                        plateau_window=self.stop_early_min_generation if self.stop_early else 0)
+        stop_state = StopState.create(state.best_fitness)
+        stop_config, stop_state = self.replicate((stop_config, stop_state))
         true_results = []
-        for t in range(self.num_generations):
-            self.stop_generation = t  # Update the stop generation
-            # ASK
-            t0 = timer()
-            key, ask_subkey = jax.random.split(key, 2)
-            population_state = self.strategy.ask(ask_subkey, state)
-            population_state.remove_row.block_until_ready()
-            ask_time += timer() - t0
-
-            # FIT
-            t0 = timer()
-            fitness = fitness_fn_jit(elite_stat, population_state).block_until_ready()
-            fit_time += timer() - t0
-
-            # TELL
-            t0 = timer()
-            state, rep_best, best_id = self.strategy.tell(population_state.X, fitness, state)
-            state.archive.block_until_ready()
-            best_fitness = state.best_fitness
-
-            self.fitness_record.append([t, best_fitness, timer() - init_time])
-
-            tell_time += timer() - t0
-            # UPDATE elite_states
-            elite_stat = update_elite_stat_jit(elite_stat, population_state, rep_best, best_id).block_until_ready()
-            elite_stat_time += timer() - t0
-
-            if best_fitness < self.stop_eary_threshold: break
-            if (t % self.stop_early_min_generation) == 0 and t > self.stop_early_min_generation and self.stop_early:
-                loss_change = jnp.abs(LAST_LAG_FITNESS - state.best_fitness) / LAST_LAG_FITNESS
-
-                if loss_change < 0.0001:
-                    if self.print_progress: print(f'\t\t ### Stop early at {t} ###')
+        self.resync_errors = []
+        last_resync = 0
+        chunk_size = self.strategy.random_pool_size
+
+        def run_chunk(carry, pool_subkey):
+            """Runs a chunk of generations. With pipeline_chunks this runs on the worker thread."""
+            t0_chunk = timer()
+            with profile_scope('GSD.fit/draw'):
+                random_pool = self.replicate(self.strategy.draw_random_pool(pool_subkey,
+                                                                            self.strategy.random_numbers))
+            t1_chunk = timer()
+            with profile_scope('GSD.fit/generations'):
+                outputs = generations_jit(*carry, random_pool, noised_statistics, query_tables, stop_config)
+            return outputs, t1_chunk - t0_chunk, timer() - t1_chunk
+
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gsd-chunks') \
+            if self.pipeline_chunks else None
+
+        def submit_chunk(carry, chunk_start_arg):
+            nonlocal key
+            key, pool_subkey = jax.random.split(key, 2)
+            if self.trace_generations is not None:
+                self.trace_generations.step(chunk_start_arg, chunk_start_arg + chunk_size - 1)
+            if executor is not None:
+                return executor.submit(run_chunk, carry, pool_subkey)
+            future = Future()
+            future.set_result(run_chunk(carry, pool_subkey))
+            return future
+
+        t = 0
+        pending = submit_chunk((state, elite_stat, stop_state), t) if self.num_generations > 0 else None
+        try:
+            while pending is not None:
+                (state, elite_stat, stop_state, telemetry), draw_time, run_time = pending.result()
+                pending = None
+                chunk_start = t
+                # With pipeline_chunks, the next chunk starts from the outputs of this one before the host reads
+                # them. A chunk that starts after a stopping rule applied runs no generation, and the next chunk is
+                # not started if the statistics are resynced or the time budget is expected to run out first.
+                next_start = chunk_start + chunk_size
+                resync_due = self.resync_interval is not None and next_start - last_resync >= self.resync_interval
+                if executor is not None and next_start < self.num_generations and not resync_due and \
+                        (time_budget is None or timer() - init_time + run_time < time_budget):
+                    pending = submit_chunk((state, elite_stat, stop_state), next_start)
+                with profile_scope('GSD.fit/generations'):
+                    # The only synchronization with the device in a chunk.
+                    telemetry, t, stopped = device_get((telemetry, stop_state.generation, stop_state.stopped))
+                elapsed_time = timer() - init_time
+                t, stopped = int(t), bool(stopped)
+                self.stop_generation = t - 1  # Update the stop generation
+                for gen in range(chunk_start, t):
+                    self.fitness_record.append([gen, float(telemetry.best_fitness[gen - chunk_start]), elapsed_time])
+                if self.trace_generations is not None:
+                    self.trace_generations.step_end(t - 1)
+                if self.telemetry.enabled:
+                    self.write_telemetry(telemetry, adaptive_epoch, chunk_start, t, elapsed_time,
+                                         draw_time=draw_time, run_time=run_time)
+
+                if self.resync_interval is not None and (t - last_resync >= self.resync_interval or stopped):
+                    # Recompute the statistics of the best synthetic dataset from scratch.
+                    with profile_scope('GSD.fit/resync'):
+                        statistics_jit = self.compile_kernel('statistics', kernels['statistics'], statistics_key,
+                                                             *kernel_args['statistics'])
+                        resync_elite_stat = self.get_elite_stat(statistics_jit(state.best_member, query_tables),
+                                                                count_mode)
+                        self.resync_errors.append(float(device_get(jnp.abs(resync_elite_stat - elite_stat).max())))
+                    elite_stat = self.replicate(resync_elite_stat)
+                    last_resync = t
+
+                if self.print_progress:
+                    if stopped and t < self.num_generations: print(f'\t\t ### Stop early at {t - 1} ###')
+                    # DEBUG
+                    best_fitness = float(device_get(state.best_fitness))
+                    best_fitness_total = min(best_fitness_total, best_fitness)
+                    if last_fitness is None or best_fitness_total < last_fitness * 0.99 or stopped:
+                        X_sync = state.best_member
+                        print(f'\tGen {t - 1:05}, fit={best_fitness_total:.6f}, ', end=' ')
+                        t_inf, t_avg, p_l2 = device_get(true_loss(X_sync, query_tables))
+                        true_results.append([t - 1, float(t_inf), float(t_avg), float(p_l2)])
+                        print(f'\ttrue error(max/avg/l2)=({t_inf:.5f}/{t_avg:.7f}/{p_l2:.3f})', end='')
+                        print(f'\t|time={elapsed_time:.4f}(s)', end='')
+                        print()
+                        last_fitness = best_fitness_total
+
+                if stopped or t >= self.num_generations:
                     break
-                LAST_LAG_FITNESS = state.best_fitness
-
-            if (t % 50 == 0) and self.print_progress:
-                # DEBUG
-                best_fitness_total = min(best_fitness_total, best_fitness)
-                if last_fitness is None or best_fitness_total < last_fitness * 0.99 or t > self.num_generations - 2:
-                    elapsed_time = timer() - init_time
-                    X_sync = state.best_member
-                    print(f'\tGen {t:05}, fit={best_fitness_total:.6f}, ', end=' ')
-                    t_inf, t_avg, p_l2 = true_loss(X_sync)
-                    true_results.append([t, float(t_inf), float(t_avg), float(p_l2)])
-                    print(f'\ttrue error(max/avg/l2)=({t_inf:.5f}/{t_avg:.7f}/{p_l2:.3f})', end='')
-                    print(f'\t|time={elapsed_time:.4f}(s):', end='')
-                    print(f'\task={ask_time:<3.3f}(s), fit={fit_time:<3.3f}(s), tell={tell_time:<3.3f}, ', end='')
-                    print(f'elite_stat={elite_stat_time:<3.3f}(s)\t', end='')
-                    print()
-                    last_fitness = best_fitness_total
+                # A chunk that already started when the time budget runs out is used, as it would have been
+                # without pipelining.
+                if time_budget is not None and timer() - init_time >= time_budget and pending is None:
+                    if self.print_progress: print(f'\t\t ### Time budget reached at {t - 1} ###')
+                    break
+                if pending is None:
+                    pending = submit_chunk((state, elite_stat, stop_state), t)
+        finally:
+            if executor is not None:
+                # Waits for a chunk that was started but is not used.
+                executor.shutdown(wait=True)
+
+        if self.trace_generations is not None:
+            self.trace_generations.stop()
 
         # Save progress for debugging.
         self.true_results_df = pd.DataFrame(true_results, columns=['G', 'Max', 'Avg', 'L2'])
-        X_sync = state.best_member
+        X_sync = device_get(self.strategy.genome.decode(state.best_member))
         sync_dataset = Dataset.from_numpy_to_dataset(self.domain, X_sync)
+
+        if self.warm_start and not self.sparse_statistics:
+            self.warm_start_state = WarmStartState(state=state, elite_stat=elite_stat[valid_positions],
+                                                   workload_keys=adaptive_statistic.get_selected_workload_keys(),
+                                                   selection_version=adaptive_statistic.selection_version,
+                                                   statistics=adaptive_statistic, sync_dataset=sync_dataset)
         return sync_dataset
 
+
+
+######################################################################
+## TEST
+######################################################################
+
+def get_test_statistics(domain: Domain, seed: int = 0) -> ChainedStatistics:
+    from stats import Marginals
+    data = Dataset.synthetic(domain, 500, seed)
+    statistics = ChainedStatistics([Marginals.get_all_kway_combinations(domain, 1, bins=[2, 4]),
+                                    Marginals.get_all_kway_combinations(domain, 2, bins=[2, 4])])
+    statistics.fit(data)
+    return statistics
+
+
+def test_genome():
+    """The compact genome stores the rows in the smallest dtype and decodes them back."""
+    domain = Domain(['a', 'b', 'c'], [3, 1, 300])
+    X = jnp.array(Dataset.synthetic(domain, 100, 0).to_numpy())
+    genome = Genome(domain, compact=True)
+    assert genome.dtype == jnp.uint16
+    assert float(jnp.abs(genome.decode(genome.encode(X)) - X).max()) <= 0.5 / (2 ** 16 - 1)
+    assert Genome(Domain(['a', 'c'], [3, 256]), compact=True).dtype == jnp.uint8
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        genome = Genome(Domain(['a', 'c'], [3, 2 ** 16 + 1]), compact=True)
+    assert genome.dtype == jnp.float32
+    assert any('float32' in str(w.message) for w in caught)
+
+
+def test_warm_start():
+    """With warm_start, the statistics of the best synthetic dataset carried across rounds match a recomputation."""
+    domain = Domain(['a', 'b', 'c', 'd'], [3, 1, 4, 2])
+    statistics = get_test_statistics(domain)
+    gsd = GSD(num_generations=200, domain=domain, data_size=50, population_size=20, warm_start=True,
+              resync_interval=64)
+    gsd.fit_zcdp_adaptive(jax.random.PRNGKey(0), statistics, rounds=3, rho=1.0, num_sample=2)
+    warm = gsd.warm_start_state
+    assert warm is not None and len(gsd.resync_errors) > 0
+    assert max(gsd.resync_errors) < 1e-3
+    statistics_fn = statistics.get_selected_statistics_fn()
+    assert float(jnp.abs(warm.elite_stat - gsd.data_size * statistics_fn(warm.state.best_member)).max()) < 1e-3
+
+    # Another starting dataset is ignored with a warning, since the warm start state takes precedence.
+    statistics.private_select_measure_statistic(jax.random.PRNGKey(1), 0.5, warm.sync_dataset, 1)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        gsd.fit(jax.random.PRNGKey(2), statistics, Dataset.synthetic(domain, 50, 1))
+    assert any('sync_dataset is ignored' in str(w.message) for w in caught)
+
+
+def test_count_statistics():
+    """The exact count mode runs only if every statistic is a count, and it tracks the float32 statistics."""
+    from stats import Marginals
+
+    class NonCountMarginals(Marginals):
+        is_count_statistic = False
+
+    domain = Domain(['a', 'b', 'c', 'd'], [3, 1, 4, 2])
+    statistics = get_test_statistics(domain)
+    statistics.private_measure_all_statistics(jax.random.PRNGKey(0), 1.0)
+    fitness = {}
+    for count_statistics in [True, False]:
+        gsd = GSD(num_generations=300, domain=domain, data_size=50, population_size=20, stop_early=False,
+                  count_statistics=count_statistics, resync_interval=64)
+        gsd.fit(jax.random.PRNGKey(1), statistics)
+        assert gsd.use_count_statistics(statistics) == count_statistics
+        assert max(gsd.resync_errors) < (1e-6 if count_statistics else 1e-3)
+        fitness[count_statistics] = np.array([record[1] for record in gsd.fitness_record])
+    assert np.allclose(fitness[True], fitness[False], rtol=1e-3)
+
+    # With a statistic that is not a count, the count mode falls back to the float32 statistics.
+    mixed_statistics = ChainedStatistics([statistics.stat_modules[0],
+                                          NonCountMarginals(domain, [['a', 'c'], ['b', 'd']], 2, bins=[2, 4])])
+    mixed_statistics.fit(Dataset.synthetic(domain, 500, 0))
+    mixed_statistics.private_measure_all_statistics(jax.random.PRNGKey(0), 1.0)
+    records = []
+    for count_statistics in [True, False]:
+        gsd = GSD(num_generations=300, domain=domain, data_size=50, population_size=20, stop_early=False,
+                  count_statistics=count_statistics)
+        assert not gsd.use_count_statistics(mixed_statistics)
+        gsd.fit(jax.random.PRNGKey(1), mixed_statistics)
+        records.append(np.array([record[1] for record in gsd.fitness_record]))
+    assert np.array_equal(records[0], records[1])
+
+
+if __name__ == "__main__":
+    test_genome()
+    test_warm_start()
+    test_count_statistics()
@@ -0,0 +1,297 @@
+"""
+Dry-run planning of a GSD run. Given the domain, the statistic modules and a GSD, plan_gsd returns the number of
+queries of each module, the memory of each stage of GSD.fit and, if calibrated, the generations per second, without
+building the query tables of the modules.
+
+    plan = plan_gsd(gsd, [(Marginals.get_all_kway_combinations, dict(k=2, bins=[2, 4, 8, 16, 32])),
+                          (Halfspace.get_kway_random_halfspaces, dict(k=1, random_hs=500))])
+    print(plan)
+"""
+import itertools
+import jax
+import numpy as np
+import pandas as pd
+from utils import Dataset, Domain, CallbackSink
+from stats import Marginals, Halfspace, Prefix, ChainedStatistics
+from stats.adaptive_statistic import get_query_bucket_size
+from models.gsd import GSD, FITNESS_BYTES_PER_STATISTIC, get_fitness_chunk_sizes
+
+FLOAT_BYTES = 4
+# A jax.random.PRNGKey is two uint32.
+KEY_BYTES = 8
+
+
+class ModulePlan:
+    def __init__(self, name: str, workload_sizes: list, query_bytes: int, get_calibration_module=None):
+        """
+        :param name: name of the statistic module
+        :param workload_sizes: number of queries of each workload, in the order of the module
+        :param query_bytes: bytes of one row of the query table of the module
+        :param get_calibration_module: function from a number of queries to a small module of the same kind with at
+         least that many queries, used to time the generations
+        """
+        self.name = name
+        self.workload_sizes = workload_sizes
+        self.query_bytes = query_bytes
+        self.get_calibration_module = get_calibration_module
+
+    def get_num_workloads(self) -> int:
+        return len(self.workload_sizes)
+
+    def get_num_queries(self) -> int:
+        return int(sum(self.workload_sizes))
+
+
+def get_cycled_workloads(workloads: list, workload_sizes: list, num_queries: int) -> list:
+    """Repeats the workloads in order until their sizes add up to at least num_queries."""
+    selected = []
+    total = 0
+    for workload, size in itertools.cycle(zip(workloads, workload_sizes)):
+        if total >= num_queries:
+            break
+        selected.append(workload)
+        total += size
+    return selected
+
+
+def get_marginals_plan(domain: Domain, k: int, bins=(32,), max_size=None) -> ModulePlan:
+    """Plan of Marginals.get_all_kway_combinations."""
+    numeric_cols = set(domain.get_numeric_cols())
+    kway_combinations = []
+    workload_sizes = []
+    for marginal in itertools.combinations(domain.attrs, k):
+        if max_size is not None:
+            total_size = 1
+            for col in marginal:
+                sz = domain.size(col)
+                total_size = total_size * (sum(bins) if sz == 1 else sz)
+            if total_size > max_size:
+                continue
+        is_numeric = any(col in numeric_cols for col in marginal)
+        workload_size = 0
+        for bin in (bins if is_numeric else [-1]):
+            workload_size += int(np.prod([domain.size(col) if domain.size(col) > 1 else bin for col in marginal]))
+        kway_combinations.append(list(marginal))
+        workload_sizes.append(workload_size)
+
+    def get_calibration_module(num_queries: int):
+        return Marginals(domain, get_cycled_workloads(kway_combinations, workload_sizes, num_queries), k, bins=bins)
+    return ModulePlan('Marginals', workload_sizes, 3 * k * FLOAT_BYTES, get_calibration_module)
+
+
+def get_halfspace_plan(domain: Domain, k: int, rng=None, random_hs: int = 500) -> ModulePlan:
+    """Plan of Halfspace.get_kway_random_halfspaces. One workload per marginal and random halfspace."""
+    kway_combinations = [list(cols) for cols in itertools.combinations(domain.get_categorical_cols(), k)]
+    sizes = [domain.size(marginal) for marginal in kway_combinations]
+
+    def get_calibration_module(num_queries: int):
+        return Halfspace(domain, k_cat=k, cat_kway_combinations=get_cycled_workloads(kway_combinations, sizes,
+                                                                                     num_queries),
+                         rng=jax.random.PRNGKey(0), num_random_halfspaces=1)
+    return ModulePlan('Halfspaces', [size for size in sizes for _ in range(random_hs)],
+                      (3 * k + 1) * FLOAT_BYTES + KEY_BYTES, get_calibration_module)
+
+
+def get_prefix_plan(domain: Domain, k_cat: int, k_num: int, rng=None, random_prefixes: int = 500) -> ModulePlan:
+    """Plan of Prefix.get_kway_prefixes. One workload per marginal and random prefix."""
+    kway_combinations = [list(cols) for cols in itertools.combinations(domain.get_categorical_cols(), k_cat)]
+    sizes = [domain.size(marginal) for marginal in kway_combinations]
+
+    def get_calibration_module(num_queries: int):
+        return Prefix(domain, k_cat=k_cat, cat_kway_combinations=get_cycled_workloads(kway_combinations, sizes,
+                                                                                      num_queries),
+                      rng=jax.random.PRNGKey(0), k_prefix=k_num, num_random_prefixes=1)
+    return ModulePlan('Prefix', [size for size in sizes for _ in range(random_prefixes)],
+                      (3 * k_cat + 1) * FLOAT_BYTES + KEY_BYTES, get_calibration_module)
+
+
+# Maps the constructors of the statistic modules to the functions that plan them with the same arguments.
+MODULE_PLANNERS = {
+    Marginals.get_all_kway_combinations: get_marginals_plan,
+    Halfspace.get_kway_random_halfspaces: get_halfspace_plan,
+    Prefix.get_kway_prefixes: get_prefix_plan,
+}
+
+
+def get_module_plan(domain: Domain, spec) -> ModulePlan:
+    """
+    :param spec: a pair (constructor, keyword arguments) of one of the constructors in MODULE_PLANNERS, without the
+     domain. The rng argument is not needed.
+    """
+    constructor, kwargs = spec
+    if constructor not in MODULE_PLANNERS:
+        raise ValueError(f'Cannot plan the statistic module of {constructor}. '
+                         f'Supported constructors are {[fn.__qualname__ for fn in MODULE_PLANNERS]}.')
+    return MODULE_PLANNERS[constructor](domain, **kwargs)
+
+
+def get_selected_query_sizes(module_plans: list, num_selected_workloads: int = None) -> list:
+    """
+    Returns the number of selected queries of each module. If num_selected_workloads is given, the selection is
+    bounded by the num_selected_workloads largest workloads over all the modules.
+    """
+    if num_selected_workloads is None:
+        return [module_plan.get_num_queries() for module_plan in module_plans]
+    workloads = [(size, module_id) for module_id, module_plan in enumerate(module_plans)
+                 for size in module_plan.workload_sizes]
+    workloads.sort(reverse=True)
+    selected_sizes = [0] * len(module_plans)
+    for size, module_id in workloads[:num_selected_workloads]:
+        selected_sizes[module_id] += size
+    return selected_sizes
+
+
+def get_memory_plan(gsd: GSD, module_plans: list, selected_sizes: list) -> dict:
+    """
+    Returns the bytes of the arrays that GSD.fit keeps on each device, by stage. The statistics of the generations
+    are evaluated on the padded query tables, see ChainedStatistics.get_statistics_kernel.
+    """
+    strategy = gsd.strategy
+    d = len(gsd.domain.attrs)
+    N = gsd.data_size
+    P = strategy.population_size
+    padded_sizes = [get_query_bucket_size(size) for size in selected_sizes]
+    M = sum(padded_sizes)
+    num_queries = sum(module_plan.get_num_queries() for module_plan in module_plans)
+    genome_bytes = np.dtype(strategy.genome.dtype).itemsize
+    row_shards = 1 if strategy.row_mesh is None else strategy.row_mesh.size
+    population_shards = 1 if gsd.population_mesh is None else gsd.population_mesh.size
+    local_population = P // population_shards
+    if gsd.fitness_memory_budget is None:
+        fitness_statistics = local_population * M
+    else:
+        population_chunk, chunk_sizes = get_fitness_chunk_sizes(local_population, padded_sizes,
+                                                                 gsd.fitness_memory_budget)
+        fitness_statistics = population_chunk * max(chunk_sizes)
+    pool_numbers = (3 * strategy.population_size_muta * strategy.muta_rate
+                    + strategy.population_size_cross * (1 + strategy.mate_rate * (3 + d)))
+    return {
+        # The query tables of all the workloads, built by the constructors of the modules.
+        'module_queries': sum(module_plan.get_num_queries() * module_plan.query_bytes
+                              for module_plan in module_plans),
+        # The true and noised statistics of all the workloads.
+        'measured_statistics': 2 * num_queries * FLOAT_BYTES,
+        'query_tables': sum(size * module_plan.query_bytes for size, module_plan in zip(padded_sizes, module_plans)),
+        # The noised statistics, the statistics of the best member and the statistics of the elite archive.
+        'fit_statistics': (2 + strategy.elite_size) * M * FLOAT_BYTES,
+        'archive': (strategy.elite_size + 1) * N * d * genome_bytes // row_shards,
+        'population': P * (N // row_shards + strategy.muta_rate + strategy.mate_rate) * d * genome_bytes,
+        'random_pool': (strategy.random_pool_size * pool_numbers + N) * FLOAT_BYTES,
+        # The updated statistics of the members evaluated at once, see GSD.get_fit_kernels.
+        'fitness': fitness_statistics * FITNESS_BYTES_PER_STATISTIC,
+    }
+
+
+def time_generation(gsd: GSD, stat_module, seed: int = 0) -> tuple:
+    """
+    Runs two chunks of generations of a copy of gsd on the statistics of stat_module on synthetic data. Returns the
+    number of padded queries and the seconds per generation of the fastest chunk.
+    """
+    strategy = gsd.strategy
+    chunk_times = []
+    timed_gsd = GSD(num_generations=2 * strategy.random_pool_size, domain=gsd.domain, data_size=gsd.data_size,
+                    population_size_muta=strategy.population_size_muta,
+                    population_size_cross=strategy.population_size_cross,
+                    muta_rate=strategy.muta_rate, mate_rate=strategy.mate_rate,
+                    random_pool_size=strategy.random_pool_size, stop_early=False,
+                    count_statistics=gsd.count_statistics, shard_population=gsd.population_mesh is not None,
+                    shard_rows=strategy.row_mesh is not None, fitness_memory_budget=gsd.fitness_memory_budget,
+                    compact_genome=strategy.genome.is_compact(),
+                    telemetry=CallbackSink(lambda records: chunk_times.extend(
+                        r['run_time'] / r['generations'] for r in records if r['event'] == 'chunk')))
+    statistics = ChainedStatistics([stat_module])
+    statistics.fit(Dataset.synthetic(gsd.domain, 1000, seed))
+    statistics.non_private_measure_all_statistics(jax.random.PRNGKey(seed))
+    timed_gsd.fit(jax.random.PRNGKey(seed), statistics)
+    return get_query_bucket_size(stat_module.queries.shape[0]), min(chunk_times)
+
+
+def get_seconds_per_generation(gsd: GSD, module_plans: list, selected_sizes: list,
+                               calibration_queries: tuple) -> float:
+    """
+    Times each module at the two sizes of calibration_queries, and models the seconds per generation as a fixed
+    cost plus a cost per padded query of each module.
+    """
+    intercepts = []
+    seconds = 0
+    for module_plan, selected_size in zip(module_plans, selected_sizes):
+        if module_plan.get_num_queries() == 0:
+            continue
+        (m1, t1), (m2, t2) = [time_generation(gsd, module_plan.get_calibration_module(num_queries))
+                              for num_queries in calibration_queries]
+        slope = max(t2 - t1, 0) / max(m2 - m1, 1)
+        intercepts.append(max(t1 - slope * m1, 0))
+        seconds += slope * get_query_bucket_size(selected_size)
+    return seconds + (np.mean(intercepts) if len(intercepts) > 0 else 0)
+
+
+class GSDPlan:
+    def __init__(self, module_plans: list, selected_sizes: list, memory: dict, seconds_per_generation: float = None,
+                 num_generations: int = None):
+        self.module_plans = module_plans
+        self.selected_sizes = selected_sizes
+        self.memory = memory
+        self.seconds_per_generation = seconds_per_generation
+        self.num_generations = num_generations
+
+    def get_num_queries(self) -> int:
+        return sum(module_plan.get_num_queries() for module_plan in self.module_plans)
+
+    def get_num_selected_queries(self) -> int:
+        return sum(self.selected_sizes)
+
+    def get_total_memory(self) -> int:
+        return sum(self.memory.values())
+
+    def get_generations_per_second(self) -> float:
+        if self.seconds_per_generation is None:
+            return None
+        return 1 / self.seconds_per_generation
+
+    def get_fit_time(self) -> float:
+        """Predicted seconds of the generations of one call of GSD.fit that does not stop early."""
+        if self.seconds_per_generation is None:
+            return None
+        return self.num_generations * self.seconds_per_generation
+
+    def queries_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame([dict(module=module_plan.name, workloads=module_plan.get_num_workloads(),
+                                  queries=module_plan.get_num_queries(),
+                                  max_workload_size=max(module_plan.workload_sizes, default=0),
+                                  selected_queries=selected_size,
+                                  padded_queries=get_query_bucket_size(selected_size))
+                             for module_plan, selected_size in zip(self.module_plans, self.selected_sizes)])
+
+    def memory_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame([dict(stage=stage, bytes=size, MB=size / 2 ** 20) for stage, size in self.memory.items()])
+
+    def __str__(self):
+        lines = [self.queries_dataframe().to_string(index=False), '',
+                 self.memory_dataframe().to_string(index=False),
+                 f'Total memory = {self.get_total_memory() / 2 ** 20:.1f} MB']
+        if self.seconds_per_generation is not None:
+            lines.append(f'Generations per second = {self.get_generations_per_second():.1f}, '
+                         f'fit time = {self.get_fit_time():.1f}(s)')
+        return '\n'.join(lines)
+
+
+def plan_gsd(gsd: GSD, stat_specs: list, num_selected_workloads: int = None, calibrate: bool = False,
+             calibration_queries: tuple = (256, 2048)) -> GSDPlan:
+    """
+    Plans the run of gsd on the statistic modules of stat_specs without building their query tables.
+
+    :param gsd: the generator to plan. It is not modified.
+    :param stat_specs: list of pairs (constructor, keyword arguments), see get_module_plan
+    :param num_selected_workloads: number of workloads GSD.fit runs on, e.g. rounds * num_sample for
+     fit_dp_adaptive. The largest workloads are assumed. If None, all the workloads.
+    :param calibrate: If True, times short runs of a copy of gsd on synthetic data, with small modules of the same
+     kind as each spec, and extrapolates the seconds per generation linearly in the number of padded queries
+    :param calibration_queries: the number of queries of the two timed runs of each module
+    """
+    module_plans = [get_module_plan(gsd.domain, spec) for spec in stat_specs]
+    selected_sizes = get_selected_query_sizes(module_plans, num_selected_workloads)
+    memory = get_memory_plan(gsd, module_plans, selected_sizes)
+    seconds_per_generation = None
+    if calibrate:
+        seconds_per_generation = get_seconds_per_generation(gsd, module_plans, selected_sizes, calibration_queries)
+    return GSDPlan(module_plans, selected_sizes, memory, seconds_per_generation, gsd.num_generations)
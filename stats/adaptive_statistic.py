@@ -1,14 +1,65 @@
-
-
 from typing import Callable
 
 import chex
+import jax
+import jax.numpy as jnp
+import numpy as np
 
 from utils import Dataset, Domain
 
 
+def get_query_bucket_size(num_queries: int) -> int:
+    """
+    Rounds the number of queries up to a bucket size of the form k * 2^j, with 8 <= k < 16. Query tables are padded
+    to the bucket size, so that one compiled kernel serves every query set of the same bucket and at most 1/8 of
+    the kernel's work is spent on padding.
+    """
+    if num_queries <= 16:
+        return 16
+    step = 2 ** (int(np.ceil(np.log2(num_queries))) - 4)
+    return int(np.ceil(num_queries / step)) * step
+
+
+def pad_query_table(query_table, size: int):
+    """
+    Pads every array of the query table along the query axis to the given size by repeating its first query. The
+    padding is done on the host, since eager jax ops would be compiled again for every new size.
+    """
+    def pad(x):
+        num_queries = x.shape[0]
+        if num_queries == size:
+            return x
+        x = np.asarray(x)
+        return jnp.asarray(np.concatenate([x, np.repeat(x[:1], size - num_queries, axis=0)], axis=0))
+    return jax.tree_util.tree_map(pad, query_table)
+
+
+def get_row_sum_kernel(answer_fn: Callable) -> Callable:
+    """
+    Returns kernel(X, query_table, *args), the average over the rows of X of answer_fn(x_row, query, *args) for
+    every query of the query table. X can also be a tuple of arrays with the same rows, such as the index form of the
+    one-hot encoding, in which case x_row is the tuple of their rows.
+    """
+    def stat_kernel(X, query_table, *args):
+        in_axes = (None, 0) + (None,) * len(args)
+        temp_stat_fn = jax.vmap(answer_fn, in_axes=in_axes)
+
+        def scan_fun(carry, x):
+            return carry + temp_stat_fn(x, query_table, *args), None
+
+        x_first = jax.tree_util.tree_map(lambda x: x[0], X)
+        num_rows = jax.tree_util.tree_leaves(X)[0].shape[0]
+        out = jax.eval_shape(temp_stat_fn, x_first, query_table, *args)
+        stats = jax.lax.scan(scan_fun, jnp.zeros(out.shape, out.dtype), X)[0]
+        return stats / num_rows
+    return stat_kernel
+
+
 class AdaptiveStatisticState:
     domain: Domain
+    queries: chex.Array
+    # True if every query answers 0 or 1 on each row, so that the statistics of n rows are counts divided by n.
+    is_count_statistic = False
 
     def get_domain(self):
         return self.domain
@@ -16,8 +67,17 @@ class AdaptiveStatisticState:
     def get_num_workloads(self) -> int:
         pass
 
+    def _get_workload_query_ids(self, workload_ids: list = None) -> chex.Array:
+        if workload_ids is None:
+            return jnp.arange(self.queries.shape[0])
+        query_positions = []
+        for workload_id in workload_ids:
+            a, b = self._get_workload_positions(workload_id)
+            query_positions.append(jnp.arange(a, b))
+        return jnp.concatenate(query_positions)
+
     def _get_workload_fn(self, workload_ids: list = None) -> Callable:
-        pass
+        return self._get_stat_fn(self._get_workload_query_ids(workload_ids))
 
     def _get_dataset_statistics_fn(self, workload_ids: list = None, jitted: bool = False) -> Callable:
         pass
@@ -25,12 +85,46 @@ class AdaptiveStatisticState:
     def _get_diff_workload_fn(self, workload_ids: list = None) -> Callable:
         pass
 
-    def _get_stat_fn(self, query_ids: chex.Array):
+    def _get_query_table(self, query_ids: chex.Array):
+        """
+        Returns the table of the given queries, an array or a tuple of arrays whose first axis is the query axis.
+        """
+        return self.queries[query_ids]
+
+    def _get_stat_kernel(self) -> Callable:
+        """
+        Returns kernel(X, query_table, **kwargs) that computes the statistics of the queries in query_table. The
+        query table is an argument of the kernel, so it is not embedded as a constant in the compiled code.
+        """
         pass
 
+    def _get_jitted_stat_kernel(self) -> Callable:
+        if getattr(self, 'stat_kernel_jit', None) is None:
+            stat_kernel = self._get_stat_kernel()
+
+            def named_stat_kernel(X, query_table, **kwargs):
+                with jax.named_scope(str(self)):
+                    return stat_kernel(X, query_table, **kwargs)
+            self.stat_kernel_jit = jax.jit(named_stat_kernel)
+        return self.stat_kernel_jit
+
+    def _get_stat_fn(self, query_ids: chex.Array, stat_kernel: Callable = None):
+        """
+        :param stat_kernel: a jitted kernel with the signature of _get_stat_kernel. If None, the kernel of
+         _get_jitted_stat_kernel.
+        """
+        if stat_kernel is None:
+            stat_kernel = self._get_jitted_stat_kernel()
+        num_queries = len(query_ids)
+        query_table = pad_query_table(self._get_query_table(jnp.asarray(query_ids)),
+                                      get_query_bucket_size(num_queries))
+
+        def stat_fn(X, **kwargs):
+            return stat_kernel(X, query_table, **kwargs)[:num_queries]
+        return stat_fn
+
     def _get_workload_sensitivity(self, workload_id: int = None, N: int = None) -> float:
         pass
 
     def _get_workload_positions(self, workload_id: int = None) -> tuple:
         pass
-
@@ -4,11 +4,25 @@ import jax
 import numpy as np
 from typing import Callable
 from utils import Dataset, Domain, timer
+from utils.compilation import enable_persistent_compilation_cache
+from utils.profiling import profile_function
 from tqdm import tqdm
 from stats import AdaptiveStatisticState
+from stats.adaptive_statistic import get_query_bucket_size, pad_query_table
+
+NOT_CONFIG = object()
 
 cpu = jax.devices("cpu")[0]
 
+def pad_statistics(statistics: chex.Array, query_tables: tuple, valid_positions: np.ndarray) -> chex.Array:
+    """Scatters statistics into the padded layout of the output of a statistics kernel, on the host."""
+    size = sum(jax.tree_util.tree_leaves(query_table)[0].shape[0] for query_table, _ in query_tables)
+    statistics = np.asarray(statistics)
+    padded = np.zeros(size, dtype=statistics.dtype)
+    padded[valid_positions] = statistics
+    return jnp.asarray(padded)
+
+
 class ChainedStatistics:
     all_workloads: list
     selected_workloads: list
@@ -17,9 +31,20 @@ class ChainedStatistics:
     modules_workload_fn_jit: list
     modules_all_statistics: list
 
-    def __init__(self, stat_modules: list):
+    def __init__(self, stat_modules: list, compilation_cache_dir: str = None):
+        """
+        :param stat_modules: list of AdaptiveStatisticState
+        :param compilation_cache_dir: If given, the compiled statistics kernels are stored on disk and reused
+         by later processes.
+        """
         self.stat_modules = stat_modules
+        if compilation_cache_dir is not None:
+            enable_persistent_compilation_cache(compilation_cache_dir)
+        # Incremented every time the selected workloads are reset, so that cached statistics can be invalidated.
+        self.selection_version = 0
+        self.max_workload_sizes = {}
 
+    @profile_function('ChainedStatistics.fit')
     def fit(self, data: Dataset):
         # X = data.to_numpy()
         self.data = data
@@ -29,6 +54,7 @@ class ChainedStatistics:
         self.modules_workload_fn_jit = []
         self.modules_all_statistics = []
         self.selected_workloads = []
+        self.selection_version += 1
         for stat_id in range(len(self.stat_modules)):
             stat_mod: AdaptiveStatisticState
             stat_mod = self.stat_modules[stat_id]
@@ -57,6 +83,149 @@ class ChainedStatistics:
     def get_selected_workload_ids(self, stat_id: int):
         return jnp.array([tup[0] for tup in self.selected_workloads[stat_id]]).astype(int)
 
+    def get_selected_workload_keys(self) -> list:
+        """
+        Returns a key (stat_id, selection_position) for every selected workload, in the same order
+        as the selected statistics are concatenated. Selected workloads are only appended, so the keys of
+        previously selected workloads do not change until the selection is reset.
+        """
+        return [(stat_id, pos) for stat_id in range(len(self.stat_modules))
+                for pos in range(len(self.selected_workloads[stat_id]))]
+
+    def get_selected_workload_size(self, workload_key: tuple) -> int:
+        stat_id, pos = workload_key
+        workload_id = self.selected_workloads[stat_id][pos][0]
+        wrk_a, wrk_b = self.stat_modules[stat_id]._get_workload_positions(workload_id)
+        return wrk_b - wrk_a
+
+    def get_selected_workloads_statistics(self, workload_keys: list):
+        """
+        Returns the noised statistics, the true statistics and the statistics function of a subset of the
+        selected workloads. The statistics are concatenated in the order given by workload_keys.
+        """
+        noised_stats = []
+        true_stats = []
+        workload_fn_list = []
+        for stat_id, pos in workload_keys:
+            _, workload_fn, noised_workload_statistics, true_workload_statistics = self.selected_workloads[stat_id][pos]
+            noised_stats.append(noised_workload_statistics)
+            true_stats.append(true_workload_statistics)
+            workload_fn_list.append(workload_fn)
+
+        def chained_workload(X, **kwargs):
+            return jnp.concatenate([fn(X, **kwargs) for fn in workload_fn_list], axis=0)
+
+        return jnp.concatenate(noised_stats), jnp.concatenate(true_stats), chained_workload
+
+    def get_statistics_kernel_key(self, stat_ids: list) -> tuple:
+        """
+        Identifies the code of the statistics kernel of the given modules. The query tables and the random keys are
+        arguments of the kernel, so only the module types and their configuration are part of the key. The
+        configuration is every attribute of the module that is not an array (see get_config_value).
+        """
+        key = []
+        for stat_id in stat_ids:
+            stat_mod = self.stat_modules[stat_id]
+            config = []
+            for name, value in sorted(vars(stat_mod).items()):
+                value = get_config_value(value)
+                if value is not NOT_CONFIG:
+                    config.append((name, value))
+            key.append((stat_id, type(stat_mod).__name__, str(stat_mod), tuple(config)))
+        return tuple(key)
+
+    def get_statistics_kernel(self, module_query_ids: list, min_sizes: dict = None):
+        """
+        Returns a kernel that computes the statistics of the given queries, with the query tables as arguments.
+        The query table of each module is padded to a bucket size, so the same compiled kernel serves every query
+        set of the same bucket. The statistics of the padded queries are zero.
+
+        :param module_query_ids: list of (stat_id, query_ids)
+        :param min_sizes: optional dictionary with the minimum padded size of the query table of each module
+        :return: statistics_kernel(X, query_tables, **kwargs), query_tables, and the positions of the statistics
+         of the given queries in the output of the kernel
+        """
+        kernel_list = []
+        kernel_names = []
+        query_tables = []
+        valid_positions = []
+        offset = 0
+        for stat_id, query_ids in module_query_ids:
+            stat_mod: AdaptiveStatisticState
+            stat_mod = self.stat_modules[stat_id]
+            num_queries = len(query_ids)
+            size = get_query_bucket_size(num_queries)
+            if min_sizes is not None and stat_id in min_sizes:
+                size = max(size, min_sizes[stat_id])
+            if num_queries == 0:
+                # Placeholder table of a module without selected queries, all its statistics are padding.
+                query_ids = np.zeros(1)
+            query_table = pad_query_table(stat_mod._get_query_table(jnp.asarray(query_ids).astype(int)), size)
+            kernel_list.append(stat_mod._get_stat_kernel())
+            kernel_names.append(f'{stat_mod}_{stat_id}')
+            query_tables.append((query_table, jnp.int32(num_queries)))
+            valid_positions.append(np.arange(offset, offset + num_queries))
+            offset += size
+
+        def statistics_kernel(X, query_tables_arg, **kwargs):
+            # A module whose entry of query_tables_arg is None is skipped, e.g. to evaluate one chunk of one module.
+            stats = []
+            for stat_name, stat_kernel, module_query_table in zip(kernel_names, kernel_list, query_tables_arg):
+                if module_query_table is None:
+                    continue
+                query_table, num_queries_arg = module_query_table
+                with jax.named_scope(stat_name):
+                    module_stats = stat_kernel(X, query_table, **kwargs)
+                valid = jnp.arange(module_stats.shape[0]) < num_queries_arg
+                stats.append(jnp.where(valid, module_stats, 0))
+            return jnp.concatenate(stats, axis=0)
+
+        return statistics_kernel, tuple(query_tables), np.concatenate(valid_positions)
+
+    def __get_selected_query_ids(self, stat_modules_ids=None, min_sizes: dict = None):
+        if stat_modules_ids is None:
+            stat_modules_ids = list(range(len(self.stat_modules)))
+        module_query_ids = []
+        for stat_id in stat_modules_ids:
+            stat_mod = self.stat_modules[stat_id]
+            query_ids = [np.arange(*stat_mod._get_workload_positions(selected[0]))
+                         for selected in self.selected_workloads[stat_id]]
+            if len(query_ids) > 0:
+                module_query_ids.append((stat_id, np.concatenate(query_ids)))
+            elif min_sizes is not None and stat_id in min_sizes:
+                module_query_ids.append((stat_id, np.zeros(0, dtype=int)))
+        return module_query_ids
+
+    def get_max_workload_size(self, stat_id: int) -> int:
+        if stat_id not in self.max_workload_sizes:
+            stat_mod = self.stat_modules[stat_id]
+            self.max_workload_sizes[stat_id] = max(b - a for a, b in (stat_mod._get_workload_positions(workload_id)
+                                                   for workload_id in range(stat_mod.get_num_workloads())))
+        return self.max_workload_sizes[stat_id]
+
+    def get_next_round_min_sizes(self, num_sample: int = 1) -> dict:
+        """
+        Returns a layout of the query tables that holds the selected queries plus any num_sample workloads selected
+        in the next round, so that the kernels of the next round can be compiled before the selection. Every module
+        gets room for num_sample of its largest workloads, since any of them can be selected.
+        """
+        min_sizes = {}
+        for stat_id in range(len(self.stat_modules)):
+            num_queries = sum(self.get_selected_workload_size((stat_id, i))
+                              for i in range(len(self.selected_workloads[stat_id])))
+            min_sizes[stat_id] = get_query_bucket_size(num_queries + num_sample * self.get_max_workload_size(stat_id))
+        return min_sizes
+
+    def get_selected_statistics_kernel(self, stat_modules_ids=None, min_sizes: dict = None):
+        """
+        Returns the kernel of the selected statistics, see get_statistics_kernel. The modules in min_sizes are part
+        of the kernel even if none of their workloads is selected.
+        """
+        module_query_ids = self.__get_selected_query_ids(stat_modules_ids, min_sizes)
+        statistics_kernel, query_tables, valid_positions = self.get_statistics_kernel(module_query_ids, min_sizes)
+        kernel_key = self.get_statistics_kernel_key([stat_id for stat_id, _ in module_query_ids])
+        return statistics_kernel, query_tables, valid_positions, kernel_key
+
     def get_all_true_statistics(self):
 
         chained_stats = []
@@ -72,23 +241,21 @@ class ChainedStatistics:
             stat_modules_ids = list(range(len(self.stat_modules)))
         selected_chained_stats = []
         for stat_id in stat_modules_ids:
-            temp = [selected[2] for selected in self.selected_workloads[stat_id]]
+            temp = [np.asarray(selected[2]) for selected in self.selected_workloads[stat_id]]
             if len(temp) > 0:
-                temp = jnp.concatenate(temp)
-                selected_chained_stats.append(temp)
-
-        return jnp.concatenate(selected_chained_stats)
+                selected_chained_stats.append(np.concatenate(temp))
+        # Concatenated on the host, since the number of selected statistics grows every round.
+        return jnp.asarray(np.concatenate(selected_chained_stats))
 
     def get_selected_statistics_without_noise(self, stat_modules_ids=None):
         if stat_modules_ids is None:
             stat_modules_ids = list(range(len(self.stat_modules)))
         selected_chained_stats = []
         for stat_id in stat_modules_ids:
-            temp = [selected[3] for selected in self.selected_workloads[stat_id]]
+            temp = [np.asarray(selected[3]) for selected in self.selected_workloads[stat_id]]
             if len(temp) > 0:
-                temp = jnp.concatenate(temp)
-                selected_chained_stats.append(temp)
-        return jnp.concatenate(selected_chained_stats)
+                selected_chained_stats.append(np.concatenate(temp))
+        return jnp.asarray(np.concatenate(selected_chained_stats))
 
     def get_selected_statistics_fn(self, stat_modules_ids=None):
         if stat_modules_ids is None:
@@ -121,6 +288,10 @@ class ChainedStatistics:
     def get_domain(self):
         return self.domain
 
+    def is_count_statistic(self) -> bool:
+        """True if all the statistics are counts divided by the number of rows, see AdaptiveStatisticState."""
+        return all(stat_mod.is_count_statistic for stat_mod in self.stat_modules)
+
     def get_num_workloads(self) -> int:
         s = 0
         for stat_mod in self.stat_modules:
@@ -184,8 +355,10 @@ class ChainedStatistics:
     def _get_workload_sensitivity(self, workload_id: int = None, N: int = None) -> float:
         pass
 
+    @profile_function('ChainedStatistics.private_measure_all_statistics')
     def private_measure_all_statistics(self, key: chex.PRNGKey, rho: float, stat_ids: list = None):
         self.selected_workloads = []
+        self.selection_version += 1
         for stat_id in range(len(self.stat_modules)):
             self.selected_workloads.append([])
 
@@ -214,8 +387,10 @@ class ChainedStatistics:
                 # selected_noised_stat = stats + gau_noise
                 self.__add_stats(stat_id, workload_id, selected_noised_stat, stats)
 
+    @profile_function('ChainedStatistics.non_private_measure_all_statistics')
     def non_private_measure_all_statistics(self, key: chex.PRNGKey, stat_ids: list = None):
         self.selected_workloads = []
+        self.selection_version += 1
         for stat_id in range(len(self.stat_modules)):
             self.selected_workloads.append([])
 
@@ -234,6 +409,7 @@ class ChainedStatistics:
                 # selected_noised_stat = stats + gau_noise
                 self.__add_stats(stat_id, workload_id, selected_noised_stat, stats)
 
+    @profile_function('ChainedStatistics.get_sync_data_errors')
     def get_sync_data_errors(self, data: Dataset):
         max_errors = []
         for stat_id in range(len(self.stat_modules)):
@@ -242,8 +418,8 @@ class ChainedStatistics:
 
             # Get synthetic data statistics
             module_sync_stats = np.array(module_stat_fn_jit(data))
-            # Statistics of original data
-            module_true_stats = self.modules_all_statistics[stat_id]
+            # Statistics of original data. Both are on the host, so the per-workload maxima below do not transfer.
+            module_true_stats = np.asarray(self.modules_all_statistics[stat_id])
 
             errors = np.abs(module_true_stats - module_sync_stats)
 
@@ -258,6 +434,7 @@ class ChainedStatistics:
         # return jnp.array(max_errors)
         return max_errors
 
+    @profile_function('ChainedStatistics.private_select_measure_statistic')
     def private_select_measure_statistic(self, key: chex.PRNGKey, rho_per_round: float,
                                          # sync_data_mat: chex.Array,
                                          data: Dataset,
@@ -292,14 +469,15 @@ class ChainedStatistics:
             errors_noise.append(stat_errors_noise)
 
             m = stat_errors_noise.shape[0]
-            vec_stat_id = jnp.ones(m) * stat_id
-            vec_work_id = jnp.arange(m)
+            vec_stat_id = np.ones(m) * stat_id
+            vec_work_id = np.arange(m)
             stat_id_pos.append(vec_stat_id)
             workload_id_pos.append(vec_work_id)
 
-        stat_id_pos = jnp.concatenate(stat_id_pos)
-        workload_id_pos = jnp.concatenate(workload_id_pos)
-        errors_noise = jnp.concatenate(errors_noise)
+        # Kept on the host, since the selected ids are read with int() below.
+        stat_id_pos = np.concatenate(stat_id_pos)
+        workload_id_pos = np.concatenate(workload_id_pos)
+        errors_noise = np.concatenate(errors_noise)
 
         errors_noise_flatten = errors_noise.flatten()
         top_k_indices = (-errors_noise_flatten).argsort()[:sample_num]
@@ -325,10 +503,10 @@ class ChainedStatistics:
             selected_noised_stat = jnp.clip(stats + gau_noise, 0, 1)
             self.__add_stats(stat_id, workload_id, selected_noised_stat, stats)
 
-    def get_selected_trimmed_statistics_fn(self, stat_modules_ids=None):
+    def __get_trimmed_selection(self, stat_modules_ids=None):
         if stat_modules_ids is None:
             stat_modules_ids = list(range(len(self.stat_modules)))
-        workload_fn_list = []
+        module_query_ids = []
         selected_true_chained_stats = []
         selected_noised_chained_stats = []
         for stat_id in stat_modules_ids:
@@ -348,17 +526,30 @@ class ChainedStatistics:
                 selected_true_chained_stats.append(true_workload_stats[topk_ids])
                 selected_noised_chained_stats.append(noised_workload_stats[topk_ids])
                 query_ids_list.append(query_ids[topk_ids])
-            query_ids_concat = jnp.concatenate(query_ids_list)
-            tmp_fn = stat_mod._get_stat_fn(query_ids_concat)
-            workload_fn_list.append(tmp_fn)
+            module_query_ids.append((stat_id, jnp.concatenate(query_ids_list)))
+        return jnp.concatenate(selected_true_chained_stats), jnp.concatenate(selected_noised_chained_stats), module_query_ids
+
+    def get_selected_trimmed_statistics_fn(self, stat_modules_ids=None):
+        selected_true_stats, selected_noised_stats, module_query_ids = self.__get_trimmed_selection(stat_modules_ids)
+        workload_fn_list = [self.stat_modules[stat_id]._get_stat_fn(query_ids) for stat_id, query_ids in module_query_ids]
 
         def chained_workload(X, **kwargs):
             return jnp.concatenate([fn(X, **kwargs) for fn in workload_fn_list], axis=0)
 
-        return jnp.concatenate(selected_true_chained_stats), jnp.concatenate(selected_noised_chained_stats), chained_workload
+        return selected_true_stats, selected_noised_stats, chained_workload
+
+    def get_selected_trimmed_statistics_kernel(self, stat_modules_ids=None, min_sizes: dict = None):
+        """
+        Returns the true and noised trimmed statistics and their kernel, see get_statistics_kernel.
+        """
+        selected_true_stats, selected_noised_stats, module_query_ids = self.__get_trimmed_selection(stat_modules_ids)
+        statistics_kernel, query_tables, valid_positions = self.get_statistics_kernel(module_query_ids, min_sizes)
+        kernel_key = self.get_statistics_kernel_key([stat_id for stat_id, _ in module_query_ids])
+        return selected_true_stats, selected_noised_stats, statistics_kernel, query_tables, valid_positions, kernel_key
 
     def reselect_stats(self):
         self.selected_workloads = []
+        self.selection_version += 1
         for stat_id in range(len(self.stat_modules)):
             self.selected_workloads.append([])
 
@@ -366,6 +557,23 @@ class ChainedStatistics:
 
 
 
+def get_config_value(value):
+    """
+    A hashable value of a configuration attribute that is the same in every process: primitive values, domains and
+    containers of them. Returns NOT_CONFIG for arrays, functions and other objects.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Domain):
+        return repr(value)
+    if isinstance(value, dict):
+        value = sorted((str(k), v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        values = tuple(get_config_value(v) for v in value)
+        return NOT_CONFIG if any(v is NOT_CONFIG for v in values) else values
+    return NOT_CONFIG
+
+
 def exponential_mechanism(key: jnp.ndarray, scores: jnp.ndarray, eps0: float, sensitivity: float):
     dist = jax.nn.softmax(2 * eps0 * scores / (2 * sensitivity))
     cumulative_dist = jnp.cumsum(dist)
@@ -4,12 +4,14 @@ import jax.numpy as jnp
 from utils import Dataset
 from utils.utils_data import Domain
 from stats import AdaptiveStatisticState
+from stats.adaptive_statistic import get_row_sum_kernel
 import numpy as np
 import chex
 from tqdm import tqdm
 
 
 class Halfspace(AdaptiveStatisticState):
+    is_count_statistic = True
 
 
     def __init__(self, domain: Domain,
@@ -106,23 +108,24 @@ class Halfspace(AdaptiveStatisticState):
             return workload_fn(X)
         return data_fn
 
-    def _get_workload_fn(self, workload_ids=None):
+    def _get_query_table(self, query_ids: chex.Array):
+        these_queries = self.queries[query_ids]
+        return these_queries, self.halfspace_keys[these_queries[:, -1].astype(int)]
+
+    def _get_stat_kernel(self):
         """
-        Returns marginals function and sensitivity
+        Returns halfspace statistics kernel. Each query comes with its halfspace key.
         :return:
         """
-        dim = len(self.domain.attrs)
         numeric_cols = self.domain.get_numeric_cols()
         num_idx = self.domain.get_attribute_indices(numeric_cols).astype(int)
         numeric_dim = num_idx.shape[0]
 
-
-        def answer_fn(x_row: chex.Array, query_single: chex.Array):
+        def answer_fn(x_row: chex.Array, query_single: tuple):
+            query_single, halfspace_key = query_single
             I = query_single[:self.k].astype(int)
             U = query_single[self.k:2*self.k]
             L = query_single[2*self.k:3*self.k]
-            key_id = query_single[-1].astype(int)
-            halfspace_key = self.halfspace_keys[key_id]
 
             # Categorical
             t1 = (x_row[I] < U).astype(int)
@@ -142,32 +145,4 @@ class Halfspace(AdaptiveStatisticState):
 
             return answers
 
-        if workload_ids is None :
-            these_queries = self.queries
-        else:
-            these_queries = []
-            # query_positions = []
-            for stat_id in workload_ids:
-                a, b = self.workload_positions[stat_id]
-                # q_pos = jnp.arange(a, b)
-                # query_positions.append(q_pos)
-                these_queries.append(self.queries[a:b, :])
-            these_queries = jnp.concatenate(these_queries, axis=0)
-
-        temp_stat_fn = jax.vmap(answer_fn, in_axes=(None, 0))
-
-        def scan_fun(carry, x):
-            return carry + temp_stat_fn(x, these_queries), None
-
-        def stat_fn(X):
-            out = jax.eval_shape(temp_stat_fn, X[0], these_queries)
-            stats = jax.lax.scan(scan_fun, jnp.zeros(out.shape, out.dtype), X)[0]
-            return stats / X.shape[0]
-        return stat_fn
-
-
-
-
-
-
-
+        return get_row_sum_kernel(answer_fn)
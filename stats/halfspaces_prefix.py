@@ -2,16 +2,16 @@ import itertools
 import jax
 import jax.numpy as jnp
 import chex
-import matplotlib.pyplot as plt
-import pandas as pd
 
 from utils import Dataset, Domain
 from stats import AdaptiveStatisticState
+from stats.adaptive_statistic import get_row_sum_kernel
 from tqdm import tqdm
 import numpy as np
 
 
 class HalfspacesPrefix(AdaptiveStatisticState):
+    is_count_statistic = True
 
     def __init__(self, domain, key: chex.PRNGKey, random_proj: int):
         self.domain = domain
@@ -80,18 +80,9 @@ class HalfspacesPrefix(AdaptiveStatisticState):
             return workload_fn(X)
         return data_fn
 
-    def _get_workload_fn(self, workload_ids=None):
-        if workload_ids is None:
-            query_ids = jnp.arange(self.queries.shape[0])
-        else:
-            query_positions = []
-            for stat_id in workload_ids:
-                a, b = self._get_workload_positions(stat_id)
-                q_pos = jnp.arange(a, b)
-                query_positions.append(q_pos)
-            query_ids = jnp.concatenate(query_positions)
-
-        return self._get_stat_fn(query_ids)
+    def _get_query_table(self, query_ids: chex.Array):
+        these_queries = self.queries[query_ids]
+        return these_queries, self.proj_keys[these_queries[:, 0].astype(jnp.uint32)]
 
     def random_linear_proj(self, key: chex.PRNGKey, x: chex.Array):
         key0, key1, key2 = jax.random.split(key, 3)
@@ -105,26 +96,14 @@ class HalfspacesPrefix(AdaptiveStatisticState):
         sum += jnp.dot(H[self.num_shift_position], x[self.num_pos])
         return sum - b
 
-    def answer_fn(self, x_row: chex.Array, query_single: chex.Array):
-        key_id = query_single[0].astype(jnp.uint32)
-        key = self.proj_keys[key_id]
+    def answer_fn(self, x_row: chex.Array, query_single: tuple):
+        query_single, key = query_single
         x_proj = self.random_linear_proj(key, x_row)
         answers1 = x_proj > 0
         return (answers1).astype(float).squeeze()
 
-    def _get_stat_fn(self, query_ids):
-
-        these_queries = self.queries[query_ids]
-        temp_stat_fn = jax.jit(jax.vmap(self.answer_fn, in_axes=(None, 0)))
-
-        # jax.vmap()
-        def scan_fun(carry, x):
-            return carry + temp_stat_fn(x, these_queries), None
-        def stat_fn(X):
-            out = jax.eval_shape(temp_stat_fn, X[0], these_queries)
-            stats = jax.lax.scan(scan_fun, jnp.zeros(out.shape, out.dtype), X)[0]
-            return stats / X.shape[0]
-        return stat_fn
+    def _get_stat_kernel(self):
+        return get_row_sum_kernel(self.answer_fn)
 
 def get_linear_proj(domain: Domain):
     cat_pos = domain.get_attribute_indices(domain.get_categorical_cols())
@@ -171,9 +150,11 @@ def get_proj(domain: Domain):
     return proj_fn
 
 
-from dp_data import load_domain_config, load_df, ml_eval
-import seaborn as sns
 def test_proj():
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+    from dp_data import load_domain_config, load_df
     dataset_name = 'folktables_2018_coverage_CA'
     root_path = '../dp-data-dev/datasets/preprocessed/folktables/1-Year/'
     config = load_domain_config(dataset_name, root_path=root_path)
@@ -4,15 +4,18 @@ import jax.numpy as jnp
 import chex
 from utils import Dataset, Domain
 from stats import AdaptiveStatisticState
+from stats.adaptive_statistic import get_row_sum_kernel
 from tqdm import tqdm
 import numpy as np
 
 
 class Marginals(AdaptiveStatisticState):
+    is_count_statistic = True
 
     def __init__(self, domain, kway_combinations, k, bins=(32,)):
         self.domain = domain
-        self.kway_combinations = kway_combinations
+        # The attributes of each marginal are in the order of the domain, the order of the columns of its queries.
+        self.kway_combinations = [sorted(marginal, key=domain.attr_index.__getitem__) for marginal in kway_combinations]
         self.k = k
         self.bins = list(bins)
         self.workload_positions = []
@@ -76,32 +79,48 @@ class Marginals(AdaptiveStatisticState):
         return self.workload_sensitivity[workload_id] / N
 
     def _get_dataset_statistics_fn(self, workload_ids=None, jitted: bool = False):
+        """
+        The statistics of a dataset are histograms of its integer values: the categorical values, and the bins of the
+        numeric values given by Dataset.get_bin_indices. They match the statistics kernel on the rows of the dataset.
+        The histograms are computed on the host with numpy, so with jitted=True the jitted statistics kernel is
+        applied to data.to_numpy() instead. The synthetic datasets of GSD are evaluated by the statistics kernel,
+        which works on the rows of the candidates inside jit.
+        """
         if jitted:
             workload_fn = jax.jit(self._get_workload_fn(workload_ids))
-        else:
-            workload_fn = self._get_workload_fn(workload_ids)
 
-        def data_fn(data: Dataset):
-            X = data.to_numpy()
-            return workload_fn(X)
-        return data_fn
+            def kernel_data_fn(data: Dataset):
+                return workload_fn(data.to_numpy())
+            return kernel_data_fn
 
-    def _get_workload_fn(self, workload_ids=None):
-        # query_ids = []
         if workload_ids is None:
-        #     these_queries = self.queries
-            query_ids = jnp.arange(self.queries.shape[0])
-        else:
-            query_positions = []
-            for stat_id in workload_ids:
-                a, b = self.workload_positions[stat_id]
-                q_pos = jnp.arange(a, b)
-                query_positions.append(q_pos)
-            query_ids = jnp.concatenate(query_positions)
+            workload_ids = range(self.get_num_workloads())
+        numeric_position = {attr: i for i, attr in enumerate(self.domain.get_numeric_cols())}
 
-        return self._get_stat_fn(query_ids)
+        def data_fn(data: Dataset):
+            counts = []
+            for workload_id in workload_ids:
+                marginal = self.kway_combinations[workload_id]
+                bins = self.bins if self.is_workload_numeric(marginal) else [-1]
+                for bin in bins:
+                    cells = np.zeros(len(data), dtype=np.int64)
+                    valid = np.ones(len(data), dtype=bool)
+                    num_cells = 1
+                    for att in marginal:
+                        size = self.domain[att]
+                        if size > 1:
+                            col = data.df[att].values.astype(np.int64)
+                        else:
+                            size = bin
+                            col = data.get_bin_indices(bin)[:, numeric_position[att]]
+                        valid &= (col >= 0) & (col < size)
+                        cells = cells * size + col
+                        num_cells *= size
+                    counts.append(np.bincount(cells[valid], minlength=num_cells))
+            return jnp.asarray(np.concatenate(counts)) / len(data)
+        return data_fn
 
-    def _get_stat_fn(self, query_ids):
+    def _get_stat_kernel(self):
         def answer_fn(x_row: chex.Array, query_single: chex.Array):
             I = query_single[:self.k].astype(int)
             U = query_single[self.k:2 * self.k]
@@ -112,16 +131,7 @@ class Marginals(AdaptiveStatisticState):
             answers = jnp.prod(t3)
             return answers
 
-        these_queries = self.queries[query_ids]
-        temp_stat_fn = jax.vmap(answer_fn, in_axes=(None, 0))
-
-        def scan_fun(carry, x):
-            return carry + temp_stat_fn(x, these_queries), None
-        def stat_fn(X):
-            out = jax.eval_shape(temp_stat_fn, X[0], these_queries)
-            stats = jax.lax.scan(scan_fun, jnp.zeros(out.shape, out.dtype), X)[0]
-            return stats / X.shape[0]
-        return stat_fn
+        return get_row_sum_kernel(answer_fn)
 
     @staticmethod
     def get_kway_categorical(domain: Domain, k):
@@ -170,3 +180,24 @@ class Marginals(AdaptiveStatisticState):
 ######################################################################
 ## TEST
 ######################################################################
+
+def test_dataset_statistics_fn():
+    """The histograms of _get_dataset_statistics_fn match the statistics kernel, with marginals that are not in the
+    order of the domain."""
+    domain = Domain(['a', 'x', 'b', 'y'], [3, 1, 4, 1])
+    data = Dataset.synthetic(domain, 1000, 0)
+    marginals = Marginals(domain, [['x', 'a'], ['b', 'y'], ['a', 'b'], ['y', 'x']], k=2, bins=[2, 4, 8])
+    assert marginals.kway_combinations == [['a', 'x'], ['b', 'y'], ['a', 'b'], ['x', 'y']]
+    histogram_stats = marginals._get_dataset_statistics_fn()(data)
+    kernel_stats = marginals._get_dataset_statistics_fn(jitted=True)(data)
+    assert histogram_stats.shape == kernel_stats.shape
+    assert np.abs(np.asarray(histogram_stats) - np.asarray(kernel_stats)).max() < 1e-6
+
+    workload_ids = [3, 1]
+    histogram_stats = marginals._get_dataset_statistics_fn(workload_ids)(data)
+    kernel_stats = marginals._get_dataset_statistics_fn(workload_ids, jitted=True)(data)
+    assert np.abs(np.asarray(histogram_stats) - np.asarray(kernel_stats)).max() < 1e-6
+
+
+if __name__ == "__main__":
+    test_dataset_statistics_fn()
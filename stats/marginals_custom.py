@@ -4,6 +4,7 @@ import jax.numpy as jnp
 import chex
 from utils import Dataset, Domain
 from stats import AdaptiveStatisticState
+from stats.adaptive_statistic import get_row_sum_kernel
 from tqdm import tqdm
 import numpy as np
 
@@ -13,6 +14,7 @@ config_example={
     'RACE': {'type': 'cat', 'sensitivity': np.sqrt(2)}
 }
 class Marginals(AdaptiveStatisticState):
+    is_count_statistic = True
 
     def __init__(self, domain, config):
         self.domain = domain
@@ -91,13 +93,7 @@ class Marginals(AdaptiveStatisticState):
             return workload_fn(X)
         return data_fn
 
-    def _get_workload_fn(self, workload_ids=None):
-        """
-        Returns marginals function and sensitivity
-        :return:
-        """
-        dim = len(self.domain.attrs)
-
+    def _get_stat_kernel(self):
         def answer_fn(x_row: chex.Array, query_single: chex.Array):
             I = query_single[:self.k].astype(int)
             U = query_single[self.k:2 * self.k]
@@ -108,28 +104,7 @@ class Marginals(AdaptiveStatisticState):
             answers = jnp.prod(t3)
             return answers
 
-        if workload_ids is None:
-            these_queries = self.queries
-        else:
-            these_queries = []
-            query_positions = []
-            for stat_id in workload_ids:
-                a, b = self.workload_positions[stat_id]
-                q_pos = jnp.arange(a, b)
-                query_positions.append(q_pos)
-                these_queries.append(self.queries[a:b, :])
-            these_queries = jnp.concatenate(these_queries, axis=0)
-        temp_stat_fn = jax.vmap(answer_fn, in_axes=(None, 0))
-
-        def scan_fun(carry, x):
-            return carry + temp_stat_fn(x, these_queries), None
-        def stat_fn(X):
-            out = jax.eval_shape(temp_stat_fn, X[0], these_queries)
-            stats = jax.lax.scan(scan_fun, jnp.zeros(out.shape, out.dtype), X)[0]
-            return stats / X.shape[0]
-
-        return stat_fn
-
+        return get_row_sum_kernel(answer_fn)
 
     @staticmethod
     def get_kway_categorical(domain: Domain, k):
@@ -6,10 +6,12 @@ from utils.utils_data import Domain
 import numpy as np
 import chex
 from stats import AdaptiveStatisticState
+from stats.adaptive_statistic import get_row_sum_kernel
 
 from tqdm import tqdm
 
 class Prefix(AdaptiveStatisticState):
+    is_count_statistic = True
 
     def __init__(self, domain: Domain,
                  k_cat: int,
@@ -73,55 +75,25 @@ class Prefix(AdaptiveStatisticState):
             return workload_fn(X)
         return data_fn
 
-    def _get_workload_fn(self, workload_ids=None):
+    def _get_stat_kernel(self):
         """
-        Returns marginals function and sensitivity
+        Returns prefix statistics kernel.
         :return:
         """
-        dim = len(self.domain.attrs)
         numeric_cols = self.domain.get_numeric_cols()
         num_idx = self.domain.get_attribute_indices(numeric_cols).astype(int)
-        numeric_dim = num_idx.shape[0]
-
 
         def answer_fn(x_row: chex.Array, query_single: chex.Array):
 
             pos = query_single[0].astype(int)
             thresholds = query_single[1]
-            # key_id = query_single[-1].astype(int)
-            # prefix_key = self.prefix_keys[key_id]
-
-            # Prefix
-            # rng_h, rng_b = jax.random.split(prefix_key, 2)
-            # thresholds = jax.random.uniform(rng_h, shape=(self.k_prefix,)) # d x h
-            # pos = jax.random.randint(rng_b, minval=0, maxval=numeric_dim, shape=(self.k_prefix,)) # d x h
             kway_idx = num_idx[pos]
             below_threshold = (x_row[kway_idx] <= thresholds).astype(int)  # n x d
             prefix_answer = jnp.prod(below_threshold)
 
             return prefix_answer
 
-        if workload_ids is None :
-            these_queries = self.queries
-        else:
-            these_queries = []
-            query_positions = []
-            for stat_id in workload_ids:
-                a, b = self.workload_positions[stat_id]
-                q_pos = jnp.arange(a, b)
-                query_positions.append(q_pos)
-                these_queries.append(self.queries[a:b, :])
-            these_queries = jnp.concatenate(these_queries, axis=0)
-
-        temp_stat_fn = jax.vmap(answer_fn, in_axes=(None, 0))
-
-        def scan_fun(carry, x):
-            return carry + temp_stat_fn(x, these_queries), None
-        def stat_fn(X):
-            out = jax.eval_shape(temp_stat_fn, X[0], these_queries)
-            stats = jax.lax.scan(scan_fun, jnp.zeros(out.shape, out.dtype), X)[0]
-            return stats / X.shape[0]
-        return stat_fn
+        return get_row_sum_kernel(answer_fn)
 
     @staticmethod
     def get_kway_prefixes(domain: Domain,
@@ -221,33 +193,75 @@ class PrefixDiff(AdaptiveStatisticState):
         self.queries = jnp.array(queries)
 
     def _get_dataset_statistics_fn(self, workload_ids=None, jitted: bool = False):
+        # The data is one-hot encoded, so its statistics are computed from the index form of the encoding.
+        sparse_stat_kernel = self._get_jitted_sparse_stat_kernel()
+        workload_fn = self._get_stat_fn(self._get_workload_query_ids(workload_ids), stat_kernel=sparse_stat_kernel)
         if jitted:
-            workload_fn = jax.jit(self._get_workload_fn(workload_ids))
-        else:
-            workload_fn = self._get_workload_fn(workload_ids)
+            workload_fn = jax.jit(workload_fn)
 
         def data_fn(data: Dataset):
-            X = data.to_onehot()
+            X = data.to_onehot_sparse()
             return workload_fn(X)
         return data_fn
 
-    def _get_workload_fn(self, workload_ids=None):
+    def _get_query_table(self, query_ids: chex.Array):
+        these_queries = self.queries[query_ids]
+        return these_queries, self.prefix_keys[these_queries[:, -1].astype(int)]
+
+    def _get_jitted_sparse_stat_kernel(self):
+        if getattr(self, 'sparse_stat_kernel_jit', None) is None:
+            sparse_stat_kernel = self._get_sparse_stat_kernel()
+
+            def named_sparse_stat_kernel(X, query_table, **kwargs):
+                with jax.named_scope(str(self)):
+                    return sparse_stat_kernel(X, query_table, **kwargs)
+            self.sparse_stat_kernel_jit = jax.jit(named_sparse_stat_kernel)
+        return self.sparse_stat_kernel_jit
+
+    def _get_sparse_stat_kernel(self):
         """
-        Returns marginals function and sensitivity
-        :return:
+        Returns the statistics kernel of _get_stat_kernel on the index form of the one-hot encoding (see
+        Dataset.to_onehot_sparse) of a dataset.
         """
-        dim = len(self.domain.attrs)
-        numeric_cols = self.domain.get_numeric_cols()
-        # num_idx = self.domain.get_attribute_indices(numeric_cols).astype(int)
-        num_idx = jnp.array([self.domain.get_attribute_onehot_indices(att) for att in numeric_cols]).reshape(-1)
-        numeric_dim = num_idx.shape[0]
+        numeric_dim = len(self.domain.get_numeric_cols())
+        # The categorical column of each one-hot position of a categorical value.
+        is_categorical = np.array(self.domain.shape) > 1
+        onehot_cat_column = jnp.array(np.repeat(np.cumsum(is_categorical) - 1, self.domain.shape))
+
+        def answer_fn(x_row: tuple, query_single: tuple, sigmoid: float):
+            cat_row, num_row = x_row
+            query_single, prefix_key = query_single
+            cat_q = query_single[:self.k].astype(int)
+            cat_answers = jnp.prod(cat_row[onehot_cat_column[cat_q]] == cat_q)
+
+            # Prefix
+            rng_h, rng_b = jax.random.split(prefix_key, 2)
+            thresholds = jax.random.uniform(rng_h, shape=(self.k_prefix,)) # d x h
+            pos = jax.random.randint(rng_b, minval=0, maxval=numeric_dim, shape=(self.k_prefix,)) # d x h
+            below_threshold = jax.nn.sigmoid(-sigmoid * (num_row[pos] - thresholds))
+
+            prefix_answer = jnp.prod(below_threshold)
+            answers = cat_answers * prefix_answer
+
+            return answers
+
+        row_sum_kernel = get_row_sum_kernel(answer_fn)
 
+        def stat_kernel(X, query_table, sigmoid: float = 2**15):
+            return row_sum_kernel(X, query_table, sigmoid)
+        return stat_kernel
 
-        def answer_fn(x_row: chex.Array, query_single: chex.Array, sigmoid: float):
+    def _get_stat_kernel(self):
+        """
+        Returns differentiable prefix statistics kernel. Each query comes with its prefix key.
+        :return:
+        """
+        num_idx = jnp.asarray(self.domain.onehot_offsets[self.domain.numeric_index])
+        numeric_dim = num_idx.shape[0]
 
+        def answer_fn(x_row: chex.Array, query_single: tuple, sigmoid: float):
+            query_single, prefix_key = query_single
             cat_q = query_single[:self.k].astype(int)
-            key_id = query_single[-1].astype(int)
-            prefix_key = self.prefix_keys[key_id]
             cat_answers = jnp.prod(x_row[cat_q])
 
             # Prefix
@@ -265,29 +279,11 @@ class PrefixDiff(AdaptiveStatisticState):
 
             return answers
 
-        if workload_ids is None :
-            these_queries = self.queries
-        else:
-            these_queries = []
-            query_positions = []
-            for stat_id in workload_ids:
-                a, b = self.workload_positions[stat_id]
-                q_pos = jnp.arange(a, b)
-                query_positions.append(q_pos)
-                these_queries.append(self.queries[a:b, :])
-            these_queries = jnp.concatenate(these_queries, axis=0)
-
-        temp_stat_fn = jax.vmap(answer_fn, in_axes=(None, 0, None))
-
-        def stat_fn(X, sigmoid: float = 2**15):
-
-            def scan_fun(carry, x):
-                return carry + temp_stat_fn(x, these_queries, sigmoid), None
-
-            out = jax.eval_shape(temp_stat_fn, X[0], these_queries, sigmoid)
-            stats = jax.lax.scan(scan_fun, jnp.zeros(out.shape, out.dtype), X)[0]
-            return stats / X.shape[0]
-        return stat_fn
+        row_sum_kernel = get_row_sum_kernel(answer_fn)
+
+        def stat_kernel(X, query_table, sigmoid: float = 2**15):
+            return row_sum_kernel(X, query_table, sigmoid)
+        return stat_kernel
 
     @staticmethod
     def get_kway_prefixes(domain: Domain,
@@ -2,4 +2,9 @@ from utils.domain import Domain
 from utils.dataset_jax import Dataset
 # from utils.transformer import DataTransformer
 from utils.general_utils import timer, filter_outliers
-from utils.ml_utils import get_Xy, separate_cat_and_num_cols
\ No newline at end of file
+from utils.ml_utils import get_Xy, separate_cat_and_num_cols
+from utils.compilation import KernelCache, enable_persistent_compilation_cache
+from utils.telemetry import TelemetrySink, JsonlSink, CallbackSink, DataFrameSink
+from utils.profiling import enable_profiling, profile_scope, profile_function, TraceWindow
+from utils.sanitizer import Sanitizer, BudgetExceededError
+from utils.accountant import ZCDPAccountant, BudgetExhaustedError, cdp_rho, cdp_eps, cdp_delta
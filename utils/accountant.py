@@ -0,0 +1,257 @@
+"""
+Conversions between zero-concentrated DP (rho-zCDP) and approximate DP ((eps, delta)-DP), and an accountant of the
+zCDP budget spent by a run.
+
+The conversions use the bound of Canonne, Kamath and Steinke (2020): rho-zCDP implies (eps, delta)-DP with
+
+    delta = min over alpha > 1 of exp((alpha - 1) * (alpha * rho - eps)) / (alpha - 1) * (1 - 1 / alpha) ** alpha.
+
+The log of the bound is a minimum of functions that are affine in eps and in rho, so it is concave in both, and its
+derivatives are -(alpha - 1) and alpha * (alpha - 1) at the optimal alpha. Newton's method on a concave function stays
+on one side of the root, so every iterate of cdp_eps and cdp_rho is a valid (conservative) conversion and the solvers
+stop as soon as the steps are below the tolerance. The optimal alpha is found the same way. The functions accept
+scalars or arrays, and the scalar conversions are memoized.
+"""
+import functools
+import numpy as np
+import pandas as pd
+
+MIN_ALPHA = 1.01  # alpha cannot be too small (numerical stability)
+TOLERANCE = 1e-12
+MAX_ITERATIONS = 100
+
+
+def _solve_alpha(rho: np.ndarray, eps: np.ndarray) -> np.ndarray:
+    """The optimal alpha of the bound, the root of (2 * alpha - 1) * rho - eps + log(1 - 1 / alpha), at least MIN_ALPHA."""
+    # Root of the upper bound (2 * alpha - 1) * rho - eps - 1 / alpha, which is at most the root.
+    alpha = (rho + eps + np.sqrt((rho + eps) ** 2 + 8 * rho)) / (4 * rho)
+    alpha = np.maximum(alpha, MIN_ALPHA)
+    for _ in range(MAX_ITERATIONS):
+        derivative = (2 * alpha - 1) * rho - eps + np.log1p(-1 / alpha)
+        step = -derivative / (2 * rho + 1 / (alpha * (alpha - 1)))
+        alpha = alpha + np.maximum(step, 0)
+        if np.all(step <= TOLERANCE * alpha):
+            break
+    return alpha
+
+
+def _log_delta(rho: np.ndarray, eps: np.ndarray) -> tuple:
+    """The log of the bound without the cap delta <= 1, and the optimal alpha."""
+    alpha = _solve_alpha(rho, eps)
+    log_delta = (alpha - 1) * (alpha * rho - eps) + alpha * np.log1p(-1 / alpha) - np.log(alpha - 1)
+    return log_delta, alpha
+
+
+def _cdp_delta(rho, eps) -> np.ndarray:
+    rho, eps = np.asarray(rho, dtype=float), np.asarray(eps, dtype=float)
+    assert np.all(rho >= 0) and np.all(eps >= 0)
+    log_delta, _ = _log_delta(np.where(rho == 0, 1.0, rho), eps)
+    return np.where(rho == 0, 0.0, np.minimum(np.exp(log_delta), 1.0))
+
+
+def _cdp_eps(rho, delta) -> np.ndarray:
+    rho, delta = np.broadcast_arrays(np.asarray(rho, dtype=float), np.asarray(delta, dtype=float))
+    assert np.all(rho >= 0) and np.all(delta > 0)
+    trivial = (delta >= 1) | (rho == 0)
+    rho = np.where(trivial, 1.0, rho)
+    log_target = np.log(np.where(trivial, 0.5, delta))
+    # Sufficient epsilon of the bound with alpha chosen in closed form, then Newton steps down to the root.
+    eps = rho + 2 * np.sqrt(rho * -log_target)
+    for _ in range(MAX_ITERATIONS):
+        log_delta, alpha = _log_delta(rho, eps)
+        new_eps = np.maximum(eps + np.minimum((log_delta - log_target) / (alpha - 1), 0), 0)
+        converged = np.all(eps - new_eps <= TOLERANCE * np.maximum(new_eps, 1))
+        eps = new_eps
+        if converged:
+            break
+    return np.where(trivial, 0.0, eps)
+
+
+def _cdp_rho(eps, delta) -> np.ndarray:
+    eps, delta = np.broadcast_arrays(np.asarray(eps, dtype=float), np.asarray(delta, dtype=float))
+    assert np.all(eps >= 0) and np.all(delta > 0)
+    trivial = delta >= 1
+    log_target = np.log(np.where(trivial, 0.5, delta))
+    # Sufficient rho of the bound with alpha chosen in closed form. The Newton steps start from the larger of it and
+    # the root e * delta^2 / 2 of the bound for eps = 0 and large alpha, since they are slow far to the left of the
+    # root. A step from the right of the root lands on its left, so each iterate after the first is sufficient.
+    min_rho = np.maximum((np.sqrt(eps - log_target) - np.sqrt(-log_target)) ** 2, np.finfo(float).tiny)
+    rho = np.maximum(min_rho, np.exp(1 + 2 * log_target) / 2)
+    for _ in range(MAX_ITERATIONS):
+        log_delta, alpha = _log_delta(rho, eps)
+        new_rho = np.maximum(rho + (log_target - log_delta) / (alpha * (alpha - 1)), min_rho)
+        converged = np.all(np.abs(new_rho - rho) <= TOLERANCE * np.maximum(new_rho, 1))
+        rho = new_rho
+        if converged:
+            break
+    return np.where(trivial, 0.0, rho)
+
+
+@functools.lru_cache(maxsize=4096)
+def _cdp_delta_scalar(rho: float, eps: float) -> float:
+    return float(_cdp_delta(rho, eps))
+
+
+@functools.lru_cache(maxsize=4096)
+def _cdp_eps_scalar(rho: float, delta: float) -> float:
+    return float(_cdp_eps(rho, delta))
+
+
+@functools.lru_cache(maxsize=4096)
+def _cdp_rho_scalar(eps: float, delta: float) -> float:
+    return float(_cdp_rho(eps, delta))
+
+
+def cdp_delta(rho, eps):
+    """The smallest delta such that rho-zCDP implies (eps, delta)-DP. Vectorized over arrays of rho and eps."""
+    if np.isscalar(rho) and np.isscalar(eps):
+        return _cdp_delta_scalar(float(rho), float(eps))
+    return _cdp_delta(rho, eps)
+
+
+def cdp_eps(rho, delta):
+    """The smallest eps such that rho-zCDP implies (eps, delta)-DP. Vectorized over arrays of rho and delta."""
+    if np.isscalar(rho) and np.isscalar(delta):
+        return _cdp_eps_scalar(float(rho), float(delta))
+    return _cdp_eps(rho, delta)
+
+
+def cdp_rho(eps, delta):
+    """The largest rho such that rho-zCDP implies (eps, delta)-DP. Vectorized over arrays of eps and delta."""
+    if np.isscalar(eps) and np.isscalar(delta):
+        return _cdp_rho_scalar(float(eps), float(delta))
+    return _cdp_rho(eps, delta)
+
+
+class BudgetExhaustedError(ValueError):
+    pass
+
+
+class ZCDPAccountant:
+    def __init__(self, rho: float, delta: float = None):
+        """
+        Keeps track of the zCDP budget spent by the steps of a run. zCDP composes additively, so the budget spent is the
+        sum of the rho of the steps.
+
+        :param rho: total budget
+        :param delta: If given, the budgets are also reported as the epsilon of (epsilon, delta)-DP.
+        """
+        self.rho = rho
+        self.delta = delta
+        self.steps = []
+        self.rho_spent = 0.0
+
+    def spend(self, rho: float, name: str):
+        """Records a step that spends rho. Raises BudgetExhaustedError if the total budget would be exceeded."""
+        rho = float(rho)
+        if self.rho_spent + rho > self.rho * (1 + 1e-9):
+            raise BudgetExhaustedError(f'{name} spends rho={rho}, but only {self.get_rho_remaining()} of the '
+                                       f'budget rho={self.rho} is left.')
+        self.rho_spent += rho
+        self.steps.append({'name': name, 'rho': rho, 'rho_spent': self.rho_spent})
+
+    def get_rho_remaining(self) -> float:
+        return max(self.rho - self.rho_spent, 0.0)
+
+    def get_epsilon_spent(self) -> float:
+        assert self.delta is not None, 'The accountant has no delta.'
+        return cdp_eps(self.rho_spent, self.delta)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.steps, columns=['name', 'rho', 'rho_spent'])
+        if self.delta is not None:
+            df['epsilon_spent'] = cdp_eps(df['rho_spent'].values, self.delta)
+        return df
+
+
+######################################################################
+## TEST
+######################################################################
+
+def bisection_cdp_delta(rho, eps, iterations=100):
+    """The binary search of the former utils.cdp2adp, the reference of the tests."""
+    if rho == 0:
+        return 0
+    amin, amax = MIN_ALPHA, (eps + 1) / (2 * rho) + 2
+    for _ in range(iterations):
+        alpha = (amin + amax) / 2
+        if (2 * alpha - 1) * rho - eps + np.log1p(-1.0 / alpha) < 0:
+            amin = alpha
+        else:
+            amax = alpha
+    delta = np.exp((alpha - 1) * (alpha * rho - eps) + alpha * np.log1p(-1 / alpha)) / (alpha - 1.0)
+    return min(delta, 1.0)
+
+
+def bisection_cdp_eps(rho, delta, iterations=100):
+    if delta >= 1 or rho == 0:
+        return 0.0
+    epsmin, epsmax = 0.0, rho + 2 * np.sqrt(rho * np.log(1 / delta))
+    for _ in range(iterations):
+        eps = (epsmin + epsmax) / 2
+        if bisection_cdp_delta(rho, eps) <= delta:
+            epsmax = eps
+        else:
+            epsmin = eps
+    return epsmax
+
+
+def bisection_cdp_rho(eps, delta, iterations=100):
+    if delta >= 1:
+        return 0.0
+    rhomin, rhomax = 0.0, eps + 1
+    for _ in range(iterations):
+        rho = (rhomin + rhomax) / 2
+        if bisection_cdp_delta(rho, eps) <= delta:
+            rhomin = rho
+        else:
+            rhomax = rho
+    return rhomin
+
+
+def test_conversions():
+    """The conversions match the binary search, are conservative, and the vectorized ones match the scalar ones."""
+    cases = [(0.1, 1e-5), (1.0, 1e-5), (0.01, 1e-9), (10.0, 1e-6), (0.5, 0.5), (3.0, 1 / 50000 ** 2), (0.0, 1e-5),
+             (0.05, 0.9), (2.0, 1.0)]
+    for eps, delta in cases:
+        rho = cdp_rho(eps, delta)
+        bisection_rho = bisection_cdp_rho(eps, delta)
+        if bisection_rho < (eps + 1) * (1 - 1e-9):
+            assert np.isclose(rho, bisection_rho, rtol=1e-9, atol=1e-15), (eps, delta)
+        else:
+            # The binary search is capped at eps + 1, below the largest rho for large delta.
+            assert rho >= bisection_rho
+        assert cdp_delta(rho, eps) <= delta * (1 + 1e-9)
+        if rho > 0:
+            assert np.isclose(cdp_eps(rho, delta), bisection_cdp_eps(rho, delta), rtol=1e-9, atol=1e-15)
+            assert cdp_eps(rho, delta) <= eps * (1 + 1e-9)
+        for rho in [0.0, 0.01, 0.2, 5.0]:
+            assert np.isclose(cdp_delta(rho, eps), bisection_cdp_delta(rho, eps), rtol=1e-9, atol=1e-300)
+
+    eps = np.linspace(0.05, 10, 50)
+    rho = cdp_rho(eps, 1e-6)
+    assert np.allclose(rho, [cdp_rho(float(e), 1e-6) for e in eps], rtol=1e-12)
+    assert np.allclose(cdp_eps(rho, 1e-6), [cdp_eps(float(r), 1e-6) for r in rho], rtol=1e-12)
+    assert np.all(cdp_delta(rho, eps) <= 1e-6 * (1 + 1e-9))
+
+
+def test_accountant():
+    accountant = ZCDPAccountant(0.5, delta=1e-6)
+    for i in range(5):
+        accountant.spend(0.1, f'round {i + 1}')
+    assert np.isclose(accountant.get_rho_remaining(), 0.0)
+    assert np.isclose(accountant.get_epsilon_spent(), bisection_cdp_eps(0.5, 1e-6), rtol=1e-9)
+    df = accountant.to_dataframe()
+    assert list(df['name']) == [f'round {i + 1}' for i in range(5)]
+    assert np.allclose(df['epsilon_spent'], [cdp_eps(rho, 1e-6) for rho in df['rho_spent']])
+    try:
+        accountant.spend(0.01, 'extra')
+        assert False, 'The budget is exhausted.'
+    except BudgetExhaustedError:
+        pass
+    assert len(accountant.steps) == 5
+
+
+if __name__ == "__main__":
+    test_conversions()
+    test_accountant()
@@ -0,0 +1,248 @@
+"""
+Persistent compilation cache and ahead-of-time compiled kernels.
+"""
+import functools
+import hashlib
+import importlib
+import os
+import pickle
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax.experimental import serialize_executable
+from jax.experimental.compilation_cache import compilation_cache
+
+
+def enable_persistent_compilation_cache(cache_dir: str, min_compile_time_secs: float = 0.0):
+    """
+    Enables the on-disk compilation cache of XLA. Every jitted function compiled after this call is stored in
+    cache_dir, so that other processes running the same configuration skip the compilation.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    jax.config.update('jax_compilation_cache_dir', cache_dir)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', min_compile_time_secs)
+    # The cache is initialized on the first compilation, which may have happened before this call.
+    compilation_cache.reset_cache()
+
+
+# Bump to invalidate the serialized kernels of every cache directory, e.g. after a change of the kernels that is not
+# in the source of KERNEL_SOURCE_PACKAGES.
+KERNEL_CACHE_VERSION = 1
+# Packages whose source defines the kernels. Any change of their source invalidates the serialized kernels.
+KERNEL_SOURCE_PACKAGES = ('models', 'stats', 'utils')
+
+
+@functools.lru_cache(maxsize=None)
+def get_source_digest(packages=KERNEL_SOURCE_PACKAGES) -> str:
+    """Hash of the source files of packages."""
+    digest = hashlib.sha256()
+    for package in packages:
+        package_dir = os.path.dirname(importlib.import_module(package).__file__)
+        for root, dirs, files in os.walk(package_dir):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            for file in sorted(files):
+                if file.endswith('.py'):
+                    path = os.path.join(root, file)
+                    digest.update(os.path.relpath(path, package_dir).encode())
+                    with open(path, 'rb') as f:
+                        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_array_digest(x) -> bytes:
+    if jnp.issubdtype(x.dtype, jax.dtypes.prng_key):
+        x = jax.random.key_data(x)
+    x = np.asarray(x)
+    return str((x.shape, x.dtype)).encode() + x.tobytes()
+
+
+def get_sharding(x):
+    """Returns the sharding of x if it spans several devices. Arrays on a single device are not pinned to it."""
+    sharding = getattr(x, 'sharding', None)
+    if sharding is None or len(sharding.device_set) <= 1:
+        return None
+    return sharding
+
+
+def get_abstract_args(args):
+    """Shapes, dtypes and, for sharded arguments, shardings of args."""
+    return jax.tree_util.tree_map(lambda x: jax.ShapeDtypeStruct(jnp.shape(x), jnp.result_type(x),
+                                                                 sharding=get_sharding(x)), args)
+
+
+class KernelCache:
+    def __init__(self, cache_dir: str = None):
+        """
+        Stores ahead-of-time compiled executables, in memory and optionally serialized to cache_dir. The key of an
+        executable includes KERNEL_CACHE_VERSION and the digest of the source of KERNEL_SOURCE_PACKAGES, so editing
+        the code of a kernel does not load the executable of the previous code.
+
+        :param cache_dir: directory of the serialized executables. If None the kernels are only kept in memory. The
+         executables are loaded with pickle, so the directory must only be writable by trusted users.
+        """
+        self.cache_dir = cache_dir
+        self.kernels = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_kernel_key(self, name: str, key, args) -> str:
+        abstract_args = jax.tree_util.tree_map(lambda x: (x.shape, str(x.dtype)), get_abstract_args(args))
+        kernel_id = (name, key, str(abstract_args), str(jax.tree_util.tree_structure(args)),
+                     jax.__version__, jax.default_backend(), KERNEL_CACHE_VERSION)
+        if self.cache_dir is not None:
+            kernel_id += (get_source_digest(),)
+        return hashlib.sha256(repr(kernel_id).encode()).hexdigest()
+
+    def compile(self, name: str, fn, key, *args):
+        """
+        Returns fn compiled for arguments with the shapes and dtypes of args. The executable is looked up in memory,
+        then on disk, and it is only lowered and compiled if none is found.
+
+        :param name: name of the kernel
+        :param fn: function to compile
+        :param key: hashable description of everything fn depends on besides the shapes of its arguments
+        :param args: example arguments, arrays or jax.ShapeDtypeStruct
+        """
+        kernel_key = self.get_kernel_key(name, key, args)
+        with self.lock:
+            compiled = self.kernels.get(kernel_key)
+            future = self.pending.get(kernel_key)
+        if compiled is not None:
+            return compiled
+        if future is not None:
+            # Compiled ahead on the background thread, wait for it.
+            return future.result()
+        return self._compile(kernel_key, fn, args)
+
+    def compile_ahead(self, name: str, fn, key, *args):
+        """
+        Starts compiling fn on a background thread, so that a later call of compile with arguments of the same shapes
+        returns without compiling. Returns a concurrent.futures.Future of the executable.
+        """
+        kernel_key = self.get_kernel_key(name, key, args)
+        with self.lock:
+            if kernel_key in self.pending:
+                return self.pending[kernel_key]
+            if kernel_key in self.kernels:
+                future = Future()
+                future.set_result(self.kernels[kernel_key])
+                return future
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kernel-cache')
+            # The worker waits for the lock, so the future is registered before it can finish.
+            future = self.executor.submit(self._compile, kernel_key, fn, get_abstract_args(args))
+            self.pending[kernel_key] = future
+        return future
+
+    def _compile(self, kernel_key: str, fn, args):
+        with self.lock:
+            if kernel_key in self.kernels:
+                return self.kernels[kernel_key]
+        try:
+            compiled = self.load(kernel_key)
+            if compiled is None:
+                compiled = jax.jit(fn).lower(*get_abstract_args(args)).compile()
+                self.save(kernel_key, compiled)
+            with self.lock:
+                self.kernels[kernel_key] = compiled
+        finally:
+            with self.lock:
+                self.pending.pop(kernel_key, None)
+        return compiled
+
+    def get_path(self, kernel_key: str) -> str:
+        return os.path.join(self.cache_dir, f'{kernel_key}.pkl')
+
+    def load(self, kernel_key: str):
+        if self.cache_dir is None or not os.path.exists(self.get_path(kernel_key)):
+            return None
+        try:
+            with open(self.get_path(kernel_key), 'rb') as f:
+                serialized, in_tree, out_tree = pickle.load(f)
+            return serialize_executable.deserialize_and_load(serialized, in_tree, out_tree)
+        except Exception:
+            # Stale or corrupted entry, compile it again.
+            return None
+
+    def save(self, kernel_key: str, compiled):
+        if self.cache_dir is None:
+            return
+        temp_path = f'{self.get_path(kernel_key)}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(serialize_executable.serialize(compiled), f)
+        os.replace(temp_path, self.get_path(kernel_key))
+
+
+######################################################################
+## TEST
+######################################################################
+
+def test_kernel_cache_across_processes():
+    """A kernel compiled by another process is loaded from the cache directory without tracing, and a different key
+    or KERNEL_CACHE_VERSION compiles and stores it again."""
+    import subprocess
+    import sys
+    import tempfile
+    global KERNEL_CACHE_VERSION
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    traces = []
+
+    def double(x):
+        traces.append(x.shape)
+        return 2 * x
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        script = ('import jax.numpy as jnp\n'
+                  'from utils.compilation import KernelCache\n'
+                  f'KernelCache({cache_dir!r}).compile("double", lambda x: 2 * x, "v1", jnp.zeros(3))\n')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([root_dir, os.environ.get('PYTHONPATH', '')]))
+        subprocess.run([sys.executable, '-c', script], check=True, cwd=root_dir, env=env)
+        assert len(os.listdir(cache_dir)) == 1
+
+        # Hit: the executable of the other process is loaded.
+        compiled = KernelCache(cache_dir).compile('double', double, 'v1', jnp.zeros(3))
+        assert traces == []
+        assert np.array_equal(compiled(jnp.ones(3)), 2 * np.ones(3))
+        assert len(os.listdir(cache_dir)) == 1
+
+        # Misses: each new kernel key stores a new executable.
+        KernelCache(cache_dir).compile('double', double, 'v2', jnp.zeros(3))
+        assert len(traces) == 1
+        assert len(os.listdir(cache_dir)) == 2
+
+        version = KERNEL_CACHE_VERSION
+        KERNEL_CACHE_VERSION = version + 1
+        try:
+            KernelCache(cache_dir).compile('double', double, 'v1', jnp.zeros(3))
+        finally:
+            KERNEL_CACHE_VERSION = version
+        assert len(os.listdir(cache_dir)) == 3
+
+
+def test_compile_ahead():
+    """A kernel compiled ahead on the background thread is traced there once and returned by compile."""
+    threads = []
+
+    def add_one(x):
+        threads.append(threading.current_thread().name)
+        return x + 1
+
+    cache = KernelCache()
+    future = cache.compile_ahead('add_one', add_one, 'v1', jax.ShapeDtypeStruct((4,), jnp.float32))
+    # The same shapes, pending or compiled, are not compiled again.
+    assert cache.compile_ahead('add_one', add_one, 'v1', jnp.zeros(4)).result() is future.result()
+    compiled = cache.compile('add_one', add_one, 'v1', jnp.zeros(4))
+    assert compiled is future.result()
+    assert len(threads) == 1 and threads[0].startswith('kernel-cache')
+    assert np.array_equal(compiled(jnp.zeros(4)), np.ones(4))
+    assert cache.pending == {}
+
+
+if __name__ == "__main__":
+    test_kernel_cache_across_processes()
+    test_compile_ahead()
@@ -1,11 +1,11 @@
 import json
+import os
 import jax.nn
 import numpy as np
 import jax.numpy as jnp
 from jax import random
 import pandas as pd
 from utils import Domain
-from sklearn.preprocessing import OneHotEncoder
 
 
 def get_data_onehot(data):
@@ -27,16 +27,66 @@ def get_data_onehot(data):
     return data_onehot.astype(float)
 
 
+def get_column_dtypes(domain: Domain) -> dict:
+    """
+    The smallest dtype of each column of the domain: the smallest unsigned integer type that holds the values of a
+    categorical column, and float32 for a numeric column.
+    """
+    return {attr: np.min_scalar_type(n - 1) if n > 1 else np.dtype(np.float32)
+            for attr, n in zip(domain.attrs, domain.shape)}
+
+
+def check_categorical_values(domain: Domain, columns, attrs=None):
+    """
+    Raises a ValueError if a categorical column does not hold integer codes in [0, size). Casting such a column to
+    the dtype of get_column_dtypes would silently wrap or truncate its values into other categories.
+
+    :param domain: a domain object
+    :param columns: a dataframe or a dictionary from each attribute to its values
+    :param attrs: the attributes to check, all the categorical attributes of the domain by default
+    """
+    attrs = domain.get_categorical_cols() if attrs is None else attrs
+    for attr in attrs:
+        n = domain[attr]
+        values = np.asarray(columns[attr])
+        if n <= 1 or values.size == 0:
+            continue
+        if values.dtype.kind == 'f':
+            is_integer = np.all(np.isfinite(values)) and np.all(values == np.floor(values))
+        else:
+            is_integer = values.dtype.kind in 'biu'
+        if not is_integer:
+            raise ValueError(f'Column {attr} is categorical with size {n}, but holds values that are not integers.')
+        low, high = values.min(), values.max()
+        if low < 0 or high >= n:
+            raise ValueError(f'Column {attr} is categorical with size {n}, but holds values in [{low}, {high}].')
+
+
 class Dataset:
     def __init__(self, df, domain):
-        """ create a Dataset object
+        """ create a Dataset object. The columns are stored in the dtypes of get_column_dtypes.
 
         :param df: a pandas dataframe
         :param domain: a domain object
         """
         assert set(domain.attrs) <= set(df.columns), 'data must contain domain attributes'
+        check_categorical_values(domain, df)
         self.domain = domain
-        self.df = df.loc[:, domain.attrs]
+        self.df = df.loc[:, domain.attrs].astype(get_column_dtypes(domain), copy=False)
+
+    @property
+    def df(self) -> pd.DataFrame:
+        """The data. Assigning a new dataframe clears the cached views; call clear_cache after modifying it in place."""
+        return self._df
+
+    @df.setter
+    def df(self, df: pd.DataFrame):
+        self._df = df
+        self.clear_cache()
+
+    def clear_cache(self):
+        """Clears the cached arrays of to_numpy, to_onehot, to_onehot_sparse and get_bin_indices."""
+        self._views = {}
 
     def __len__(self):
         return len(self.df)
@@ -84,13 +134,66 @@ class Dataset:
         config = json.load(open(domain))
         domain = Domain(config.keys(), config.values())
         return Dataset(df, domain)
-    
+
+    @staticmethod
+    def from_columns(domain, columns: dict):
+        """ create a Dataset from a dictionary of column arrays without copying them, if they already have the dtypes
+        of get_column_dtypes. Only the columns that are cast are checked with check_categorical_values, so that
+        memory mapped columns are not read.
+
+        :param domain: a domain object
+        :param columns: a dictionary from each attribute of the domain to its values
+        """
+        dtypes = get_column_dtypes(domain)
+        check_categorical_values(domain, columns, [attr for attr in domain.get_categorical_cols()
+                                                   if np.asarray(columns[attr]).dtype != dtypes[attr]])
+        data = Dataset.__new__(Dataset)
+        data.domain = domain
+        data.df = pd.DataFrame({attr: np.asarray(columns[attr], dtype=dtypes[attr]) for attr in domain.attrs},
+                               copy=False)
+        return data
+
+    def save_columns(self, path):
+        """ save the dataset in a directory, with one .npy file per column and the domain in domain.json
+
+        :param path: path to the directory
+        """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'domain.json'), 'w') as f:
+            json.dump({attr: int(n) for attr, n in zip(self.domain.attrs, self.domain.shape)}, f)
+        for i, attr in enumerate(self.domain.attrs):
+            np.save(os.path.join(path, f'{i}.npy'), np.ascontiguousarray(self.df[attr].values))
+
+    @staticmethod
+    def open_columns(path, cols=None, mmap_mode='r'):
+        """ open a dataset saved with save_columns. The columns are memory mapped, so opening does not read them and
+        processes that open the same directory share one copy in memory.
+
+        :param path: path to the directory
+        :param cols: If not None, only these columns are opened
+        :param mmap_mode: memory mapping mode of numpy.load. With None the columns are read into memory.
+        """
+        with open(os.path.join(path, 'domain.json')) as f:
+            domain = Domain.fromdict(json.load(f))
+        indices = {attr: i for i, attr in enumerate(domain.attrs)}
+        if cols is not None:
+            domain = domain.project(cols)
+        columns = {attr: np.load(os.path.join(path, f'{indices[attr]}.npy'), mmap_mode=mmap_mode)
+                   for attr in domain.attrs}
+        return Dataset.from_columns(domain, columns)
+
+    def is_read_only(self):
+        """ True if no column can be written, as with the memory mapped columns of open_columns """
+        return all(not self.df[attr].values.flags.writeable for attr in self.domain.attrs)
+
     def project(self, cols):
-        """ project dataset onto a subset of columns """
+        """ project dataset onto a subset of columns. Read-only columns are shared with the projection. """
         if type(cols) in [str, int]:
             cols = [cols]
-        data = self.df.loc[:,cols]
         domain = self.domain.project(cols)
+        if self.is_read_only():
+            return Dataset.from_columns(domain, {attr: self.df[attr].values for attr in domain.attrs})
+        data = self.df.loc[:,cols]
         return Dataset(data, domain)
 
     def drop(self, cols):
@@ -148,65 +251,111 @@ class Dataset:
         df = pd.DataFrame(np.array(X), columns=domain.attrs)
         return Dataset(df, domain=domain)
 
-    def to_numpy(self):
-        cols = [self.df.values[:, i].astype(int) if n > 1 else self.df.values[:, i].astype(float) for i, n in enumerate(self.domain.shape)]
-        df_numpy = jnp.vstack(cols).T
-        return df_numpy
+    def to_numpy(self) -> jnp.ndarray:
+        """
+        The dataset as a device array, of int32 if all the columns are categorical and of float32 otherwise. The array
+        is cached until the dataframe is replaced.
+        """
+        if 'numpy' not in self._views:
+            dtype = np.float32 if len(self.domain.get_numeric_cols()) > 0 else np.int32
+            X = np.empty((len(self.df), len(self.domain.attrs)), dtype=dtype)
+            for i, attr in enumerate(self.domain.attrs):
+                X[:, i] = self.df[attr].values
+            self._views['numpy'] = jnp.asarray(X)
+        return self._views['numpy']
 
     def to_onehot(self) -> jnp.ndarray:
-        df_data = self.df
-        oh_encoded = []
-        for attr, num_classes in zip(self.domain.attrs, self.domain.shape):
-            col = df_data[attr].values
-            if num_classes > 1:
-                # Categorical features
-                col_oh = jax.nn.one_hot(col.astype(int), num_classes)
-                oh_encoded.append(col_oh)
-            elif num_classes == 1:
-                # Numerical features
-                oh_encoded.append(col.astype(float).reshape((-1, 1)))
-        data_onehot = jnp.concatenate(oh_encoded, axis=1)
+        """
+        The dataset with the categorical columns one-hot encoded, as a float32 device array. The array is cached until
+        the dataframe is replaced.
+        """
+        if 'onehot' not in self._views:
+            cat_positions, num_values = self._get_onehot_columns()
+            offsets = self.domain.onehot_offsets
+            num_positions = offsets[self.domain.numeric_index]
+            X_oh = np.zeros((len(self.df), self.domain.get_dimension()), dtype=np.float32)
+            X_oh[np.arange(len(self.df))[:, None], cat_positions] = 1
+            X_oh[:, num_positions] = num_values
+            self._views['onehot'] = jnp.asarray(X_oh)
+        return self._views['onehot']
+
+    def to_onehot_sparse(self) -> tuple:
+        """
+        The one-hot encoding in index form: an int32 device array with the one-hot position of the value of each
+        categorical column, and a float32 device array with the numeric columns. It takes the memory of the dataset
+        instead of the memory of the one-hot encoding, and it is cached until the dataframe is replaced.
+        """
+        if 'onehot_sparse' not in self._views:
+            cat_positions, num_values = self._get_onehot_columns()
+            self._views['onehot_sparse'] = (jnp.asarray(cat_positions), jnp.asarray(num_values))
+        return self._views['onehot_sparse']
 
-        return data_onehot.astype(float)
+    def get_bin_indices(self, num_bins: int) -> np.ndarray:
+        """
+        The bin of each value of the numeric columns on the grid of num_bins equal intervals of [0, 1] of the range
+        marginals, as an int32 array with one column per numeric attribute. A value v is in bin j if
+        j / num_bins <= v < (j + 1) / num_bins, where the last bin extends up to 1.01, and the bin is -1 if v is not in
+        [0, 1.01). The bounds are compared in float32, like the queries of the range marginals. The array is cached
+        per num_bins until the dataframe is replaced.
+        """
+        key = ('bins', num_bins)
+        if key not in self._views:
+            lower = np.linspace(0, 1, num=num_bins + 1)[:-1].astype(np.float32)
+            upper = np.float32(1.01)
+            bin_indices = np.empty((len(self.df), len(self.domain.numeric_index)), dtype=np.int32)
+            for i, attr in enumerate(self.domain.get_numeric_cols()):
+                col = self.df[attr].values
+                bin_indices[:, i] = np.digitize(col, lower) - 1
+                bin_indices[~(col < upper), i] = -1
+            self._views[key] = bin_indices
+        return self._views[key]
+
+    def _get_onehot_columns(self) -> tuple:
+        offsets = self.domain.onehot_offsets
+        cat_positions = np.empty((len(self.df), len(self.domain.get_categorical_cols())), dtype=np.int32)
+        num_values = np.empty((len(self.df), len(self.domain.get_numeric_cols())), dtype=np.float32)
+        i_cat, i_num = 0, 0
+        for attr, num_classes, offset in zip(self.domain.attrs, self.domain.shape, offsets):
+            if num_classes > 1:
+                cat_positions[:, i_cat] = self.df[attr].values
+                cat_positions[:, i_cat] += offset
+                i_cat += 1
+            else:
+                num_values[:, i_num] = self.df[attr].values
+                i_num += 1
+        return cat_positions, num_values
 
     @staticmethod
     def from_onehot_to_dataset(domain: Domain, X_oh):
-
-        dtypes = []
+        """ decode a one-hot encoded (or relaxed) dataset. The value of a categorical column is the argmax of its
+        one-hot block. """
+        X_oh = np.asarray(X_oh)
+        columns = {}
         start = 0
-        output = []
-        column_names = domain.attrs
-        cat_cols = domain.get_categorical_cols()
-        for col in domain.attrs:
-            dimensions = domain.size(col)
-            column_onehot_encoding = X_oh[:, start:start + dimensions]
-
-
-            if col in cat_cols:
-                encoder = OneHotEncoder()
-                # encoder.categories_ = [list(range(domain.size(col)))]
-                dummy = [[v] for v in range(domain.size(col))]
-                encoder.fit(dummy)
-                col_values = encoder.inverse_transform(column_onehot_encoding)
-                dtypes.append('int64')
+        for attr, num_classes in zip(domain.attrs, domain.shape):
+            if num_classes > 1:
+                columns[attr] = np.argmax(X_oh[:, start:start + num_classes], axis=1)
             else:
-                col_values = column_onehot_encoding.squeeze()
-                dtypes.append('float')
-
-            output.append(col_values)
-            start += dimensions
-
-        data_np = np.column_stack(output)
-
-        data_df = pd.DataFrame(data_np, columns=column_names)
+                columns[attr] = np.array(X_oh[:, start], dtype=np.float32)
+            start += num_classes
+        return Dataset.from_columns(domain, columns)
 
-        dtypes = pd.Series(dtypes, data_df.columns)
-
-        data_df = data_df.astype(dtypes)
-
-        data = Dataset(data_df, domain=domain)
-
-        return data
+    @staticmethod
+    def from_onehot_sparse_to_dataset(domain: Domain, cat_positions, num_values):
+        """ decode the index form of the one-hot encoding returned by to_onehot_sparse """
+        cat_positions = np.asarray(cat_positions)
+        num_values = np.asarray(num_values)
+        offsets = domain.onehot_offsets
+        columns = {}
+        i_cat, i_num = 0, 0
+        for attr, num_classes, offset in zip(domain.attrs, domain.shape, offsets):
+            if num_classes > 1:
+                columns[attr] = cat_positions[:, i_cat] - offset
+                i_cat += 1
+            else:
+                columns[attr] = np.array(num_values[:, i_num], dtype=np.float32)
+                i_num += 1
+        return Dataset.from_columns(domain, columns)
 
 
     @staticmethod
@@ -302,7 +451,8 @@ class Dataset:
 
     def discretize(self, num_bins=10):
         """
-        Discretize real-valued columns using an equal sized binning strategy
+        Discretize real-valued columns using an equal sized binning strategy. As in get_bin_indices, the value 1 is in
+        the last bin, and values outside of [0, 1] are in the first or the last bin.
         """
         numerical_cols = self.domain.get_numeric_cols()
         bin_edges = np.linspace(0, 1, num_bins+1)[1:]
@@ -311,7 +461,7 @@ class Dataset:
         for col, shape in zip(self.domain.attrs, self.domain.shape) :
             col_values = self.df[col].values
             if col in numerical_cols:
-                discrete_col_values = np.digitize(col_values, bin_edges)
+                discrete_col_values = np.minimum(np.digitize(col_values, bin_edges), num_bins - 1)
                 cols.append(discrete_col_values)
                 domain_shape.append(num_bins)
             else:
@@ -366,7 +516,7 @@ class Dataset:
         domain_shape = []
         """ when called on a discretized dataset it turns discretized features into numeric features """
         for col, shape in zip(data.domain.attrs, data.domain.shape):
-            col_values = data.df_real[col].values
+            col_values = data.df[col].values
 
             if col in numeric_features:
                 rand_values = np.random.rand(col_values.shape[0]) / shape
@@ -444,6 +594,47 @@ def test_onehot_encoding():
 
     # assert raw_data_array
 
+
+def test_categorical_values():
+    dom = Domain(['A', 'B', 'C'], [3, 1, 300])
+    raw_data_array = pd.DataFrame([
+                        [0, 0.0, 0.0],
+                        [2, 0.5, 299.0],
+                        [1, 1.0, 5.0]], columns=['A', 'B', 'C'])
+    data = Dataset(raw_data_array, dom)
+    assert [data.df[col].dtype for col in dom.attrs] == [np.uint8, np.float32, np.uint16]
+
+    for col, values in [('A', [0, -1, 1]), ('A', [0, 3, 1]), ('A', [0, 1.5, 1]), ('C', [0, np.nan, 1]),
+                        ('A', ['x', 'y', 'z'])]:
+        bad_data_array = raw_data_array.copy()
+        bad_data_array[col] = values
+        try:
+            Dataset(bad_data_array, dom)
+        except ValueError as e:
+            assert f'Column {col}' in str(e)
+        else:
+            raise AssertionError(f'Column {col} with values {values} was accepted.')
+
+    try:
+        Dataset.from_columns(dom, {'A': np.array([0, 5]), 'B': np.array([0.1, 0.2]), 'C': np.array([1, 2])})
+    except ValueError as e:
+        assert 'Column A' in str(e)
+    else:
+        raise AssertionError('from_columns accepted the value 5 of a column of size 3.')
+
+
+def test_discretize_codes():
+    dom = Domain(['A', 'B'], [3, 1])
+    data = Dataset(pd.DataFrame({'A': [0, 1, 2, 0], 'B': [0.0, 0.5, 1.0, 0.99]}), dom)
+    data_disc = data.discretize(num_bins=4)
+    assert data_disc.domain.shape == (3, 4)
+    assert data_disc.df['B'].tolist() == [0, 2, 3, 3]
+    # The codes are the bins of get_bin_indices.
+    assert data_disc.df['B'].tolist() == data.get_bin_indices(4)[:, 0].tolist()
+
+
 if __name__ == "__main__":
     # test_onehot_encoding()
-    test_discrete()
\ No newline at end of file
+    test_discrete()
+    test_categorical_values()
+    test_discretize_codes()
\ No newline at end of file
@@ -1,17 +1,37 @@
 from functools import reduce
+import numpy as np
 import jax.numpy as jnp
 
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    array.flags.writeable = False
+    return array
+
+
 class Domain:
     def __init__(self, attrs, shape):
-        """ Construct a Domain object
+        """ Construct a Domain object. The index maps of the schema are computed here once, and are read-only:
+
+            attr_index: dictionary from attribute to its position
+            cardinalities: array of the domain sizes
+            onehot_offsets: array of the position of each attribute in the one-hot encoding
+            categorical_index, numeric_index: arrays of the positions of the categorical and numeric attributes
         
         :param attrs: a list or tuple of attribute names
         :param shape: a list or tuple of domain sizes for each attribute
         """
         assert len(attrs) == len(shape), 'dimensions must be equal'
         self.attrs = tuple(attrs)
-        self.shape = tuple(shape)
-        self.config = dict(zip(attrs, shape))
+        self.shape = tuple(int(n) for n in shape)
+        self.config = dict(zip(self.attrs, self.shape))
+
+        self.attr_index = {attr: i for i, attr in enumerate(self.attrs)}
+        self.cardinalities = _read_only(np.array(self.shape, dtype=np.int64))
+        self.onehot_offsets = _read_only(np.cumsum(self.cardinalities) - self.cardinalities)
+        self.categorical_index = _read_only(np.flatnonzero(self.cardinalities > 1))
+        self.numeric_index = _read_only(np.flatnonzero(self.cardinalities == 1))
+        self._categorical_cols = tuple(self.attrs[i] for i in self.categorical_index)
+        self._numeric_cols = tuple(self.attrs[i] for i in self.numeric_index)
 
     @staticmethod
     def fromdict(config):
@@ -52,7 +72,7 @@ class Domain:
         :param attrs: the attributes
         :return: a tuple with the corresponding axes
         """
-        return tuple(self.attrs.index(a) for a in attrs)
+        return tuple(self.attr_index[a] for a in attrs)
 
     def transpose(self, attrs):
         """ reorder the attributes in the domain object """
@@ -102,7 +122,7 @@ class Domain:
         return tuple(a for a in self.attrs if a in attrs)
 
     def __contains__(self, attr):
-        return attr in self.attrs
+        return attr in self.attr_index
 
     def __getitem__(self, a):
         """ return the size of an individual attribute
@@ -128,33 +148,17 @@ class Domain:
         return self.__repr__()
 
     def get_numeric_cols(self):
-        n_cols = []
-        for c in self.attrs:
-            if self.config[c] == 1:
-                n_cols.append(c)
-        return n_cols
+        return list(self._numeric_cols)
 
     def get_categorical_cols(self):
-        c_cols = []
-        for c in self.attrs:
-            if self.config[c] > 1:
-                c_cols.append(c)
-        return c_cols
+        return list(self._categorical_cols)
 
     def get_attribute_indices(self, atts):
-        indices = []
-        for i, temp in enumerate(self.attrs):
-            if temp not in atts:
-               continue
-            indices.append(i)
+        """ the positions of the attributes of atts in the domain, in the order of the domain and each once """
+        indices = np.unique([self.attr_index[att] for att in atts if att in self.attr_index]).astype(np.int32)
         return jnp.array(indices)
 
     def get_attribute_onehot_indices(self, att):
-        left_position = 0
-        for temp in self.attrs:
-            if temp == att:
-                break
-            left_position += self.size([temp])
-
-        att_size = self.size([att])
-        return jnp.arange(0, att_size) + left_position
+        """ the positions of the attribute att in the one-hot encoding """
+        i = self.attr_index[att]
+        return jnp.arange(0, self.shape[i]) + int(self.onehot_offsets[i])
@@ -1,6 +1,5 @@
 import time
 from utils import Domain
-import matplotlib.pyplot as plt
 
 
 def timer(last_time=None, msg=None):
@@ -37,6 +36,7 @@ def filter_outliers(df_train, df_test, config, quantile=0.01, visualize_columns=
         # meanv = df_train[num_col].mean()
         # print(f'Col={num_col:<10}: mean={meanv:<5.3f}, min={minv:<5.3f},  max={maxv:<5.3f},')
         if visualize_columns:
+            import matplotlib.pyplot as plt
             df_train[num_col].hist()
             plt.title(f'Column={num_col}')
             # plt.yscale('log')
@@ -1,8 +1,6 @@
 import jax.random
-import matplotlib.pyplot as plt
 import pandas as pd
 from utils import Domain
-from sklearn.preprocessing import OneHotEncoder, StandardScaler
 import numpy as np
 
 
@@ -33,6 +31,7 @@ def filter_outliers(df_train, df_test, config, quantile=0.01, visualize_columns=
         # meanv = df_train[num_col].mean()
         # print(f'Col={num_col:<10}: mean={meanv:<5.3f}, min={minv:<5.3f},  max={maxv:<5.3f},')
         if visualize_columns:
+            import matplotlib.pyplot as plt
             df_train[num_col].hist()
             plt.title(f'Column={num_col}')
             # plt.yscale('log')
@@ -47,6 +46,7 @@ def separate_cat_and_num_cols(domain, features):
     return train_cols_num, train_cols_cat
 def get_Xy(domain: Domain, features: list, target, df_train: pd.DataFrame, df_test: pd.DataFrame,
            rescale=True):
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
     cols_num, cols_cat = separate_cat_and_num_cols(domain, features)
     y_train = df_train[target].values
     y_test = df_test[target].values
@@ -0,0 +1,120 @@
+"""
+Opt-in profiler instrumentation. When profiling is enabled, the phases of the statistics and the generators are
+wrapped in named trace annotations, and a TraceWindow writes a profiler trace (viewable with TensorBoard or Perfetto)
+for a chosen range of rounds or generations. The compiled kernels always carry named scopes, which cost nothing at
+run time.
+"""
+import contextlib
+import functools
+import jax
+from utils.sanitizer import get_active_sanitizer, region
+
+_profiling_enabled = False
+
+
+def enable_profiling(enabled: bool = True):
+    global _profiling_enabled
+    _profiling_enabled = enabled
+
+
+def is_profiling_enabled() -> bool:
+    return _profiling_enabled
+
+
+def profile_scope(name: str):
+    """
+    Context manager that annotates the enclosed host code in the profiler trace, if profiling is enabled, and names
+    the region of the code for the active Sanitizer, if any.
+    """
+    sanitizer_active = get_active_sanitizer() is not None
+    if not _profiling_enabled and not sanitizer_active:
+        return contextlib.nullcontext()
+    stack = contextlib.ExitStack()
+    if _profiling_enabled:
+        stack.enter_context(jax.profiler.TraceAnnotation(name))
+    if sanitizer_active:
+        stack.enter_context(region(name))
+    return stack
+
+
+def profile_function(name: str):
+    """Decorator version of profile_scope."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profile_scope(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TraceWindow:
+    def __init__(self, log_dir: str, first: int, last: int = None):
+        """
+        Captures a profiler trace of the steps (rounds or generations) from first to last, both included.
+
+        :param log_dir: directory of the trace
+        :param first: first step of the window
+        :param last: last step of the window. If None, only the step first is captured.
+        """
+        self.log_dir = log_dir
+        self.first = first
+        self.last = first if last is None else last
+        self.active = False
+        self.done = False
+        self.profiling_was_enabled = False
+
+    def step(self, step: int, step_last: int = None):
+        """
+        Called before running step, or the steps from step to step_last. Starts the trace if they overlap the window.
+        Profiling is enabled while the trace runs.
+        """
+        step_last = step if step_last is None else step_last
+        if not self.active and not self.done and step <= self.last and self.first <= step_last:
+            self.profiling_was_enabled = is_profiling_enabled()
+            enable_profiling()
+            jax.profiler.start_trace(self.log_dir)
+            self.active = True
+
+    def step_end(self, step: int):
+        """Called after running the steps up to step. Stops the trace after the last step of the window."""
+        if self.active and step >= self.last:
+            self.stop()
+
+    def stop(self):
+        """Stops the trace, and restores profiling to its state before the trace."""
+        if self.active:
+            jax.profiler.stop_trace()
+            enable_profiling(self.profiling_was_enabled)
+            self.active = False
+            self.done = True
+
+
+######################################################################
+## TEST
+######################################################################
+
+def test_trace_window():
+    """A trace window captures only its steps, and profiling is back to its previous state after it."""
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        window = TraceWindow(log_dir, first=2, last=3)
+        enable_profiling(False)
+        for step in range(6):
+            window.step(step)
+            assert window.active == (2 <= step <= 3)
+            assert is_profiling_enabled() == window.active
+            window.step_end(step)
+        assert window.done and not is_profiling_enabled()
+
+        enable_profiling(True)
+        window = TraceWindow(log_dir, first=0)
+        window.step(0, 9)
+        window.stop()
+        assert is_profiling_enabled()
+        enable_profiling(False)
+
+
+if __name__ == "__main__":
+    test_trace_window()
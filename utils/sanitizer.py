@@ -0,0 +1,202 @@
+"""
+Debug mode that counts jit cache misses and device-to-host transfers per named region of the code, to catch
+recompilations and host synchronizations in hot loops.
+
+    sanitizer = Sanitizer(budgets={'GSD.fit/generations': {'compiles': 0}}, raise_on_budget=True)
+    gsd = GSD(..., sanitizer=sanitizer)
+
+The regions are the names of profile_scope (see utils.profiling). Events outside of any region, or on other threads
+such as the background compilation, are counted under the region '<none>'.
+
+The transfers counted are the arrays read by device_get of this module, which the hot loops use for their reads of
+device values. Other transfers are implicit (float(x), np.asarray(x), ...), and transfer_guard of Sanitizer applies
+the jax transfer guard to them, e.g. 'disallow' to raise on any implicit transfer in the sanitized code. The guard
+only applies to accelerators, since the arrays of the CPU backend are already in host memory.
+"""
+import contextlib
+import threading
+import jax
+import pandas as pd
+
+TRACE_EVENT = '/jax/core/compile/jaxpr_trace_duration'
+COMPILE_EVENT = '/jax/core/compile/backend_compile_duration'
+COUNTERS = ('traces', 'compiles', 'transfers')
+NO_REGION = '<none>'
+
+_active_sanitizer = None
+_listener_registered = False
+_region_stack = threading.local()
+
+
+class BudgetExceededError(RuntimeError):
+    pass
+
+
+def get_active_sanitizer():
+    return _active_sanitizer
+
+
+def _get_region_stack() -> list:
+    if not hasattr(_region_stack, 'stack'):
+        _region_stack.stack = []
+    return _region_stack.stack
+
+
+def _on_event_duration(event: str, duration: float):
+    if _active_sanitizer is None:
+        return
+    if event == TRACE_EVENT:
+        _active_sanitizer.count('traces')
+    elif event == COMPILE_EVENT:
+        _active_sanitizer.count('compiles')
+
+
+def device_get(tree):
+    """jax.device_get, which counts the arrays of tree as transfers of the active sanitizer, if any."""
+    if _active_sanitizer is not None:
+        num_arrays = sum(isinstance(leaf, jax.Array) for leaf in jax.tree_util.tree_leaves(tree))
+        if num_arrays > 0:
+            _active_sanitizer.count('transfers', num_arrays)
+    return jax.device_get(tree)
+
+
+class Sanitizer:
+    """
+    The 'transfers' counter only counts the reads of device_get. Implicit transfers, such as float(x),
+    np.asarray(x) or x.item() on a device array, are not counted and do not show in the report; on accelerators,
+    transfer_guard logs or raises on them instead. On the CPU backend they are invisible to the sanitizer.
+    """
+    def __init__(self, budgets: dict = None, raise_on_budget: bool = False, verbose: bool = True,
+                 transfer_guard: str = None):
+        """
+        :param budgets: dictionary from region name to a dictionary with the maximum number of 'traces', 'compiles'
+         and 'transfers' of the region
+        :param raise_on_budget: If True, report raises BudgetExceededError when a region exceeds its budget
+        :param verbose: If True, report prints the counts
+        :param transfer_guard: If given, the level of jax.transfer_guard_device_to_host ('log' or 'disallow') for the
+         implicit transfers of the thread that activates the sanitizer
+        """
+        self.budgets = budgets if budgets is not None else {}
+        self.raise_on_budget = raise_on_budget
+        self.verbose = verbose
+        self.transfer_guard = transfer_guard
+        self.counts = {}
+        self.depth = 0
+        self.lock = threading.Lock()
+
+    def count(self, counter: str, num: int = 1):
+        stack = _get_region_stack()
+        region = stack[-1] if len(stack) > 0 else NO_REGION
+        with self.lock:
+            region_counts = self.counts.setdefault(region, dict.fromkeys(COUNTERS, 0))
+            region_counts[counter] += num
+
+    @contextlib.contextmanager
+    def activate(self, name: str = None):
+        """
+        Counts the events until the outermost activation exits, then reports them. The counts start from zero at
+        the outermost activation. If the enclosed code raises, the exception propagates without a report and the
+        counts are left in counts.
+        """
+        global _active_sanitizer, _listener_registered
+        if self.depth == 0:
+            if _active_sanitizer is not None:
+                raise RuntimeError('Another Sanitizer is active.')
+            if not _listener_registered:
+                # jax.monitoring listeners cannot be removed, so a single listener forwards to the active sanitizer.
+                jax.monitoring.register_event_duration_secs_listener(_on_event_duration)
+                _listener_registered = True
+            self.counts = {}
+            _active_sanitizer = self
+        self.depth += 1
+        try:
+            with contextlib.ExitStack() as stack:
+                if self.depth == 1 and self.transfer_guard is not None:
+                    stack.enter_context(jax.transfer_guard_device_to_host(self.transfer_guard))
+                if name is not None:
+                    stack.enter_context(region(name))
+                yield self
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                _active_sanitizer = None
+        # Only reached on a normal exit, so a budget violation does not replace an exception of the enclosed code.
+        if self.depth == 0:
+            self.report()
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame.from_dict(self.counts, orient='index', columns=list(COUNTERS)).sort_index()
+
+    def get_budget_violations(self) -> list:
+        violations = []
+        for region_name, budget in self.budgets.items():
+            region_counts = self.counts.get(region_name, dict.fromkeys(COUNTERS, 0))
+            for counter, max_count in budget.items():
+                if region_counts[counter] > max_count:
+                    violations.append(f'{region_name}: {region_counts[counter]} {counter} > {max_count}')
+        return violations
+
+    def report(self):
+        if self.verbose:
+            print('Sanitizer counts:')
+            print(self.to_dataframe().to_string())
+        violations = self.get_budget_violations()
+        if len(violations) > 0:
+            message = 'Sanitizer budget exceeded: ' + '; '.join(violations)
+            if self.raise_on_budget:
+                raise BudgetExceededError(message)
+            print(message)
+
+
+@contextlib.contextmanager
+def region(name: str):
+    """Attributes the events in the enclosed code to the region name."""
+    stack = _get_region_stack()
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+######################################################################
+## TEST
+######################################################################
+
+def test_sanitizer():
+    """Compiles and device_get reads are counted per region, budgets raise, and exceptions are not masked."""
+    import jax.numpy as jnp
+
+    sanitizer = Sanitizer(budgets={'loop': {'compiles': 0}}, verbose=False)
+    with sanitizer.activate():
+        with region('setup'):
+            fn = jax.jit(lambda x: x * 2 + 1)
+            x = fn(jnp.arange(3))
+        with region('loop'):
+            for _ in range(3):
+                x = fn(x)
+            device_get((x, x, 1.0))
+    assert sanitizer.counts['setup']['compiles'] >= 1
+    assert sanitizer.counts['loop'] == {'traces': 0, 'compiles': 0, 'transfers': 2}
+    assert get_active_sanitizer() is None
+
+    sanitizer = Sanitizer(budgets={'loop': {'compiles': 0}}, raise_on_budget=True, verbose=False)
+    try:
+        with sanitizer.activate('loop'):
+            jax.jit(lambda x: x - 1)(jnp.arange(4))
+        assert False, 'The loop compiled a kernel.'
+    except BudgetExceededError:
+        pass
+
+    try:
+        with sanitizer.activate('loop'):
+            jax.jit(lambda x: x - 2)(jnp.arange(5))
+            raise KeyError('inner')
+    except KeyError:
+        pass
+    assert get_active_sanitizer() is None
+    assert sanitizer.counts['loop']['compiles'] >= 1
+
+
+if __name__ == "__main__":
+    test_sanitizer()
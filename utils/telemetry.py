@@ -0,0 +1,86 @@
+"""
+Telemetry of the generation loop. The generator collects the telemetry of a chunk of generations on the device and
+hands it to the sinks as a list of records (dictionaries) once per chunk.
+"""
+import json
+import numpy as np
+import pandas as pd
+
+
+def to_python(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+class TelemetrySink:
+    def write(self, records: list):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlSink(TelemetrySink):
+    def __init__(self, path: str, mode: str = 'a'):
+        """Appends one JSON object per record to the file at path."""
+        self.path = path
+        self.file = open(path, mode)
+
+    def write(self, records: list):
+        for record in records:
+            self.file.write(json.dumps({key: to_python(value) for key, value in record.items()}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CallbackSink(TelemetrySink):
+    def __init__(self, callback):
+        """Calls callback(records) once per flush."""
+        self.callback = callback
+
+    def write(self, records: list):
+        self.callback(records)
+
+
+class DataFrameSink(TelemetrySink):
+    def __init__(self):
+        """Keeps the records in memory, see to_dataframe."""
+        self.records = []
+
+    def write(self, records: list):
+        self.records.extend({key: to_python(value) for key, value in record.items()} for record in records)
+
+    def to_dataframe(self, event: str = None) -> pd.DataFrame:
+        records = self.records if event is None else [r for r in self.records if r.get('event') == event]
+        return pd.DataFrame(records)
+
+
+class Telemetry:
+    def __init__(self, sinks=None):
+        """
+        Dispatches records to a list of sinks. With no sinks, records are dropped without being built.
+
+        :param sinks: a TelemetrySink or a list of them
+        """
+        if sinks is None:
+            sinks = []
+        elif isinstance(sinks, TelemetrySink):
+            sinks = [sinks]
+        self.sinks = list(sinks)
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.sinks) > 0
+
+    def write(self, records: list):
+        for sink in self.sinks:
+            sink.write(records)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()